@@ -3,64 +3,103 @@ Add the correct logainm tags to all objects
 """
 import sys
 import logging
-from contextlib import contextmanager
 import csv
-import sqlite3
 import xml.etree.ElementTree as ET
 import argparse
 from collections import defaultdict
 import re
 
+import instrumentation
+import osm_output
+import logainm_store
+
 logging.getLogger().setLevel(logging.DEBUG)
 logger = logging.getLogger(__name__)
 
-@contextmanager
-def printer(msg):
-    msg = msg.strip()
-    logger.info("Started "+msg)
-    yield
-    logger.info("Finished "+msg)
-
-def get_existing_osm_tags(xml_el):
-    """Given a XML element for an object, return (as dict) the current OSM tags"""
-    return {el.get('k'): el.get('v') for el in xml_el.findall("tag")}
-
-
-def set_tag(osmobj, k, v):
-    if v is None:
-        return
-
-    updated_existing_tag = False
-    for tag in osmobj.findall("tag"):
-        if tag.attrib["k"] == k:
-            tag.set("v", v)
-            updated_existing_tag = True
-
-    if not updated_existing_tag:
-        ET.SubElement(osmobj, 'tag', {'k': k, 'v': v})
-
-def set_if_missing(osmobj, k, v):
-    if v is None:
-        # Do nothing for empty values
-        return
-
-    existing_value = [tag.attrib['v'] for tag in osmobj.findall("tag") if tag.attrib.get("k") == k]
-    existing_value = existing_value[0] if len(existing_value) > 0 else None
-    if existing_value is None:
-        logger.debug("Settting %(k)s=%(v)s for osmobj %(id)s", {'k': k, 'v': v, 'id': osmobj.attrib['id']})
-        set_tag(osmobj, k, v)
-    elif existing_value != v:
-        logger.debug("relation %(id)s tag %(k)s is %(current)r. Wanted to set to %(new)r", {'id':osmobj.attrib['id'], 'k': k, 'current': existing_value, 'new': v})
-    else:
-        # it has a value, which is the same as what we want to set, so just skip
-        pass
-            
+printer = instrumentation.make_printer(logger)
+
+
+class Tags(object):
+    """The tags of an OSM object XML element, by key, so each tag can be
+    read & changed without going through all the tags every time"""
+
+    def __init__(self, osmobj):
+        self.osmobj = osmobj
+        self.elements = {tag.get('k'): tag for tag in osmobj.findall("tag")}
+
+    def __contains__(self, k):
+        return k in self.elements
+
+    def get(self, k, default=None):
+        tag = self.elements.get(k)
+        return default if tag is None else tag.get('v')
+
+    def set(self, k, v):
+        """Set tag k to v, returns True iff that changed anything"""
+        if v is None or self.get(k) == v:
+            return False
+
+        if k in self.elements:
+            self.elements[k].set("v", v)
+        else:
+            self.elements[k] = ET.SubElement(self.osmobj, 'tag', {'k': k, 'v': v})
+        return True
+
+    def set_if_missing(self, k, v):
+        if v is None:
+            # Do nothing for empty values
+            return False
+
+        existing_value = self.get(k)
+        if existing_value is None:
+            logger.debug("Settting %(k)s=%(v)s for osmobj %(id)s", {'k': k, 'v': v, 'id': self.osmobj.attrib['id']})
+            return self.set(k, v)
+        elif existing_value != v:
+            logger.debug("relation %(id)s tag %(k)s is %(current)r. Wanted to set to %(new)r", {'id': self.osmobj.attrib['id'], 'k': k, 'current': existing_value, 'new': v})
+        else:
+            # it has a value, which is the same as what we want to set, so just skip
+            pass
+        return False
+
+PLACENAMESNI_URL = re.compile("^http://www\.placenamesni\.org/resultdetails\.php\?entry=([0-9]+)$")
+
+def logainm_ref_key(logainm_ref):
+    """Key for this logainm:ref in the result of LogainmStore.get_names, or
+    None if it's not one logainm id (e.g. semi-colon separated ones)"""
+    return logainm_store.id_str_key(logainm_ref)
+
+def add_logainm_tags(tags, logainm_data):
+    """Add the logainm tags for this names row (from LogainmStore) to
+    the object with these Tags. Returns the keys of the tags which changed."""
+    changed = []
+    if 'logainm:url' not in tags or tags.get('logainm:url') == 'http://www.logainm.ie/en/{}'.format(logainm_data['logainm_id']):
+        logger.debug("Setting logainm:url to %(url)s for osm id %(id)s", {'url': logainm_data['logainm_permalink'], 'id': logainm_data['logainm_id']})
+        if tags.set('logainm:url', logainm_data.get("logainm_permalink")):
+            changed.append('logainm:url')
+
+    for k, v in [("name:ga", logainm_data.get("name_ga")), ("name:en", logainm_data.get("name_en"))]:
+        if tags.set_if_missing(k, v):
+            changed.append(k)
+
+    if logainm_data.get('placenamesni_link'):
+        link = logainm_data['placenamesni_link']
+        if tags.set_if_missing("placenamesni:url", link):
+            changed.append("placenamesni:url")
+        match = PLACENAMESNI_URL.match(link)
+        if match:
+            pnni_id = match.groups()[0]
+            if tags.set_if_missing("placenamesni:ref", pnni_id):
+                changed.append("placenamesni:ref")
+
+    return changed
 
 def main():
     parser = argparse.ArgumentParser()
     parser.add_argument("-i", "--input")
     parser.add_argument("-o", "--output")
     parser.add_argument("-n", "--dry-run", action="store_true")
+    osm_output.add_output_arguments(parser)
+    parser.add_argument("--profile", metavar="FILE", help="Write the time, CPU, memory & counters of each stage to this JSON file")
 
     args = parser.parse_args()
 
@@ -68,68 +107,54 @@ def main():
     ch.setLevel(logging.DEBUG)
     formatter = logging.Formatter('%(asctime)s\t%(levelname)s\tL%(lineno)s\t%(message)s')
     ch.setFormatter(formatter)
-    logger.addHandler(ch)
+    for log in [logger, osm_output.logger, osm_output.logainm_closure.logger]:
+        log.addHandler(ch)
 
-    conn = sqlite3.connect("logainm.sqlite")
-    cursor = conn.cursor()
+    store = logainm_store.LogainmStore.open()
 
     # read in OSM XML
-    with printer("reading in OSM XML"):
+    with printer("reading in OSM XML") as stage:
         tree = ET.parse(args.input)
         root = tree.getroot()
-
-    # add new tags to OSM XML
-    with printer("correcting names"):
-        for rel in root.findall("relation"):
-            osm_id = rel.get("id", None)
-            tags = get_existing_osm_tags(rel)
-            has_been_changed = False
-            
-            if 'logainm:ref' in tags:
-                try:
-                    logainmref = int(tags['logainm:ref'])
-                except:
-                    # can't int. probably semi-colon multiple
-                    continue
-
-                cursor.execute("select * from names where logainm_id = ?", [logainmref])
-                logainm_data = cursor.fetchone()
-                if logainm_data is None:
-                    logger.debug("No logainm data for logainm_id %s", logainmref)
-                    continue
-                logainm_data = {k: logainm_data[i] for i, k in enumerate([
-                        "logainm_id", "logainm_category_code", "logainm_permalink", "placenamesni_link",
-                        "name_en", "name_ga", "name_ga_genitive", ])
-                }
-
-                if 'logainm:url' not in tags or tags['logainm:url'] == 'http://www.logainm.ie/en/{}'.format(logainm_data['logainm_id']):
-                    logger.debug("Setting logainm:url to %(url)s for osm id %(id)s", {'url': logainm_data['logainm_permalink'], 'id': logainm_data['logainm_id']})
-                    set_tag(rel, 'logainm:url', logainm_data.get("logainm_permalink"))
-
-                set_if_missing(rel, "name:ga", logainm_data.get("name_ga"))
-                set_if_missing(rel, "name:en", logainm_data.get("name_en"))
-
-                if logainm_data.get('placenamesni_link'):
-                    link = logainm_data['placenamesni_link']
-                    set_if_missing(rel, "placenamesni:url", link)
-                    match = re.match("^http://www\.placenamesni\.org/resultdetails\.php\?entry=([0-9]+)$", link)
-                    if match:
-                        pnni_id = match.groups()[0]
-                        set_if_missing(rel, "placenamesni:ref", pnni_id)
-
-
-                # change the tag
-                rel.set("action", "modify")
-                has_been_changed = True
-
-
-            if not has_been_changed:
-                root.remove(rel)
-
-
-    # write out OSM XML
-    with printer("writing out OSM XML"):
-        tree.write(args.output, encoding='utf-8', xml_declaration=True) 
+        stage.objects = len(root)
+
+    output = osm_output.output_from_args(args, store.cursor())
+    output.root_attrib = dict(root.attrib)
+
+    with printer("looking up logainm data") as stage:
+        relations = [(rel, Tags(rel)) for rel in root.findall("relation")]
+        logainm_names = store.get_names(tags.get('logainm:ref') for rel, tags in relations if 'logainm:ref' in tags)
+        stage.objects = len(logainm_names)
+
+    # add new tags, and write out the changed objects
+    with printer("correcting names and writing out OSM XML") as stage:
+        stage.objects = len(relations)
+        for el in root:
+            if el.tag != 'relation':
+                output.add(el)
+        for rel, tags in relations:
+            if 'logainm:ref' not in tags:
+                continue
+            logainmref = logainm_ref_key(tags.get('logainm:ref'))
+            if logainmref is None:
+                # can't int. probably semi-colon multiple
+                continue
+
+            logainm_data = logainm_names.get(logainmref)
+            if logainm_data is None:
+                logger.debug("No logainm data for logainm_id %s", logainmref)
+                continue
+
+            add_logainm_tags(tags, logainm_data)
+
+            # change the tag
+            rel.set("action", "modify")
+            output.add(rel, group=output.county_of(rel, tags.get('logainm:ref')))
+
+        output.close()
+
+    if args.profile:
+        instrumentation.PROFILE.dump(args.profile)
 
 if __name__ == '__main__':
     main()
@@ -0,0 +1,220 @@
+"""
+Time the scripts on synthetic data (from make_synthetic_data.py), and keep
+the results so they can be compared between commits.
+
+    python benchmark.py --scale 1 --scale 5
+
+Data for each scale is made in benchmark-data/scale-N/ the first time it's
+needed, and made again if the code that makes it has changed. Each script is run there with --profile, and the total time, and the
+time of each stage, is added (with the current git commit) to
+benchmark-results.jsonl. Afterwards each result is shown next to the last
+result from a different commit (or the one given with --compare).
+"""
+import sys
+import os
+import time
+import hashlib
+import json
+import logging
+import shutil
+import argparse
+import subprocess
+
+import instrumentation
+
+logger = logging.getLogger(__name__)
+
+printer = instrumentation.make_printer(logger)
+
+REPO_DIR = os.path.dirname(os.path.abspath(__file__))
+
+MATCH_LEVELS = ["match.py", "-i", "boundaries.osm.xml", "-o", "new-boundaries.osm.xml",
+                "--baronies", "--civil-parishes", "--townlands", "--journal", "match-journal.jsonl"]
+
+# Without the cache, so it's all read & matched each time
+MATCH_ALL = MATCH_LEVELS + ["--no-cache"]
+
+# The cache dir of the match-cache-* benchmarks. It's emptied before each run
+# of the benchmarks in EMPTY_CACHE_FIRST, the others use what they left.
+CACHE_DIR = "benchmark-match-cache"
+MATCH_CACHED = MATCH_LEVELS + ["--engine", "memory", "--dry-run", "--cache-dir", CACHE_DIR]
+EMPTY_CACHE_FIRST = {'match-cache-cold'}
+
+# name -> command line (script in this directory, then the arguments). They're
+# run in the data directory, with --profile added.
+BENCHMARKS = [
+    ('match-sql', MATCH_ALL + ["--engine", "sql"]),
+    ('match-batch', MATCH_ALL + ["--engine", "batch"]),
+    ('match-memory', MATCH_ALL + ["--engine", "memory"]),
+    ('match-memory-stream', MATCH_ALL + ["--engine", "memory", "--stream"]),
+    ('match-memory-j4', MATCH_ALL + ["--engine", "memory", "-j", "4"]),
+    ('match-fuzzy', MATCH_ALL + ["--engine", "memory", "--dry-run", "--fuzzy-output", "fuzzy.tsv"]),
+    # Like make td-dry-run: the first time, again with nothing changed, and
+    # when trying out a change to the townland matching
+    ('match-cache-cold', MATCH_CACHED),
+    ('match-cache-warm', MATCH_CACHED),
+    ('match-cache-townlands', MATCH_CACHED + ["--rematch", "townlands"]),
+    ('add_all_logainm_tags', ["add_all_logainm_tags.py", "-i", "boundaries.osm.xml", "-o", "boundaries-all-logainm-tags.osm.xml"]),
+    ('fix_names_encoding', ["fix_names_encoding.py", "-i", "boundaries.osm.xml", "-o", "fixed-names.osm.xml"]),
+    ('logainm_lint', ["logainm_lint.py", "-i", "boundaries.osm.xml", "--all"]),
+    ('pipeline', ["pipeline.py", "-i", "boundaries.osm.xml", "-o", "nightly.osc", "--report", "nightly-report.jsonl"]),
+]
+
+
+# The synthetic data is made by these, so it's made again if they change
+DATA_SOURCES = ["make_synthetic_data.py", "build_logainm_db.py", "logainm_closure.py", "logainm_closure.sql"]
+
+# In each data dir, the hash of DATA_SOURCES it was made with
+DATA_SOURCES_HASH_FILENAME = "data-sources.sha1"
+
+def data_sources_hash():
+    sha1 = hashlib.sha1()
+    for filename in DATA_SOURCES:
+        with open(os.path.join(REPO_DIR, filename), 'rb') as fp:
+            sha1.update(fp.read())
+    return sha1.hexdigest()
+
+def scale_dir(data_dir, scale):
+    return os.path.join(data_dir, "scale-{:g}".format(scale))
+
+def ensure_data(data_dir, scale):
+    """The directory with the synthetic data for this scale, which is made if
+    it's not there, or was made by different code"""
+    directory = scale_dir(data_dir, scale)
+    hash_filename = os.path.join(directory, DATA_SOURCES_HASH_FILENAME)
+    sources_hash = data_sources_hash()
+    made_with = None
+    if os.path.exists(hash_filename):
+        with open(hash_filename) as fp:
+            made_with = fp.read().strip()
+    if made_with != sources_hash or not os.path.exists(os.path.join(directory, "boundaries.osm.xml")):
+        if os.path.exists(directory):
+            logger.info("The synthetic data in %s was made by a different version of %s, making it again", directory, ", ".join(DATA_SOURCES))
+        with printer("making synthetic data at scale {:g} in {}".format(scale, directory)):
+            subprocess.check_call([sys.executable, os.path.join(REPO_DIR, "make_synthetic_data.py"),
+                                   "--scale", str(scale), "--output-dir", directory])
+        with open(hash_filename, 'w') as fp:
+            fp.write(sources_hash + "\n")
+    return directory
+
+def git_commit():
+    """(commit, whether there are uncommitted changes)"""
+    try:
+        commit = subprocess.check_output(["git", "rev-parse", "--short", "HEAD"], cwd=REPO_DIR).strip()
+        dirty = subprocess.check_output(["git", "status", "--porcelain", "--untracked-files=no"], cwd=REPO_DIR).strip() != b""
+    except (OSError, subprocess.CalledProcessError):
+        return None, False
+    return commit.decode("ascii"), dirty
+
+
+def run_benchmark(name, command, directory):
+    """Run this benchmark, and return the result"""
+    profile_filename = os.path.join(directory, "{}.profile.json".format(name))
+    if os.path.exists(profile_filename):
+        os.remove(profile_filename)
+    if name in EMPTY_CACHE_FIRST:
+        shutil.rmtree(os.path.join(directory, CACHE_DIR), ignore_errors=True)
+    argv = [sys.executable, os.path.join(REPO_DIR, command[0])] + command[1:] + ["--profile", profile_filename]
+
+    with open(os.path.join(directory, "{}.log".format(name)), 'w') as log:
+        start = time.time()
+        returncode = subprocess.call(argv, cwd=directory, stdout=log, stderr=subprocess.STDOUT)
+        wall_seconds = time.time() - start
+
+    result = {'benchmark': name, 'argv': command, 'returncode': returncode, 'wall_seconds': wall_seconds}
+    if os.path.exists(profile_filename):
+        with open(profile_filename) as fp:
+            profile = json.load(fp)
+        result['peak_rss_kb'] = profile['peak_rss_kb']
+        result['counters'] = profile['counters']
+        result['stages'] = [{k: stage[k] for k in ('name', 'parent', 'objects', 'wall_seconds', 'cpu_seconds', 'peak_rss_kb')} for stage in profile['stages']]
+    return result
+
+def read_results(filename):
+    if not os.path.exists(filename):
+        return []
+    with open(filename) as fp:
+        return [json.loads(line) for line in fp if line.strip()]
+
+def previous_result(results, result, compare_commit=None):
+    """The latest result for the same benchmark & scale, from compare_commit,
+    or else from a different commit"""
+    for previous in reversed(results):
+        if (previous['benchmark'], previous['scale']) != (result['benchmark'], result['scale']):
+            continue
+        if compare_commit is not None:
+            if previous['commit'] is not None and previous['commit'].startswith(compare_commit):
+                return previous
+        elif previous['commit'] != result['commit']:
+            return previous
+    return None
+
+def show_results(new_results, old_results, compare_commit=None):
+    print("{:<24} {:>6} {:>10} {:>10} {:>8}  {}".format("benchmark", "scale", "seconds", "before", "change", "before commit"))
+    for result in new_results:
+        previous = previous_result(old_results, result, compare_commit)
+        line = "{:<24} {:>6g} {:>10.2f}".format(result['benchmark'], result['scale'], result['wall_seconds'])
+        if result['returncode'] != 0:
+            line += "  FAILED (exit code {})".format(result['returncode'])
+        elif previous is not None:
+            change = (result['wall_seconds'] - previous['wall_seconds']) * 100 / previous['wall_seconds']
+            line += " {:>10.2f} {:>+7.1f}%  {}".format(previous['wall_seconds'], change, previous['commit'])
+        print(line)
+
+        for stage in result.get('stages', []):
+            if stage['parent'] is None and stage['wall_seconds'] >= 0.1:
+                print("    {:<40} {:>10.2f}".format(stage['name'], stage['wall_seconds']))
+
+
+def main(args=None):
+    args = args or sys.argv[1:]
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--scale", type=float, action="append", help="Scale of the synthetic data, can be given more than once (default: 1)")
+    parser.add_argument("--data-dir", default=os.path.join(REPO_DIR, "benchmark-data"))
+    parser.add_argument("--results", default=os.path.join(REPO_DIR, "benchmark-results.jsonl"), help="File to add the results to")
+    parser.add_argument("--only", action="append", choices=[name for name, command in BENCHMARKS], help="Only run this benchmark (can be given more than once)")
+    parser.add_argument("--repeat", type=int, default=1, help="Run each benchmark this many times, and keep the fastest")
+    parser.add_argument("--compare", metavar="COMMIT", help="Compare against the results from this commit, rather than the last different commit")
+    parser.add_argument("-v", "--verbose", action="store_true")
+
+    args = parser.parse_args(args)
+    scales = args.scale or [1.0]
+
+    ch = logging.StreamHandler(sys.stdout)
+    if args.verbose:
+        ch.setLevel(logging.DEBUG)
+    else:
+        ch.setLevel(logging.INFO)
+    formatter = logging.Formatter('%(asctime)s\t%(levelname)s\tL%(lineno)s\t%(message)s')
+    ch.setFormatter(formatter)
+    logger.addHandler(ch)
+    logger.setLevel(logging.DEBUG)
+
+    commit, dirty = git_commit()
+    if dirty:
+        logger.warning("There are uncommitted changes, the results will be recorded against %s anyway", commit)
+
+    old_results = read_results(args.results)
+    new_results = []
+    for scale in scales:
+        directory = ensure_data(args.data_dir, scale)
+        for name, command in BENCHMARKS:
+            if args.only and name not in args.only:
+                continue
+            with printer("running {} at scale {:g}".format(name, scale)):
+                runs = [run_benchmark(name, command, directory) for i in range(args.repeat)]
+            result = min(runs, key=lambda r: (r['returncode'] != 0, r['wall_seconds']))
+            result.update(scale=scale, commit=commit, dirty=dirty, date=time.strftime("%Y-%m-%dT%H:%M:%S"), python=sys.version.split()[0])
+            if result['returncode'] != 0:
+                logger.error("%s failed with exit code %d, see %s.log in %s", name, result['returncode'], name, directory)
+            new_results.append(result)
+
+            with open(args.results, 'a') as fp:
+                fp.write(json.dumps(result, sort_keys=True) + "\n")
+
+    show_results(new_results, old_results, args.compare)
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
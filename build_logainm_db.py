@@ -0,0 +1,199 @@
+"""
+Make logainm.sqlite from the logainm CSVs (in logainm-csvs/).
+
+The ids are INTEGER columns, so they're compared as numbers whether they're
+looked up with a string or an int, and the indexes cover the columns the
+matching reads, so each lookup is one index search. Everything is inserted
+in one transaction, then the logainm_closure & name keys tables are made, and
+ANALYZE is run. It's written to a temporary file, and renamed at the end, so
+there's never a half made logainm.sqlite.
+
+    python build_logainm_db.py --csv-dir logainm-csvs --output logainm.sqlite
+
+The query plans of the hot queries are logged at the end, with a warning for
+any which would scan a whole table.
+"""
+import os
+import sys
+import csv
+import sqlite3
+import logging
+import argparse
+
+import instrumentation
+import logainm_closure
+import logainm_store
+import match
+
+logger = logging.getLogger(__name__)
+
+printer = instrumentation.make_printer(logger)
+
+# table -> CSV file it's made from
+TABLES = [
+    ('names', 'logainm_names.csv'),
+    ('geometric_contains', 'geometric_contains.csv'),
+    ('geometries', 'geometries.csv'),
+    ('categories', 'logainm_categories.csv'),
+]
+
+# Every other column is TEXT
+INTEGER_COLUMNS = {'logainm_id', 'outer_obj_id', 'inner_obj_id'}
+
+# The covering columns after the key are what the queries on that index read
+INDEXES = [
+    "create index names__logainm_id on names(logainm_id, logainm_category_code, name_en, name_ga)",
+    "create index names__category on names(logainm_category_code, name_en)",
+    "create index names__name_en on names(name_en)",
+    "create index geometric_contains__outer on geometric_contains(outer_obj_id, inner_obj_id)",
+    "create index geometric_contains__inner on geometric_contains(inner_obj_id, outer_obj_id)",
+    "create index categories__code on categories(logainm_category_code, name_en)",
+]
+
+NAME_CONTAINS_VIEW = "create view name_contains as select outer.logainm_id as outer_logainm_id, outer.logainm_category_code as outer_logainm_category_code, outer.name_en as outer_name_en, outer.name_ga as outer_name_ga, inner.logainm_id as inner_logainm_id, inner.logainm_category_code as inner_logainm_category_code, inner.name_en as inner_name_en, inner.name_ga as inner_name_ga from names as outer join geometric_contains as c on (outer.logainm_id = c.outer_obj_id) join names as inner on (inner.logainm_id = c.inner_obj_id);"
+
+# (what it's for, query, example parameters), for the query plan report
+HOT_QUERIES = [
+    ("match.py tags of a logainm object", match.LOGAINM_TAGS_SQL, [1]),
+    ("match.py objects in a parent with a name", match.FIND_LOGAINM_OBJS_SQL,
+        {'parent_logainm_code': 'PAR', 'obj_logainm_code': 'BF', 'parent_logainm_id': 1, 'name_key': 'x'}),
+    ("match.py fuzzy candidates in a parent", match.FUZZY_CANDIDATES_SQL,
+        {'parent_logainm_code': 'PAR', 'obj_logainm_code': 'BF', 'parent_logainm_id': 1}),
+    ("logainm_closure.descendants", logainm_closure.DESCENDANTS_IN_CATEGORY_SQL, [1, 'BF']),
+    ("logainm_closure.ancestors", logainm_closure.ANCESTORS_IN_CATEGORY_SQL, [1, 'CON']),
+    ("logainm_closure.is_inside", logainm_closure.IS_INSIDE_SQL, [1, 2]),
+    ("logainm_store children", logainm_store.related_sql('outer_obj_id', 'inner_obj_id', category=True).format(ids="?"), [1, 'BF']),
+    ("logainm_store parents", logainm_store.related_sql('inner_obj_id', 'outer_obj_id').format(ids="?"), [1]),
+]
+
+
+def column_type(column):
+    return "INTEGER" if column in INTEGER_COLUMNS else "TEXT"
+
+def convert(column, value):
+    """The value to store for this CSV value. Blank ids are NULL, other text
+    is kept as it is (like sqlite3's .import)"""
+    if isinstance(value, str):
+        value = value.decode("utf-8")
+    if column in INTEGER_COLUMNS:
+        if value == u"":
+            return None
+        try:
+            return int(value)
+        except ValueError:
+            return value
+    return value
+
+def create_table(conn, table, columns):
+    conn.execute("create table {} ({})".format(table, ", ".join("{} {}".format(column, column_type(column)) for column in columns)))
+
+def insert_rows(conn, table, columns, rows):
+    """Insert these rows (of CSV values) into the table. Returns how many
+    there were"""
+    sql = "insert into {} ({}) values ({})".format(table, ", ".join(columns), ", ".join("?" for column in columns))
+    count = [0]
+    def converted():
+        for row in rows:
+            count[0] += 1
+            yield [convert(column, value) for column, value in zip(columns, row)]
+    conn.executemany(sql, converted())
+    return count[0]
+
+def import_csv(conn, table, filename):
+    """Make the table from this CSV file, the header row is the column names"""
+    with open(filename) as fp:
+        reader = csv.reader(fp)
+        columns = next(reader)
+        create_table(conn, table, columns)
+        return insert_rows(conn, table, columns, reader)
+
+def finish_db(conn):
+    """Make the indexes, logainm_closure and name keys tables, and ANALYZE,
+    once the tables are filled in"""
+    with printer("creating indexes"):
+        for sql in INDEXES:
+            conn.execute(sql)
+        conn.execute(NAME_CONTAINS_VIEW)
+        conn.commit()
+    logainm_closure.build_closure(conn)
+    with printer("creating name keys"):
+        match.build_name_keys(conn)
+    with printer("analyzing"):
+        conn.execute("analyze")
+        conn.commit()
+
+def query_plans(conn):
+    """(description, query plan lines) of the HOT_QUERIES"""
+    plans = []
+    for description, sql, params in HOT_QUERIES:
+        plans.append((description, [row[-1] for row in conn.execute("explain query plan " + sql, params)]))
+    return plans
+
+def log_query_plans(conn):
+    for description, plan in query_plans(conn):
+        logger.info("Query plan for %s:", description)
+        for line in plan:
+            if line.startswith("SCAN"):
+                logger.warning("    %s", line)
+            else:
+                logger.info("    %s", line)
+
+def build(csv_dir, filename):
+    tmp_filename = filename + ".tmp"
+    if os.path.exists(tmp_filename):
+        os.remove(tmp_filename)
+    conn = sqlite3.connect(tmp_filename)
+    # It's a new file, which is only renamed into place at the end
+    conn.execute("pragma journal_mode = off")
+    conn.execute("pragma synchronous = off")
+
+    # The sqlite3 module commits before each create table, so the
+    # transaction is done by hand
+    conn.isolation_level = None
+    conn.execute("begin")
+    for table, csv_filename in TABLES:
+        with printer("importing {} into {}".format(csv_filename, table)) as stage:
+            stage.objects = import_csv(conn, table, os.path.join(csv_dir, csv_filename))
+        logger.info("%d rows in %s", stage.objects, table)
+    conn.execute("commit")
+    conn.isolation_level = ""
+
+    finish_db(conn)
+    log_query_plans(conn)
+    conn.close()
+    os.rename(tmp_filename, filename)
+
+
+def main(args=None):
+    args = args or sys.argv[1:]
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--csv-dir", default="logainm-csvs")
+    parser.add_argument("-o", "--output", default="logainm.sqlite")
+    parser.add_argument("-v", "--verbose", action="store_true")
+    parser.add_argument("--profile", metavar="FILE", help="Write the time, CPU, memory & counters of each stage to this JSON file")
+
+    args = parser.parse_args(args)
+
+    ch = logging.StreamHandler(sys.stdout)
+    if args.verbose:
+        ch.setLevel(logging.DEBUG)
+    else:
+        ch.setLevel(logging.INFO)
+    formatter = logging.Formatter('%(asctime)s\t%(levelname)s\tL%(lineno)s\t%(message)s')
+    ch.setFormatter(formatter)
+    for log in [logger, match.logger, logainm_closure.logger]:
+        log.addHandler(ch)
+        log.setLevel(logging.DEBUG)
+
+    # geometries.csv has big fields
+    csv.field_size_limit(sys.maxsize)
+
+    build(args.csv_dir, args.output)
+
+    if args.profile:
+        instrumentation.PROFILE.dump(args.profile)
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
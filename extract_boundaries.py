@@ -0,0 +1,268 @@
+"""
+Extract the boundary relations (those with an admin_level=* or boundary=*
+tag) from an OSM PBF file, and write them out as OSM XML.
+
+This replaces running osmosis twice over the PBF, merging, and running the
+result through xmlstarlet c14n. The PBF file is read once, and only the
+relation groups of each block are decoded, node and way groups are skipped
+over. Blocks are decoded in a pool of processes.
+"""
+import sys
+import time
+import struct
+import zlib
+import logging
+import argparse
+import multiprocessing
+
+import instrumentation
+
+logger = logging.getLogger(__name__)
+
+printer = instrumentation.make_printer(logger)
+
+MEMBER_TYPES = ['node', 'way', 'relation']
+
+# Relations with any of these tags are extracted
+FILTER_KEYS = {'admin_level', 'boundary'}
+
+
+def read_varint(buf, pos):
+    result = 0
+    shift = 0
+    while True:
+        b = buf[pos]
+        pos += 1
+        result |= (b & 0x7f) << shift
+        if not b & 0x80:
+            return result, pos
+        shift += 7
+
+def zigzag(n):
+    return (n >> 1) ^ -(n & 1)
+
+def signed64(n):
+    return n - (1 << 64) if n >= (1 << 63) else n
+
+def iter_fields(buf, start=0, end=None):
+    """Yield (field_number, value) for the protobuf message in buf[start:end].
+    Varints are returned as ints, everything else as a (start, end) span of
+    buf, so nothing is copied until it's needed."""
+    pos = start
+    end = len(buf) if end is None else end
+    while pos < end:
+        key, pos = read_varint(buf, pos)
+        field, wire_type = key >> 3, key & 7
+        if wire_type == 0:
+            value, pos = read_varint(buf, pos)
+        elif wire_type == 2:
+            length, pos = read_varint(buf, pos)
+            value = (pos, pos + length)
+            pos += length
+        elif wire_type == 1:
+            value = (pos, pos + 8)
+            pos += 8
+        elif wire_type == 5:
+            value = (pos, pos + 4)
+            pos += 4
+        else:
+            raise ValueError("Unknown protobuf wire type {}".format(wire_type))
+        yield field, value
+
+def packed_varints(buf, span):
+    pos, end = span
+    while pos < end:
+        value, pos = read_varint(buf, pos)
+        yield value
+
+
+def parse_info(buf, span, strings, date_granularity):
+    info = {}
+    for field, value in iter_fields(buf, *span):
+        if field == 1:
+            info['version'] = str(value)
+        elif field == 2:
+            seconds = signed64(value) * date_granularity // 1000
+            info['timestamp'] = time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime(seconds))
+        elif field == 3:
+            info['changeset'] = str(signed64(value))
+        elif field == 4:
+            info['uid'] = str(signed64(value))
+        elif field == 5:
+            info['user'] = strings[value]
+    return info
+
+def parse_relation(buf, span, strings, date_granularity):
+    """Returns (attributes, tags, members) for the Relation message in this span"""
+    osm_id = None
+    keys, vals, roles, memids, types = [], [], [], [], []
+    info = {}
+    for field, value in iter_fields(buf, *span):
+        if field == 1:
+            osm_id = signed64(value)
+        elif field == 2:
+            keys = list(packed_varints(buf, value))
+        elif field == 3:
+            vals = list(packed_varints(buf, value))
+        elif field == 4:
+            info = value
+        elif field == 8:
+            roles = list(packed_varints(buf, value))
+        elif field == 9:
+            memids = list(packed_varints(buf, value))
+        elif field == 10:
+            types = list(packed_varints(buf, value))
+
+    tags = [(strings[k], strings[v]) for k, v in zip(keys, vals)]
+    if not any(k in FILTER_KEYS for k, v in tags):
+        return None
+
+    attrs = parse_info(buf, info, strings, date_granularity) if info else {}
+    attrs['id'] = str(osm_id)
+
+    members = []
+    ref = 0
+    for role, memid, member_type in zip(roles, memids, types):
+        # member ids are delta coded
+        ref += zigzag(memid)
+        members.append((MEMBER_TYPES[member_type], str(ref), strings[role]))
+
+    return attrs, tags, members
+
+def boundary_relations_in_block(data):
+    """Yield (attributes, tags, members) for each boundary relation in this
+    PrimitiveBlock"""
+    buf = bytearray(data)
+    stringtable = None
+    groups = []
+    date_granularity = 1000
+    for field, value in iter_fields(buf):
+        if field == 1:
+            stringtable = value
+        elif field == 2:
+            groups.append(value)
+        elif field == 18:
+            date_granularity = value
+
+    strings = None
+    for start, end in groups:
+        if start == end:
+            continue
+        # A group only has one type of object, so the first field says what
+        # it is. Only relations (4) are needed.
+        key, _ = read_varint(buf, start)
+        if key >> 3 != 4:
+            continue
+
+        if strings is None:
+            strings = [bytes(buf[s:e]).decode("utf-8") for field, (s, e) in iter_fields(buf, *stringtable)]
+
+        for field, span in iter_fields(buf, start, end):
+            if field != 4:
+                continue
+            relation = parse_relation(buf, span, strings, date_granularity)
+            if relation is not None:
+                yield relation
+
+
+def escape_attr(value):
+    """Escape an attribute value the way XML c14n does"""
+    return (value.replace("&", "&amp;").replace("<", "&lt;").replace('"', "&quot;")
+            .replace("\t", "&#x9;").replace("\n", "&#xA;").replace("\r", "&#xD;"))
+
+def format_attrs(attrs):
+    return " ".join(u'{}="{}"'.format(k, escape_attr(v)) for k, v in sorted(attrs))
+
+def relation_xml(attrs, tags, members):
+    lines = [u"  <relation {}>".format(format_attrs(attrs.items()))]
+    for member_type, ref, role in members:
+        lines.append(u"    <member {}></member>".format(format_attrs([('type', member_type), ('ref', ref), ('role', role)])))
+    for k, v in tags:
+        lines.append(u"    <tag {}></tag>".format(format_attrs([('k', k), ('v', v)])))
+    lines.append(u"  </relation>\n")
+    return u"\n".join(lines)
+
+
+def read_blob(filename, offset, size):
+    with open(filename, 'rb') as fp:
+        fp.seek(offset)
+        buf = bytearray(fp.read(size))
+
+    for field, value in iter_fields(buf):
+        if field == 1:
+            return bytes(buf[value[0]:value[1]])
+        elif field == 3:
+            return zlib.decompress(bytes(buf[value[0]:value[1]]))
+    raise ValueError("Unsupported PBF blob compression at offset {}".format(offset))
+
+def blob_boundaries_xml(blob_position):
+    """Returns the OSM XML (as utf-8) for the boundary relations in this blob"""
+    filename, offset, size = blob_position
+    data = read_blob(filename, offset, size)
+    return u"".join(relation_xml(*r) for r in boundary_relations_in_block(data)).encode("utf-8")
+
+def data_blob_positions(filename):
+    """Yield (filename, offset, size) for each OSMData blob in the PBF file.
+    Only the blob headers are read here"""
+    with open(filename, 'rb') as fp:
+        while True:
+            header_size = fp.read(4)
+            if len(header_size) < 4:
+                break
+            header_size = struct.unpack('>I', header_size)[0]
+            header = bytearray(fp.read(header_size))
+
+            blob_type = None
+            datasize = 0
+            for field, value in iter_fields(header):
+                if field == 1:
+                    blob_type = bytes(header[value[0]:value[1]]).decode("utf-8")
+                elif field == 3:
+                    datasize = value
+
+            offset = fp.tell()
+            fp.seek(datasize, 1)
+            if blob_type == 'OSMData':
+                yield filename, offset, datasize
+
+
+def extract_boundaries(input_filename, output_filename, jobs=None):
+    pool = multiprocessing.Pool(jobs)
+    try:
+        with open(output_filename, 'wb') as output:
+            output.write(b'<osm generator="logainm-osm-import extract_boundaries.py" version="0.6">\n')
+            for xml in pool.imap(blob_boundaries_xml, data_blob_positions(input_filename)):
+                output.write(xml)
+            output.write(b'</osm>')
+    finally:
+        pool.close()
+        pool.join()
+
+
+def main(args=None):
+    args = args or sys.argv[1:]
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-i", "--input", required=True, help="OSM PBF file")
+    parser.add_argument("-o", "--output", required=True, help="OSM XML file to write")
+    parser.add_argument("-j", "--jobs", type=int, help="Number of processes to decode with (default: number of CPUs)")
+    parser.add_argument("-v", "--verbose", action="store_true")
+
+    args = parser.parse_args(args)
+
+    ch = logging.StreamHandler(sys.stdout)
+    if args.verbose:
+        ch.setLevel(logging.DEBUG)
+    else:
+        ch.setLevel(logging.INFO)
+    formatter = logging.Formatter('%(asctime)s\t%(levelname)s\tL%(lineno)s\t%(message)s')
+    ch.setFormatter(formatter)
+    logger.addHandler(ch)
+    logger.setLevel(logging.DEBUG)
+
+    with printer("extracting boundaries from {}".format(args.input)):
+        extract_boundaries(args.input, args.output, jobs=args.jobs)
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -5,27 +5,57 @@ objects which have this bd data
 """
 import sys
 import logging
-from contextlib import contextmanager
 import csv
-import sqlite3
 import xml.etree.ElementTree as ET
 import argparse
 from collections import defaultdict
 import re
 
+import instrumentation
+import osm_output
+import add_all_logainm_tags
+import logainm_store
+
 logging.getLogger().setLevel(logging.DEBUG)
 logger = logging.getLogger(__name__)
 
-@contextmanager
-def printer(msg):
-    msg = msg.strip()
-    logger.info("Started "+msg)
-    yield
-    logger.info("Finished "+msg)
+printer = instrumentation.make_printer(logger)
+
+NAME_GA_KEYS = ['name:ga', 'official_name:ga']
+
+def has_bad_name(tags):
+    """True iff an Irish name of the object with these Tags might be broken,
+    and it can be looked up in logainm"""
+    return 'logainm:ref' in tags and any('??' in tags.get(name_ga, "") for name_ga in NAME_GA_KEYS)
+
+def fix_bad_names(osm_id, tags, logainm_names):
+    """Replace the broken Irish names of the object with these Tags with the
+    correct name in logainm_names (from LogainmStore.get_names). Returns
+    (key, bad name, correct name) for each name which was changed."""
+    fixes = []
+    for name_ga in NAME_GA_KEYS:
+        if '??' in tags.get(name_ga, "") and 'logainm:ref' in tags:
+            bad_name = tags.get(name_ga)
+            logainmref = add_all_logainm_tags.logainm_ref_key(tags.get('logainm:ref'))
+            if logainmref is None:
+                # can't int. probably semi-colon multiple
+                continue
+
+            correct_name = logainm_names.get(logainmref, {}).get('name_ga')
+            if correct_name is None:
+                logger.debug("No name_ga for logainm_id %s", logainmref)
+                continue
 
-def get_existing_osm_tags(xml_el):
-    """Given a XML element for an object, return (as dict) the current OSM tags"""
-    return {el.get('k'): el.get('v') for el in xml_el.findall("tag")}
+            if bad_name == correct_name:
+                continue
+
+            logger.info("Have encoding problem for osmid %(osmid)s, Current %(k)s=%(v)s logainm:ref=%(logainmref)s correct name = %(correct)s",
+                         {'osmid': osm_id, 'k': name_ga, 'v': bad_name, 'logainmref': tags.get('logainm:ref'), 'correct': correct_name})
+
+            tags.set(name_ga, correct_name)
+            fixes.append((name_ga, bad_name, correct_name))
+
+    return fixes
 
 
 def main():
@@ -33,6 +63,8 @@ def main():
     parser.add_argument("-i", "--input")
     parser.add_argument("-o", "--output")
     parser.add_argument("-n", "--dry-run", action="store_true")
+    osm_output.add_output_arguments(parser)
+    parser.add_argument("--profile", metavar="FILE", help="Write the time, CPU, memory & counters of each stage to this JSON file")
 
     args = parser.parse_args()
 
@@ -40,59 +72,43 @@ def main():
     ch.setLevel(logging.DEBUG)
     formatter = logging.Formatter('%(asctime)s\t%(levelname)s\tL%(lineno)s\t%(message)s')
     ch.setFormatter(formatter)
-    logger.addHandler(ch)
+    for log in [logger, osm_output.logger, osm_output.logainm_closure.logger]:
+        log.addHandler(ch)
 
-    conn = sqlite3.connect("logainm.sqlite")
-    cursor = conn.cursor()
+    store = logainm_store.LogainmStore.open()
 
     # read in OSM XML
-    with printer("reading in OSM XML"):
+    with printer("reading in OSM XML") as stage:
         tree = ET.parse(args.input)
         root = tree.getroot()
-
-    # add new tags to OSM XML
-    with printer("correcting names"):
-        for rel in root.findall("relation"):
-            osm_id = rel.get("id", None)
-            tags = get_existing_osm_tags(rel)
-            has_been_changed = False
-            
-            for name_ga in ['name:ga', 'official_name:ga']:
-                if '??' in tags.get(name_ga, "") and 'logainm:ref' in tags:
-                    bad_name = tags[name_ga]
-                    try:
-                        logainmref = int(tags['logainm:ref'])
-                    except:
-                        # can't int. probably semi-colon multiple
-                        continue
-
-                    cursor.execute("select name_ga from names where logainm_id = ?", [logainmref])
-                    correct_name = cursor.fetchone()[0]
-                    if correct_name is None:
-                        logger.debug("No name_ga for logainm_id %s", logainmref)
-                        continue
-
-                    if bad_name == correct_name:
-                        continue
-
-                    logger.info("Have encoding problem for osmid %(osmid)s, Current %(k)s=%(v)s logainm:ref=%(logainmref)s correct name = %(correct)s",
-                                 {'osmid': osm_id, 'k': name_ga, 'v': bad_name, 'logainmref': tags['logainm:ref'], 'correct': correct_name})
-
-                    # change the tag
-                    rel.set("action", "modify")
-                    has_been_changed = True
-
-                    for tag in rel.findall("tag"):
-                        if tag.attrib["k"] == name_ga:
-                            tag.set("v", correct_name)
-
-            if not has_been_changed:
-                root.remove(rel)
-
-
-    # write out OSM XML
-    with printer("writing out OSM XML"):
-        tree.write(args.output, encoding='utf-8', xml_declaration=True) 
+        stage.objects = len(root)
+
+    output = osm_output.output_from_args(args, store.cursor())
+    output.root_attrib = dict(root.attrib)
+
+    with printer("looking up logainm data") as stage:
+        relations = [(rel, add_all_logainm_tags.Tags(rel)) for rel in root.findall("relation")]
+        logainm_names = store.get_names(tags.get('logainm:ref') for rel, tags in relations if has_bad_name(tags))
+        stage.objects = len(logainm_names)
+
+    # fix the names, and write out the changed objects
+    with printer("correcting names and writing out OSM XML") as stage:
+        stage.objects = len(relations)
+        for el in root:
+            if el.tag != 'relation':
+                output.add(el)
+        for rel, tags in relations:
+            if not has_bad_name(tags):
+                continue
+            if fix_bad_names(rel.get("id", None), tags, logainm_names):
+                # change the tag
+                rel.set("action", "modify")
+                output.add(rel, group=output.county_of(rel, tags.get('logainm:ref')))
+
+        output.close()
+
+    if args.profile:
+        instrumentation.PROFILE.dump(args.profile)
 
 if __name__ == '__main__':
     main()
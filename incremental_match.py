@@ -0,0 +1,304 @@
+"""
+Keep the match up semi-continuously up to date from OSM replication diffs.
+
+The OSM boundary relations, and the match results, are kept in a state
+database. Each run applies the osmChange (.osc) files from a local
+replication directory (as made by osmosis --replicate-apidb or downloaded
+from a replication server), and only rematches the relations that the diffs
+touched, and their children. The newly matched relations are written out as
+OSM XML for uploading with JOSM.
+
+Each run is one transaction on the state: the diffs, the new sequence number
+and the new matches are only committed once the output has been written, so
+if a run fails, the next one does it all again.
+
+First load the full boundaries file (and the replication sequence number it
+is up to date with):
+
+    python incremental_match.py --state match-state.sqlite --init boundaries.osm.xml --sequence 1234 -o new-boundaries.osm.xml
+
+and afterwards:
+
+    python incremental_match.py --state match-state.sqlite --replication-dir replication/ -o new-boundaries-{sequence}.osm.xml
+
+{sequence} in the output filename is replaced with the replication sequence
+number the state is then up to, so the output of one run isn't overwritten
+by the next (which --loop needs).
+"""
+import sys
+import os
+import gzip
+import time
+import logging
+import sqlite3
+import argparse
+import xml.etree.ElementTree as ET
+
+import match
+import instrumentation
+import osm_output
+
+logger = logging.getLogger(__name__)
+
+printer = instrumentation.make_printer(logger)
+
+# (key in logainm_data, matchup function), in the order they need to be done
+LEVELS = [
+    ('baronies', match.baronies_matchup),
+    ('civil_parishes', match.civil_parish_matchup),
+    ('townlands', match.townlands_matchup),
+]
+
+
+def is_boundary(tags):
+    """Same filter as used to make boundaries.osm.xml"""
+    return 'admin_level' in tags or 'boundary' in tags
+
+
+def open_state(filename):
+    conn = sqlite3.connect(filename)
+    conn.execute("create table if not exists relations (osm_id text primary key, logainm_ref text, xml text not null)")
+    conn.execute("create table if not exists matches (osm_id text primary key, logainm_id, name_en, name_ga)")
+    conn.execute("create table if not exists state (key text primary key, value)")
+    return conn
+
+def get_sequence(conn):
+    row = conn.execute("select value from state where key = 'sequence'").fetchone()
+    return None if row is None else int(row[0])
+
+def set_sequence(conn, sequence):
+    conn.execute("insert or replace into state (key, value) values ('sequence', ?)", [sequence])
+
+
+def store_relation(conn, rel):
+    """Save (or delete) this relation XML element in the state"""
+    osm_id = rel.get("id")
+    tags = match.get_existing_osm_tags(rel)
+    if not is_boundary(tags):
+        delete_relation(conn, osm_id)
+        return
+
+    rel.attrib.pop("action", None)
+    rel.tail = None
+    conn.execute("insert or replace into relations (osm_id, logainm_ref, xml) values (?, ?, ?)",
+                 [osm_id, tags.get('logainm:ref'), ET.tostring(rel, encoding='utf-8').decode("utf-8")])
+
+def delete_relation(conn, osm_id):
+    conn.execute("delete from relations where osm_id = ?", [osm_id])
+    conn.execute("delete from matches where osm_id = ?", [osm_id])
+
+
+def load_osm_xml(conn, filename):
+    """Replace all the relations in the state with those in this OSM XML
+    file. Returns the ids of all the relations"""
+    conn.execute("delete from relations")
+    osm_ids = set()
+    for event, el in ET.iterparse(filename):
+        if el.tag == 'relation':
+            store_relation(conn, el)
+            osm_ids.add(el.get("id"))
+            el.clear()
+    return osm_ids
+
+def apply_osc(conn, fp):
+    """Apply the relation changes in this osmChange file to the state. Returns
+    the ids of the relations which were changed"""
+    touched = set()
+    action = None
+    for event, el in ET.iterparse(fp, events=("start", "end")):
+        if event == 'start':
+            if el.tag in ('create', 'modify', 'delete'):
+                action = el.tag
+            continue
+
+        if el.tag == 'relation':
+            touched.add(el.get("id"))
+            if action == 'delete':
+                delete_relation(conn, el.get("id"))
+            else:
+                store_relation(conn, el)
+        if el.tag in ('node', 'way', 'relation'):
+            el.clear()
+    return touched
+
+
+def replication_path(replication_dir, sequence):
+    """Path to the diff for this sequence number, in the usual
+    AAA/BBB/CCC.osc.gz replication layout"""
+    return os.path.join(replication_dir, "{:03d}".format(sequence // 1000000),
+                        "{:03d}".format((sequence // 1000) % 1000), "{:03d}.osc.gz".format(sequence % 1000))
+
+def read_replication_state(replication_dir):
+    with open(os.path.join(replication_dir, "state.txt")) as fp:
+        for line in fp:
+            if line.startswith("sequenceNumber="):
+                return int(line.strip().split("=", 1)[1])
+    raise ValueError("No sequenceNumber in state.txt in {}".format(replication_dir))
+
+def apply_replication_diffs(conn, replication_dir):
+    """Apply all the diffs since the last run, without committing. Returns
+    the ids of the relations which were changed"""
+    touched = set()
+    current = get_sequence(conn)
+    if current is None:
+        raise ValueError("No replication sequence number in the state, use --init first")
+    latest = read_replication_state(replication_dir)
+
+    for sequence in range(current + 1, latest + 1):
+        path = replication_path(replication_dir, sequence)
+        with printer("applying diff {}".format(path)):
+            with gzip.open(path) as fp:
+                touched.update(apply_osc(conn, fp))
+        set_sequence(conn, sequence)
+
+    return touched
+
+
+def osm_ids_to_rematch(logainm_data, touched):
+    """The relations which were changed, and everything that's inside them (in
+    townlands.ie format, i.e. "-" + relation id)"""
+    touched = set("-"+osm_id for osm_id in touched)
+    results = set(touched)
+    for t in logainm_data['townlands']:
+        chain = [t['CO_OSM_ID'], t['BAR_OSM_ID'], t['CP_OSM_ID'], t['OSM_ID']]
+        for i, osm_id in enumerate(chain):
+            if osm_id in touched:
+                results.update(x for x in chain[i+1:] if x != '')
+                break
+    return results
+
+def restrict_to(logainm_data, osm_ids):
+    """Copy of logainm_data, where the levels only have these objects"""
+    restricted = dict(logainm_data)
+    for key, matchup in LEVELS:
+        restricted[key] = [x for x in logainm_data[key] if x['OSM_ID'] in osm_ids]
+    return restricted
+
+
+def stored_matches(conn):
+    return {('relation', osm_id): {'logainm_id': logainm_id, 'name_en': name_en, 'name_ga': name_ga}
+            for osm_id, logainm_id, name_en, name_ga in conn.execute("select osm_id, logainm_id, name_en, name_ga from matches")}
+
+def rematch(conn, matcher, osm_ids, jobs=1):
+    """Rematch these objects. Saves the results (without committing), and
+    returns those for these objects which aren't duplicates"""
+    relations = ((osm_id, {'logainm:ref': logainm_ref}) for osm_id, logainm_ref in conn.execute("select osm_id, logainm_ref from relations where logainm_ref is not null"))
+    with printer("reading logainm data"):
+        logainm_data = match.read_logainm_data(osm_relations=relations)
+
+    to_rematch = osm_ids_to_rematch(logainm_data, osm_ids)
+    # townlands.ie might not know yet that some have been deleted
+    in_osm = set("-"+osm_id for (osm_id, ) in conn.execute("select osm_id from relations"))
+    to_rematch &= in_osm
+    logger.info("Rematching %d objects for %d changed relations", len(to_rematch), len(osm_ids))
+    restricted = restrict_to(logainm_data, to_rematch)
+
+    logainm_candidates = stored_matches(conn)
+    for osm_id in to_rematch:
+        logainm_candidates.pop(('relation', osm_id[1:]), None)
+
+    new_keys = set()
+    for key, matchup in LEVELS:
+        results = matchup(restricted, matcher, logainm_candidates, jobs=jobs)
+        new_keys.update(results.keys())
+        logainm_candidates.update(results)
+
+    conn.executemany("delete from matches where osm_id = ?", ([osm_id[1:]] for osm_id in to_rematch))
+    conn.executemany("insert or replace into matches (osm_id, logainm_id, name_en, name_ga) values (?, ?, ?, ?)",
+                     ([key[1], logainm_candidates[key]['logainm_id'], logainm_candidates[key]['name_en'], logainm_candidates[key]['name_ga']] for key in new_keys))
+
+    logainm_candidates = match.remove_and_warn_dupes(logainm_candidates)
+    return {key: tags for key, tags in logainm_candidates.items() if key in new_keys}
+
+def write_osm_xml(conn, logainm_candidates, output):
+    """Write the relations in logainm_candidates, with the new tags, to output"""
+    for key in sorted(logainm_candidates, key=lambda k: int(k[1])):
+        row = conn.execute("select xml from relations where osm_id = ?", [key[1]]).fetchone()
+        if row is None:
+            continue
+        rel = ET.fromstring(row[0].encode("utf-8"))
+        match.add_logainm_tags_to_relation(rel, logainm_candidates[key])
+        output.add(rel, group=output.county_of(rel))
+    output.close()
+
+
+def output_args(args, sequence):
+    """Copy of args, with {sequence} in the output filename replaced"""
+    args = argparse.Namespace(**vars(args))
+    args.output = args.output.format(sequence=sequence)
+    return args
+
+def run_once(conn, matcher, args):
+    """Apply the diffs (or load --init), rematch, and write out the new
+    matches. Nothing is committed until the output is written, so if this
+    fails, the next run starts from the same sequence number again."""
+    try:
+        if args.init:
+            with printer("loading {} into state".format(args.init)):
+                touched = load_osm_xml(conn, args.init)
+                set_sequence(conn, args.sequence)
+        else:
+            touched = apply_replication_diffs(conn, args.replication_dir)
+
+        if len(touched) == 0:
+            logger.info("No relations changed")
+        else:
+            logainm_candidates = rematch(conn, matcher, touched, jobs=args.jobs)
+            logger.info("%d new matches", len(logainm_candidates))
+            if args.output and len(logainm_candidates) > 0:
+                with printer("writing out OSM XML"):
+                    output = osm_output.output_from_args(output_args(args, get_sequence(conn)), match.connect_logainm_db(read_only=True).cursor())
+                    write_osm_xml(conn, logainm_candidates, output)
+
+        conn.commit()
+    except:
+        conn.rollback()
+        raise
+
+
+def main(args=None):
+    args = args or sys.argv[1:]
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--state", default="match-state.sqlite", help="State database")
+    parser.add_argument("--init", metavar="OSM_XML", help="Load all the relations from this file, and match them all")
+    parser.add_argument("--sequence", type=int, help="With --init, the replication sequence number the OSM XML file is up to date with")
+    parser.add_argument("--replication-dir", help="Local replication directory to read diffs from")
+    parser.add_argument("-o", "--output", help="Write newly matched relations to this OSM XML (or .osc) file. {sequence} is replaced with the replication sequence number")
+    osm_output.add_output_arguments(parser)
+    parser.add_argument("--engine", choices=sorted(match.MATCHERS.keys()), default="memory")
+    parser.add_argument("-j", "--jobs", type=int, default=1)
+    parser.add_argument("--loop", type=int, metavar="SECONDS", help="Keep running, checking for new diffs this often")
+    parser.add_argument("-v", "--verbose", action="store_true")
+
+    args = parser.parse_args(args)
+    if args.init and args.sequence is None:
+        parser.error("--init needs --sequence")
+    if not args.init and not args.replication_dir:
+        parser.error("Need one of --init or --replication-dir")
+    if args.loop and args.output and "{sequence}" not in args.output:
+        parser.error("With --loop, the output filename needs {sequence} in it, so each run's output isn't overwritten by the next")
+
+    ch = logging.StreamHandler(sys.stdout)
+    if args.verbose:
+        ch.setLevel(logging.DEBUG)
+    else:
+        ch.setLevel(logging.INFO)
+    formatter = logging.Formatter('%(asctime)s\t%(levelname)s\tL%(lineno)s\t%(message)s')
+    ch.setFormatter(formatter)
+    for log in [logger, match.logger, osm_output.logger, match.logainm_closure.logger]:
+        log.addHandler(ch)
+        log.setLevel(logging.DEBUG)
+
+    conn = open_state(args.state)
+    matcher = match.MATCHERS[args.engine](match.connect_logainm_db(read_only=True).cursor())
+
+    run_once(conn, matcher, args)
+    while args.loop and args.replication_dir:
+        args.init = None
+        time.sleep(args.loop)
+        run_once(conn, matcher, args)
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -0,0 +1,134 @@
+"""
+Measure where the scripts spend their time & memory.
+
+Each stage of a run (reading the CSVs, parsing the XML, matching a level, ...)
+records its wall time, CPU time, peak RSS and how many objects it dealt with.
+Counters (e.g. SQL queries, cache hits) can be incremented from anywhere. All
+of it can be dumped to a JSON file with the scripts' --profile option.
+
+    printer = instrumentation.make_printer(logger)
+
+    with printer("reading in OSM XML") as stage:
+        tree = ET.parse(filename)
+        stage.objects = len(tree.getroot())
+
+    instrumentation.count('sql_queries')
+"""
+import sys
+import os
+import time
+import json
+import resource
+from contextlib import contextmanager
+from collections import defaultdict
+
+
+def cpu_seconds(who=resource.RUSAGE_SELF):
+    usage = resource.getrusage(who)
+    return usage.ru_utime + usage.ru_stime
+
+def peak_rss_kb():
+    # ru_maxrss is in kB on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+class Stage(object):
+    """One stage of a run. Set objects to the number of things it dealt
+    with."""
+
+    def __init__(self, name, parent, counters):
+        self.name = name
+        self.parent = parent
+        self.objects = None
+        self.start_counters = dict(counters)
+        self.start_wall = time.time()
+        self.start_cpu = cpu_seconds()
+        self.start_children_cpu = cpu_seconds(resource.RUSAGE_CHILDREN)
+        self.start_peak_rss_kb = peak_rss_kb()
+
+    def finish(self, counters):
+        end_peak_rss_kb = peak_rss_kb()
+        return {
+            'name': self.name,
+            'parent': self.parent,
+            'objects': self.objects,
+            'wall_seconds': time.time() - self.start_wall,
+            'cpu_seconds': cpu_seconds() - self.start_cpu,
+            # e.g. worker processes
+            'children_cpu_seconds': cpu_seconds(resource.RUSAGE_CHILDREN) - self.start_children_cpu,
+            'peak_rss_kb': end_peak_rss_kb,
+            'peak_rss_growth_kb': end_peak_rss_kb - self.start_peak_rss_kb,
+            'counters': {k: v - self.start_counters.get(k, 0) for k, v in counters.items() if v != self.start_counters.get(k, 0)},
+        }
+
+
+class Profile(object):
+    """The stages & counters of this run"""
+
+    def __init__(self):
+        self.start_wall = time.time()
+        self.stages = []
+        self.running = []
+        self.counters = defaultdict(int)
+
+    def count(self, counter, n=1):
+        self.counters[counter] += n
+
+    def take_counters(self):
+        """Return the counters, and start them again from 0. For sending
+        back the counts from a worker process"""
+        counters = dict(self.counters)
+        self.counters = defaultdict(int)
+        return counters
+
+    def add_counters(self, counters):
+        for counter, n in counters.items():
+            self.counters[counter] += n
+
+    @contextmanager
+    def stage(self, name):
+        stage = Stage(name, self.running[-1].name if self.running else None, self.counters)
+        self.running.append(stage)
+        try:
+            yield stage
+        finally:
+            self.running.pop()
+            self.stages.append(stage.finish(self.counters))
+
+    def report(self):
+        return {
+            'script': os.path.basename(sys.argv[0]),
+            'argv': sys.argv[1:],
+            'wall_seconds': time.time() - self.start_wall,
+            'cpu_seconds': cpu_seconds(),
+            'children_cpu_seconds': cpu_seconds(resource.RUSAGE_CHILDREN),
+            'peak_rss_kb': peak_rss_kb(),
+            'counters': dict(self.counters),
+            'stages': self.stages,
+        }
+
+    def dump(self, filename):
+        with open(filename, 'w') as fp:
+            json.dump(self.report(), fp, indent=2, sort_keys=True)
+
+
+PROFILE = Profile()
+
+def count(counter, n=1):
+    PROFILE.count(counter, n)
+
+def stage(name):
+    """Measure this stage, without logging anything"""
+    return PROFILE.stage(name)
+
+def make_printer(log):
+    """Returns a printer(msg) context manager, which logs to log when the
+    stage starts & finishes, and measures it"""
+    @contextmanager
+    def printer(msg):
+        msg = msg.strip()
+        log.info("Started "+msg)
+        with PROFILE.stage(msg) as stage:
+            yield stage
+        log.info("Finished "+msg)
+    return printer
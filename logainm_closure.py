@@ -0,0 +1,94 @@
+"""
+The logainm_closure table: every (ancestor, descendant) pair of the
+geometric_contains hierarchy, with how many levels apart they are, and their
+categories. It's made by build_logainm_db.py, from logainm_closure.sql, and
+never while matching. For a database made before that, rebuild it, or add it
+with:
+
+    python logainm_closure.py logainm.sqlite
+"""
+import os
+import sys
+import logging
+import sqlite3
+import argparse
+
+import instrumentation
+import logainm_store
+
+logger = logging.getLogger(__name__)
+
+CLOSURE_TABLE = "logainm_closure"
+
+CLOSURE_SQL = os.path.join(os.path.dirname(os.path.abspath(__file__)), "logainm_closure.sql")
+
+def id_type(conn, table="geometric_contains", column="outer_obj_id"):
+    """INTEGER if this id column is INTEGER (build_logainm_db.py),
+    otherwise TEXT (sqlite3's .import)"""
+    columns = {row[1]: row[2] for row in conn.execute("pragma table_info({})".format(table))}
+    return "INTEGER" if columns.get(column, '').upper() == "INTEGER" else "TEXT"
+
+def build_closure(conn):
+    """(Re)create the CLOSURE_TABLE from geometric_contains"""
+    with instrumentation.stage("building " + CLOSURE_TABLE):
+        with open(CLOSURE_SQL) as fp:
+            conn.executescript(fp.read().format(id_type=id_type(conn)))
+        conn.commit()
+
+def require_closure(conn):
+    """Raise a ValueError if the CLOSURE_TABLE isn't in the logainm database"""
+    logainm_store.require_table(conn, CLOSURE_TABLE)
+
+DESCENDANTS_SQL = "select descendant_id, depth from logainm_closure where ancestor_id = ?"
+DESCENDANTS_IN_CATEGORY_SQL = DESCENDANTS_SQL + " and descendant_category_code = ?"
+ANCESTORS_SQL = "select ancestor_id, depth from logainm_closure where descendant_id = ?"
+ANCESTORS_IN_CATEGORY_SQL = ANCESTORS_SQL + " and ancestor_category_code = ?"
+IS_INSIDE_SQL = "select count(*) from logainm_closure where descendant_id = ? and ancestor_id = ?"
+
+def descendants(cursor, ancestor_id, category_code=None):
+    """(logainm_id, depth) of everything in this logainm object (of this
+    category, if given)"""
+    instrumentation.count('sql_queries')
+    if category_code is None:
+        cursor.execute(DESCENDANTS_SQL, [ancestor_id])
+    else:
+        cursor.execute(DESCENDANTS_IN_CATEGORY_SQL, [ancestor_id, category_code])
+    return cursor.fetchall()
+
+def ancestors(cursor, descendant_id, category_code=None):
+    """(logainm_id, depth) of everything this logainm object is in (of this
+    category, if given)"""
+    instrumentation.count('sql_queries')
+    if category_code is None:
+        cursor.execute(ANCESTORS_SQL, [descendant_id])
+    else:
+        cursor.execute(ANCESTORS_IN_CATEGORY_SQL, [descendant_id, category_code])
+    return cursor.fetchall()
+
+def is_inside(cursor, inner_id, outer_id):
+    """True iff inner_id is anywhere inside outer_id"""
+    instrumentation.count('sql_queries')
+    cursor.execute(IS_INSIDE_SQL, [inner_id, outer_id])
+    return cursor.fetchone()[0] > 0
+
+
+def main(args=None):
+    args = args or sys.argv[1:]
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("database", nargs="?", default="logainm.sqlite")
+    args = parser.parse_args(args)
+
+    ch = logging.StreamHandler(sys.stdout)
+    ch.setFormatter(logging.Formatter('%(asctime)s\t%(levelname)s\tL%(lineno)s\t%(message)s'))
+    logger.addHandler(ch)
+    logger.setLevel(logging.INFO)
+
+    conn = sqlite3.connect(args.database)
+    logger.info("Building %s in %s", CLOSURE_TABLE, args.database)
+    build_closure(conn)
+    logger.info("%s has %d rows", CLOSURE_TABLE, conn.execute("select count(*) from {}".format(CLOSURE_TABLE)).fetchone()[0])
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
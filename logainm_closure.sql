@@ -0,0 +1,26 @@
+-- Every (ancestor, descendant) pair in the geometric_contains hierarchy,
+-- however many levels apart, so "is this townland anywhere in this county?"
+-- or "all the townlands in this county" is one indexed lookup. depth is the
+-- longest chain of geometric_contains rows between them (1 for a direct
+-- child), so it's the same whether geometric_contains has only the direct
+-- parents, or every containing object.
+--
+-- Run by logainm_closure.py, which fills in {id_type} with the type of
+-- geometric_contains' ids (INTEGER, or TEXT for a database made with
+-- sqlite3's .import), so the ids compare the same way in both tables.
+drop table if exists logainm_closure;
+create table logainm_closure (ancestor_id {id_type}, descendant_id {id_type}, depth INTEGER, ancestor_category_code TEXT, descendant_category_code TEXT);
+insert into logainm_closure (ancestor_id, descendant_id, depth, ancestor_category_code, descendant_category_code)
+    with recursive paths (ancestor_id, descendant_id, depth) as (
+        select outer_obj_id, inner_obj_id, 1 from geometric_contains where outer_obj_id != inner_obj_id
+        union
+        -- the depth limit stops it going round forever if there's a loop
+        select p.ancestor_id, c.inner_obj_id, p.depth + 1 from paths as p join geometric_contains as c on (c.outer_obj_id = p.descendant_id) where p.depth < 10 and c.inner_obj_id != p.ancestor_id
+    )
+    select p.ancestor_id, p.descendant_id, max(p.depth), ancestor.logainm_category_code, descendant.logainm_category_code
+    from paths as p left join names as ancestor on (ancestor.logainm_id = p.ancestor_id) left join names as descendant on (descendant.logainm_id = p.descendant_id)
+    group by p.ancestor_id, p.descendant_id;
+create unique index logainm_closure__descendant_ancestor on logainm_closure(descendant_id, ancestor_id);
+-- These cover everything the lookups read, so they don't need the table
+create index logainm_closure__ancestor_category on logainm_closure(ancestor_id, descendant_category_code, ancestor_category_code, descendant_id, depth);
+create index logainm_closure__descendant_category on logainm_closure(descendant_id, ancestor_category_code, ancestor_id, depth);
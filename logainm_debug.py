@@ -1,59 +1,238 @@
+"""
+Show a logainm object, and what it's in & what's in it.
+
+    python logainm_debug.py 1234 5678
+
+To look up lots of ids (e.g. from the errors of a match run) without loading
+everything each time, start a server, which keeps it all in memory:
+
+    python logainm_debug.py --serve &
+    python logainm_debug.py --server http://localhost:8765 1234 5678
+    python logainm_debug.py --server http://localhost:8765 --osm - < osm-ids.txt
+
+The server takes a POST of {"logainm_ids": [...], "osm_ids": [...]} to
+/lookup and returns {"results": [{"type": ..., "id": ..., "text": ...}, ...]}
+"""
+import os
 import sys
+import json
 import logging
-import csv
-import sqlite3
 import argparse
+import urllib2
+import BaseHTTPServer
+from collections import defaultdict
+
+import instrumentation
+import logainm_store
 
 reload(sys)
 sys.setdefaultencoding('utf-8')
 
-
-def main():
+logger = logging.getLogger(__name__)
+
+printer = instrumentation.make_printer(logger)
+
+DEFAULT_PORT = 8765
+
+
+def describe(logainm_id, obj, children, parents):
+    """Text about this logainm object. obj is (name_en, name_ga, category
+    name), children & parents are lists of (logainm_id, name_en, name_ga,
+    category name), or obj is None if there's no such object"""
+    if obj is None:
+        return u"Logainm id {} not found\n".format(logainm_id)
+
+    name_en, name_ga, category = obj
+    lines = [u"Logainm [{}] {} {}/{}".format(category, logainm_id, name_en, name_ga)]
+
+    for title, objs, none in [("Children objects:", children, " No children"), ("Parent objects:", parents, " No parents")]:
+        lines.append(title)
+        if len(objs) == 0:
+            lines.append(none)
+        else:
+            for c in objs:
+                lines.append(u" * [{3}] {1}/{2} ({0} http://www.logainm.ie/en/{0})".format(*c))
+
+    return u"\n".join(lines) + u"\n"
+
+def related(store, rows):
+    """(logainm_id, name_en, name_ga, category name) of these names rows,
+    by category & name"""
+    objs = [(row['logainm_id'], row['name_en'], row['name_ga'], store.category_name(row['logainm_category_code'])) for row in rows]
+    objs.sort(key=lambda obj: (obj[3], obj[1]))
+    return objs
+
+def describe_from_store(store, logainm_id):
+    """describe() this object, looked up in the LogainmStore"""
+    row = store.get_name(logainm_id)
+    if row is None:
+        return describe(logainm_id, None, [], [])
+    obj = (row['name_en'], row['name_ga'], store.category_name(row['logainm_category_code']))
+    return describe(logainm_id, obj, related(store, store.children(logainm_id)), related(store, store.parents(logainm_id)))
+
+
+class LogainmIndex(object):
+    """The logainm names, categories & hierarchy, in memory, so describe()ing
+    an object doesn't need any queries. Ids are strings."""
+
+    def __init__(self, store):
+        self.names = {}
+        for row in store.all_names():
+            self.names[str(row['logainm_id'])] = (row['name_en'], row['name_ga'], store.category_name(row['logainm_category_code']))
+
+        self.children = defaultdict(list)
+        self.parents = defaultdict(list)
+        for outer_obj_id, inner_obj_id in store.all_contains():
+            self.children[str(outer_obj_id)].append(str(inner_obj_id))
+            self.parents[str(inner_obj_id)].append(str(outer_obj_id))
+
+    def related(self, logainm_ids):
+        """(logainm_id, name_en, name_ga, category name) of these objects, in
+        the same order as describe_from_store"""
+        objs = [(logainm_id, ) + self.names[logainm_id] for logainm_id in logainm_ids if logainm_id in self.names]
+        objs.sort(key=lambda obj: (obj[3], obj[1]))
+        return objs
+
+    def describe(self, logainm_id):
+        logainm_id = str(logainm_id)
+        return describe(logainm_id, self.names.get(logainm_id), self.related(self.children.get(logainm_id, [])), self.related(self.parents.get(logainm_id, [])))
+
+
+def read_osm_logainm_refs(osm_filename="boundaries.osm.xml"):
+    """OSM relation id -> logainm:ref, from the townlands.ie CSVs & the OSM
+    data, like match.py. Empty if they're not here."""
+    import match
+    filenames = ['townlands-no-geom.csv', 'civil_parishes-no-geom.csv', 'counties-no-geom.csv', 'baronies-no-geom.csv', osm_filename]
+    if not all(os.path.exists(filename) for filename in filenames):
+        logger.warning("Don't have all of %s, so can't look up OSM ids", ", ".join(filenames))
+        return {}
+    logainm_data = match.read_logainm_data(match.osm_relations_from_xml(osm_filename))
+    # townlands.ie has relations as negative ids
+    return {osm_id.lstrip("-"): logainm_ref for osm_id, logainm_ref in logainm_data['index']['osmid_to_logainm_ref'].items()}
+
+
+class LookupService(object):
+    """Answers batches of lookups from the in memory index, and keeps the
+    last answers"""
+
+    def __init__(self, index, osm_logainm_refs, cache_size=10000):
+        self.index = index
+        self.osm_logainm_refs = osm_logainm_refs
+        self.cache = logainm_store.LRUCache(cache_size)
+
+    def describe(self, logainm_id):
+        text = self.cache.get(logainm_id)
+        if text is not None:
+            instrumentation.count('cache_hits')
+        else:
+            text = self.index.describe(logainm_id)
+            self.cache.put(logainm_id, text)
+        return text
+
+    def describe_osm(self, osm_id):
+        osm_id = str(osm_id).lstrip("-")
+        logainm_ref = self.osm_logainm_refs.get(osm_id)
+        if logainm_ref is None:
+            return u"OSM relation {} has no known logainm:ref\n".format(osm_id)
+        text = u"OSM relation {} has logainm:ref={}\n".format(osm_id, logainm_ref)
+        for logainm_id in logainm_ref.split(";"):
+            text += self.describe(logainm_id.strip())
+        return text
+
+    def lookup(self, logainm_ids=(), osm_ids=()):
+        results = [{'type': 'logainm', 'id': str(logainm_id), 'text': self.describe(str(logainm_id))} for logainm_id in logainm_ids]
+        results.extend({'type': 'osm', 'id': str(osm_id), 'text': self.describe_osm(osm_id)} for osm_id in osm_ids)
+        return results
+
+
+class LookupHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    def do_POST(self):
+        if self.path != "/lookup":
+            self.send_error(404)
+            return
+        try:
+            request = json.loads(self.rfile.read(int(self.headers.getheader('content-length', 0))))
+            logainm_ids, osm_ids = request.get('logainm_ids', []), request.get('osm_ids', [])
+            if not (isinstance(logainm_ids, list) and isinstance(osm_ids, list)):
+                raise ValueError("logainm_ids and osm_ids must be lists")
+            results = self.server.service.lookup(logainm_ids, osm_ids)
+        except (ValueError, AttributeError, TypeError) as e:
+            self.send_error(400, str(e))
+            return
+
+        body = json.dumps({'results': results})
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        logger.debug(format, *args)
+
+def serve(service, port):
+    server = BaseHTTPServer.HTTPServer(('127.0.0.1', port), LookupHandler)
+    server.service = service
+    logger.info("Listening on http://localhost:%d/lookup", port)
+    server.serve_forever()
+
+def lookup_on_server(server_url, logainm_ids, osm_ids):
+    request = urllib2.Request(server_url.rstrip("/") + "/lookup", json.dumps({'logainm_ids': logainm_ids, 'osm_ids': osm_ids}), {'Content-Type': 'application/json'})
+    return json.load(urllib2.urlopen(request))['results']
+
+
+def main(args=None):
+    args = args or sys.argv[1:]
 
     parser = argparse.ArgumentParser()
-    #parser.add_argument("mbtilesfilename")
-    parser.add_argument("logainm_id")
-
-    args = parser.parse_args()
-    logainm_id = args.logainm_id
-
-    conn = sqlite3.connect("logainm.sqlite")
-    cursor = conn.cursor()
-
-    cursor.execute("select names.name_en, names.name_ga, cat.name_en from names join categories as cat on (names.logainm_category_code = cat.logainm_category_code) where logainm_id = ?", [logainm_id])
-    data = cursor.fetchone()
-    if len(data) == 0:
-        print "Logainm id {} not found".format(logainm_id)
+    parser.add_argument("ids", nargs="*", help="logainm ids (or OSM relation ids with --osm). - reads them from stdin")
+    parser.add_argument("--osm", action="store_true", help="The ids are OSM relation ids")
+    parser.add_argument("--serve", action="store_true", help="Run a lookup server, with everything in memory")
+    parser.add_argument("--port", type=int, default=DEFAULT_PORT)
+    parser.add_argument("--input", default="boundaries.osm.xml", help="OSM data for the server to look up OSM ids in")
+    parser.add_argument("--server", metavar="URL", help="Look the ids up on this server, e.g. http://localhost:{}".format(DEFAULT_PORT))
+    parser.add_argument("-v", "--verbose", action="store_true")
+
+    args = parser.parse_args(args)
+
+    ch = logging.StreamHandler(sys.stderr)
+    ch.setLevel(logging.DEBUG if args.verbose else logging.INFO)
+    ch.setFormatter(logging.Formatter('%(asctime)s\t%(levelname)s\tL%(lineno)s\t%(message)s'))
+    logger.addHandler(ch)
+    logger.setLevel(logging.DEBUG)
+
+    ids = []
+    for value in args.ids:
+        if value == '-':
+            ids.extend(sys.stdin.read().split())
+        else:
+            ids.append(value)
+
+    if args.serve:
+        store = logainm_store.LogainmStore.open()
+        with printer("loading logainm data"):
+            index = LogainmIndex(store)
+        with printer("loading OSM ids"):
+            osm_logainm_refs = read_osm_logainm_refs(args.input)
+        serve(LookupService(index, osm_logainm_refs), args.port)
         return
 
-    name_en, name_ga, category = data
-    print u"Logainm [{}] {} {}/{}".format(category, logainm_id, name_en, name_ga)
-
-    cursor.execute("select inner_obj_id, names.name_en, names.name_ga, cat.name_en from geometric_contains as c join names on (c.inner_obj_id = names.logainm_id) join categories as cat ON (cat.logainm_category_code = names.logainm_category_code) where c.outer_obj_id = ? ORDER BY cat.name_en, names.name_en", [logainm_id])
-    children_logainm_id = cursor.fetchall()
-    
-    print "Children objects:"
-    if len(children_logainm_id) == 0:
-        print " No children"
-    else:
-        for c in children_logainm_id:
-            print u" * [{3}] {1}/{2} ({0} http://www.logainm.ie/en/{0})".format(*c)
-
-    cursor.execute("select outer_obj_id, names.name_en, names.name_ga, cat.name_en from geometric_contains as c join names on (c.outer_obj_id = names.logainm_id) join categories as cat ON (cat.logainm_category_code = names.logainm_category_code) where c.inner_obj_id = ? ORDER BY cat.name_en, names.name_en", [logainm_id])
-    parents = cursor.fetchall()
-    
-    print "Parent objects:"
-    if len(parents) == 0:
-        print " No parents"
-    else:
-        for c in parents:
-            print u" * [{3}] {1}/{2} ({0} http://www.logainm.ie/en/{0})".format(*c)
-
+    if args.server:
+        for result in lookup_on_server(args.server, [] if args.osm else ids, ids if args.osm else []):
+            sys.stdout.write(result['text'])
+        return
 
+    if args.osm:
+        parser.error("--osm needs --server, which has the OSM data loaded")
 
+    store = logainm_store.LogainmStore.open()
+    # Look them all up at once, so describing each one is from the cache
+    store.get_names(ids)
+    store.children_of(ids)
+    store.parents_of(ids)
+    for logainm_id in ids:
+        sys.stdout.write(describe_from_store(store, logainm_id))
 
 
 if __name__ == '__main__':
-    main()
-
-
+    main(sys.argv[1:])
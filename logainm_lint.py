@@ -1,49 +1,259 @@
 """
 Perform some linting on the logainm data that's currently in OSM
+
+All the checks are run in one pass over the OSM XML. Each check looks at
+every relation (visit), then says what it needs from the logainm database
+(request), which is all looked up at once, one query per table, and then
+returns the problems it found.
+
+    python logainm_lint.py -i boundaries.osm.xml --all
+    python logainm_lint.py -i boundaries.osm.xml --dupe-logainm-ref --logainm-names
 """
+import os
 import sys
 import argparse
 import logging
-import xml.etree.ElementTree as ET
-from contextlib import contextmanager
 from collections import defaultdict
 
+import instrumentation
+import match
+import add_all_logainm_tags
+import logainm_closure
+import logainm_store
+
 logger = logging.getLogger(__name__)
 
-@contextmanager
-def printer(msg):
-    msg = msg.strip()
-    logger.info("Started "+msg)
-    yield
-    logger.info("Finished "+msg)
+printer = instrumentation.make_printer(logger)
+
+
+class Check(object):
+    """One lint check. Subclasses set name (also the command line option),
+    description & message, and override some of the methods."""
+    name = None
+    description = None
+    # Used to log each problem. Unicode, since the names in the problems are
+    message = None
+    needs_logainm = False
+
+    def visit(self, osm_id, tags):
+        """Called for each relation, tags is a dict-like of its OSM tags"""
+        pass
+
+    def request(self, lookup):
+        """Say what's needed from logainm, with lookup.want_*"""
+        pass
 
+    def problems(self, lookup):
+        """The problems found, as a list of dicts"""
+        return []
 
-def get_existing_osm_tags(xml_el):
-    """Given a XML element for an object, return (as dict) the current OSM tags"""
-    return {el.get('k'): el.get('v') for el in xml_el.findall("tag")}
+    def log_problem(self, problem):
+        logger.info(self.message.format(**problem))
 
+    def log_summary(self, problems):
+        logger.info("There are {} {}".format(len(problems), self.description))
 
-def duplicate_logainm_refs(osm_xml_root):
-    logainm_ref_to_osm_id = defaultdict(set)
-    for rel in osm_xml_root.iter("relation"):
-        osm_id = rel.get("id", None)
-        tags = get_existing_osm_tags(rel)
+
+class DuplicateLogainmRefs(Check):
+    name = 'dupe-logainm-ref'
+    description = "logainm:refs which are on more than one OSM relation"
+
+    def __init__(self):
+        self.logainm_ref_to_osm_id = defaultdict(set)
+
+    def visit(self, osm_id, tags):
         if 'logainm:ref' in tags:
-            logainm_ref_to_osm_id[tags['logainm:ref']].add(osm_id)
+            self.logainm_ref_to_osm_id[tags.get('logainm:ref')].add(osm_id)
+
+    def problems(self, lookup):
+        return [{'logainm_ref': lref, 'osm_ids': sorted(osms)} for lref, osms in sorted(self.logainm_ref_to_osm_id.items()) if len(osms) > 1]
+
+    def log_problem(self, problem):
+        lref, osms = problem['logainm_ref'], problem['osm_ids']
+        logger.info(u"logainm:ref={} for these {} OSM relations: {}".format(lref, len(osms), u", ".join(osms)))
+        logger.info(u"View on logainm: http://logainm.ie/en/{}".format(lref))
+        for osmid in osms:
+            logger.info(u"View on OSM: http://www.openstreetmap.org/relation/{}".format(osmid))
+
+    def log_summary(self, problems):
+        logger.info("There are {} duplicate logainm:refs which affect {} OSM objects".format(len(problems), sum(len(p['osm_ids']) for p in problems)))
+
+
+class MultipleLogainmRefs(Check):
+    name = 'multiple-logainm-refs'
+    description = "OSM relations with more than one (semi-colon separated) logainm:ref"
+    message = u"OSM relation {osm_id} has more than one logainm:ref: {logainm_ref}"
+
+    def __init__(self):
+        self.found = []
+
+    def visit(self, osm_id, tags):
+        if ';' in tags.get('logainm:ref', ''):
+            self.found.append({'osm_id': osm_id, 'logainm_ref': tags.get('logainm:ref')})
+
+    def problems(self, lookup):
+        return self.found
+
+
+class MissingLogainmRefs(Check):
+    name = 'missing-logainm-ref'
+    description = "OSM relations with a logainm:ref which isn't in logainm"
+    message = u"OSM relation {osm_id} has logainm:ref={logainm_ref}, which isn't in logainm"
+    needs_logainm = True
+
+    def __init__(self):
+        self.refs = []
+
+    def visit(self, osm_id, tags):
+        if 'logainm:ref' in tags and ';' not in tags.get('logainm:ref'):
+            self.refs.append((osm_id, tags.get('logainm:ref')))
+
+    def request(self, lookup):
+        lookup.want_names(ref for osm_id, ref in self.refs)
+
+    def problems(self, lookup):
+        return [{'osm_id': osm_id, 'logainm_ref': ref} for osm_id, ref in self.refs if lookup.name(ref) is None]
+
+
+class LogainmNames(Check):
+    name = 'logainm-names'
+    description = "OSM names which are different from the logainm name"
+    message = u"OSM relation {osm_id} (logainm:ref={logainm_ref}) has {key}={osm_name}, logainm has {logainm_name}"
+    needs_logainm = True
+    KEYS = [('name:ga', 'name_ga'), ('name:en', 'name_en')]
+
+    def __init__(self):
+        self.names = []
 
-    num_dupe_refs = 0
-    num_osm_dupes = 0
-    for lref, osms in logainm_ref_to_osm_id.items():
-        if len(osms) > 1:
-            logger.info("logainm:ref={} for these {} OSM relations: {}".format(lref, len(osms), ", ".join(osms)))
-            logger.info("View on logainm: http://logainm.ie/en/{}".format(lref))
-            for osmid in osms:
-                logger.info("View on OSM: http://www.openstreetmap.org/relation/{}".format(osmid))
-            num_dupe_refs += 1
-            num_osm_dupes += len(osms)
+    def visit(self, osm_id, tags):
+        if 'logainm:ref' in tags and any(key in tags for key, column in self.KEYS):
+            self.names.append((osm_id, tags.get('logainm:ref'), [(key, column, tags.get(key)) for key, column in self.KEYS if key in tags]))
 
-    logger.info("There are {} duplicate logainm:refs which affect {} OSM objects".format(num_dupe_refs, num_osm_dupes))
+    def request(self, lookup):
+        lookup.want_names(ref for osm_id, ref, names in self.names)
 
+    def problems(self, lookup):
+        problems = []
+        for osm_id, ref, names in self.names:
+            logainm_data = lookup.name(ref)
+            if logainm_data is None:
+                continue
+            for key, column, osm_name in names:
+                if logainm_data[column] not in ("", None) and logainm_data[column] != osm_name:
+                    problems.append({'osm_id': osm_id, 'logainm_ref': ref, 'key': key, 'osm_name': osm_name, 'logainm_name': logainm_data[column]})
+        return problems
+
+
+class ParentContains(Check):
+    """Needs the townlands.ie CSV, for which OSM relation is in which"""
+    name = 'parent-contains'
+    description = "OSM relations whose logainm:ref isn't anywhere in their parent's logainm:ref"
+    message = u"OSM relation {osm_id} (logainm:ref={logainm_ref}) is in OSM relation {parent_osm_id} (logainm:ref={parent_logainm_ref}), but logainm doesn't have it in there"
+    needs_logainm = True
+
+    def __init__(self, townlands_csv="townlands-no-geom.csv"):
+        self.townlands_csv = townlands_csv
+        self.refs = {}
+        self.pairs = []
+
+    def visit(self, osm_id, tags):
+        if add_all_logainm_tags.logainm_ref_key(tags.get('logainm:ref')) is not None:
+            self.refs[osm_id] = tags.get('logainm:ref')
+
+    def request(self, lookup):
+        if not os.path.exists(self.townlands_csv):
+            logger.warning("No %s, so can't check parents", self.townlands_csv)
+            return
+        with instrumentation.stage("reading parents from " + self.townlands_csv):
+            parents = match.ParentIndexes(match.read_csv_records(self.townlands_csv, {}))
+            for level in [match.BARONIES, match.CIVIL_PARISHES, match.TOWNLANDS]:
+                for obj_osm_id, parent_osm_ids in parents.get(level['obj_key'], level['parent_key']).items():
+                    # townlands.ie has relations as negative OSM ids
+                    obj_osm_id = obj_osm_id.lstrip("-")
+                    for parent_osm_id in parent_osm_ids:
+                        parent_osm_id = parent_osm_id.lstrip("-")
+                        if obj_osm_id in self.refs and parent_osm_id in self.refs:
+                            self.pairs.append((obj_osm_id, parent_osm_id))
+        lookup.want_contains((self.refs[parent], self.refs[obj]) for obj, parent in self.pairs)
+
+    def problems(self, lookup):
+        return [{'osm_id': obj, 'logainm_ref': self.refs[obj], 'parent_osm_id': parent, 'parent_logainm_ref': self.refs[parent]}
+                for obj, parent in self.pairs if not lookup.contains(self.refs[parent], self.refs[obj])]
+
+
+CHECKS = [DuplicateLogainmRefs, MultipleLogainmRefs, MissingLogainmRefs, LogainmNames, ParentContains]
+
+
+class LogainmLookup(object):
+    """What the checks need from the logainm database. They ask for what
+    they want, and then it's all loaded with one query per table."""
+
+    def __init__(self, store):
+        self.store = store
+        self.wanted_names = set()
+        self.wanted_contains = set()
+        self.names = {}
+        self.contained = set()
+
+    def want_names(self, logainm_refs):
+        self.wanted_names.update(add_all_logainm_tags.logainm_ref_key(ref) for ref in logainm_refs)
+
+    def want_contains(self, pairs):
+        """pairs of (outer logainm:ref, inner logainm:ref)"""
+        self.wanted_contains.update((add_all_logainm_tags.logainm_ref_key(outer), add_all_logainm_tags.logainm_ref_key(inner)) for outer, inner in pairs)
+
+    def load(self):
+        self.wanted_names.discard(None)
+        if self.wanted_names:
+            with instrumentation.stage("looking up logainm names") as stage:
+                self.names = self.store.get_names(self.wanted_names)
+                stage.objects = len(self.names)
+
+        if self.wanted_contains:
+            logainm_closure.require_closure(self.store.conn)
+            with instrumentation.stage("looking up logainm containment") as stage:
+                rows = self.store.bulk_query("select ancestor_id, descendant_id from logainm_closure where descendant_id in ({ids})",
+                                             set(inner for outer, inner in self.wanted_contains))
+                # The ids can be stored as text or numbers
+                self.contained = set(pair for pair in ((str(outer), str(inner)) for outer, inner in rows) if pair in self.wanted_contains)
+                stage.objects = len(self.contained)
+
+    def name(self, logainm_ref):
+        """The names row for this logainm:ref, or None"""
+        return self.names.get(add_all_logainm_tags.logainm_ref_key(logainm_ref))
+
+    def contains(self, outer_ref, inner_ref):
+        """True iff inner_ref is anywhere inside outer_ref"""
+        return (add_all_logainm_tags.logainm_ref_key(outer_ref), add_all_logainm_tags.logainm_ref_key(inner_ref)) in self.contained
+
+
+class Linter(object):
+    """Runs these checks. Call visit for each relation, then finish, which
+    logs the problems and returns them as (check, problems)"""
+
+    def __init__(self, checks, store=None):
+        self.checks = checks
+        self.store = store
+
+    def visit(self, osm_id, tags):
+        for check in self.checks:
+            check.visit(osm_id, tags)
+
+    def finish(self):
+        lookup = LogainmLookup(self.store)
+        for check in self.checks:
+            check.request(lookup)
+        lookup.load()
+
+        results = []
+        for check in self.checks:
+            with instrumentation.stage("checking " + check.name):
+                problems = check.problems(lookup)
+            for problem in problems:
+                check.log_problem(problem)
+            check.log_summary(problems)
+            results.append((check, problems))
+        return results
 
 
 def main(args=None):
@@ -53,7 +263,11 @@ def main(args=None):
     parser.add_argument("-i", "--input", required=True)
     parser.add_argument("-v", "--verbose", action="store_true")
 
-    parser.add_argument("--dupe-logainm-ref", action="store_true")
+    parser.add_argument("--all", action="store_true", help="Run all the checks")
+    for check in CHECKS:
+        parser.add_argument("--" + check.name, action="append_const", dest="checks", const=check, help="Report " + check.description)
+    parser.add_argument("--report", help="Also write the problems to this JSON lines file")
+    parser.add_argument("--profile", metavar="FILE", help="Write the time, CPU, memory & counters of each stage to this JSON file")
 
     args = parser.parse_args(args)
 
@@ -64,19 +278,37 @@ def main(args=None):
         ch.setLevel(logging.INFO)
     formatter = logging.Formatter('%(asctime)s\t%(levelname)s\tL%(lineno)s\t%(message)s')
     ch.setFormatter(formatter)
-    logger.addHandler(ch)
-    logger.setLevel(logging.DEBUG)
+    for log in [logger, match.logger, logainm_closure.logger]:
+        log.addHandler(ch)
+        log.setLevel(logging.DEBUG)
 
     logger.info("Starting")
 
-    # read in OSM XML
-    with printer("reading in OSM XML"):
-        tree = ET.parse(args.input)
-        root = tree.getroot()
+    checks = [check() for check in CHECKS if args.all or check in (args.checks or [])]
+    store = None
+    if any(check.needs_logainm for check in checks):
+        store = logainm_store.LogainmStore.open()
+    linter = Linter(checks, store)
+
+    # read in OSM XML, once for all the checks
+    with printer("reading in OSM XML & visiting relations") as stage:
+        stage.objects = 0
+        for osm_id, tags in match.osm_relations_from_xml(args.input):
+            linter.visit(osm_id, tags)
+            stage.objects += 1
+
+    results = linter.finish()
+
+    if args.report:
+        report = match.JournalWriter(args.report)
+        for check, problems in results:
+            for problem in problems:
+                report.add(dict(problem, stage='lint', outcome=check.name))
+        report.close()
+
+    if args.profile:
+        instrumentation.PROFILE.dump(args.profile)
 
-    if args.dupe_logainm_ref:
-        duplicate_logainm_refs(root)
-    
 
 
 if __name__ == '__main__':
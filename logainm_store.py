@@ -0,0 +1,213 @@
+"""
+Access to the logainm database (logainm.sqlite), shared by all the scripts,
+so it's opened & tuned in one place.
+
+    store = logainm_store.LogainmStore.open()
+    store.get_name(1234)            # names row, as a dict, or None
+    store.children(1234, 'BF')      # names rows of what's directly in it
+    store.parents(1234)
+    store.get_names([1234, 5678])   # and the bulk versions, which return
+    store.children_of([1234, 5678]) # dicts keyed by id_str_key(id)
+
+Read only connections are opened immutable where the sqlite3 module supports
+URIs (Python 3), so SQLite doesn't need any locks. Otherwise (Python 2) they
+are normal connections with query_only set, so they can't write, but still
+lock. All connections have a large page cache and memory mapped I/O. The rows looked up are kept in LRU
+caches, and the SQL is the same each time (the bulk queries are padded to
+BULK_SIZE ids), so the sqlite3 module reuses the prepared statements.
+"""
+import sqlite3
+from collections import OrderedDict
+
+import instrumentation
+
+DEFAULT_FILENAME = "logainm.sqlite"
+
+# Page cache, in KiB, and how much of the file to memory map, in bytes
+CACHE_SIZE_KB = 64 * 1024
+MMAP_SIZE = 256 * 1024 * 1024
+
+# How many ids are looked up with each query of the bulk lookups
+BULK_SIZE = 500
+
+NAME_COLUMNS = ["logainm_id", "logainm_category_code", "logainm_permalink", "placenamesni_link", "name_en", "name_ga", "name_ga_genitive"]
+
+
+def id_str_key(logainm_id):
+    """Key for this logainm id in the results of the bulk lookups, the id as
+    a string (unlike match.logainm_id_key, which is an int), or None if it's
+    not one logainm id (e.g. semi-colon separated ones)"""
+    try:
+        return str(int(logainm_id))
+    except (TypeError, ValueError):
+        return None
+
+def connect(filename=DEFAULT_FILENAME, read_only=False):
+    """Connect to the database. A read_only one is immutable if this sqlite3
+    module supports URIs, and query_only if not"""
+    conn = None
+    if read_only:
+        try:
+            conn = sqlite3.connect("file:{}?mode=ro&immutable=1".format(filename), uri=True)
+        except TypeError:
+            # This version of the sqlite3 module doesn't support URIs
+            pass
+    if conn is None:
+        conn = sqlite3.connect(filename)
+        if read_only:
+            conn.execute("pragma query_only = 1")
+    conn.execute("pragma cache_size = -{}".format(CACHE_SIZE_KB))
+    conn.execute("pragma mmap_size = {}".format(MMAP_SIZE))
+    return conn
+
+
+def require_table(conn, table):
+    """Raise a ValueError if this table (made by build_logainm_db.py) isn't in
+    the database, since it's never made while matching"""
+    cursor = conn.execute("select count(*) from sqlite_master where type = 'table' and name = ?", [table])
+    if cursor.fetchone()[0] == 0:
+        raise ValueError("The logainm database has no {} table, it was made by an older build_logainm_db.py. Rebuild logainm.sqlite with: python build_logainm_db.py".format(table))
+
+
+def related_sql(this_column, other_column, category=False):
+    """Query for the names rows related to some ids in geometric_contains,
+    with {ids} for the list of ids, and a parameter for the category if
+    there is one"""
+    # cross join, so SQLite always starts from the ids, not the category
+    sql = "select c.{}, {} from geometric_contains as c cross join names as n on (n.logainm_id = c.{}) where c.{} in ({{ids}})".format(
+        this_column, ", ".join("n." + column for column in NAME_COLUMNS), other_column, this_column)
+    if category:
+        sql += " and n.logainm_category_code = ?"
+    return sql
+
+
+class LRUCache(object):
+    """Keeps the last size values used"""
+
+    def __init__(self, size):
+        self.size = size
+        self.values = OrderedDict()
+
+    def __contains__(self, key):
+        return key in self.values
+
+    def get(self, key, default=None):
+        if key not in self.values:
+            return default
+        value = self.values.pop(key)
+        self.values[key] = value
+        return value
+
+    def put(self, key, value):
+        self.values.pop(key, None)
+        self.values[key] = value
+        if len(self.values) > self.size:
+            self.values.popitem(last=False)
+
+
+class LogainmStore(object):
+    """Looks up names rows (dicts of NAME_COLUMNS), and what's directly
+    in/around them in geometric_contains. Ids can be given as ints or
+    strings."""
+
+    def __init__(self, conn, cache_size=10000):
+        self.conn = conn
+        self.names_cache = LRUCache(cache_size)
+        self.children_cache = LRUCache(cache_size)
+        self.parents_cache = LRUCache(cache_size)
+        self.category_names = None
+
+    @classmethod
+    def open(cls, filename=DEFAULT_FILENAME, read_only=True, **kwargs):
+        return cls(connect(filename, read_only=read_only), **kwargs)
+
+    def cursor(self):
+        return self.conn.cursor()
+
+    def bulk_query(self, sql, keys, params=()):
+        """Run this query (with {ids} for the list of ids, then any other
+        params) for all these ids, BULK_SIZE at a time"""
+        keys = list(keys)
+        sql = sql.format(ids=", ".join("?" for i in range(BULK_SIZE)))
+        for i in range(0, len(keys), BULK_SIZE):
+            chunk = keys[i:i+BULK_SIZE]
+            # NULL never matches, and the statement is always the same
+            chunk += [None] * (BULK_SIZE - len(chunk))
+            instrumentation.count('sql_queries')
+            for row in self.conn.execute(sql, chunk + list(params)):
+                yield row
+
+    def cached(self, cache, logainm_ids, category=None):
+        """(id_str_key -> what's in the cache, keys which aren't) for
+        these ids. The cache is by (key, category)"""
+        results = {}
+        missing = []
+        for key in set(id_str_key(logainm_id) for logainm_id in logainm_ids):
+            if key is None:
+                continue
+            if (key, category) in cache:
+                instrumentation.count('cache_hits')
+                results[key] = cache.get((key, category))
+            else:
+                missing.append(key)
+        return results, missing
+
+    def get_names(self, logainm_ids):
+        """id_str_key -> names row of these ids (if they're in logainm)"""
+        results, missing = self.cached(self.names_cache, logainm_ids)
+        for key in missing:
+            results[key] = None
+        for row in self.bulk_query("select {} from names where logainm_id in ({{ids}})".format(", ".join(NAME_COLUMNS)), missing):
+            results[id_str_key(row[0])] = dict(zip(NAME_COLUMNS, row))
+        for key in missing:
+            self.names_cache.put((key, None), results[key])
+        return dict((key, row) for key, row in results.items() if row is not None)
+
+    def get_name(self, logainm_id):
+        """names row of this id, or None"""
+        return self.get_names([logainm_id]).get(id_str_key(logainm_id))
+
+    def related_of(self, cache, this_column, other_column, logainm_ids, category=None):
+        results, missing = self.cached(cache, logainm_ids, category)
+        for key in missing:
+            results[key] = []
+        params = [] if category is None else [category]
+        for row in self.bulk_query(related_sql(this_column, other_column, category is not None), missing, params):
+            results[id_str_key(row[0])].append(dict(zip(NAME_COLUMNS, row[1:])))
+        for key in missing:
+            cache.put((key, category), results[key])
+        return results
+
+    def children_of(self, logainm_ids, category=None):
+        """id_str_key -> names rows of what's directly in each of these
+        (of this category, if given), according to geometric_contains"""
+        return self.related_of(self.children_cache, 'outer_obj_id', 'inner_obj_id', logainm_ids, category)
+
+    def parents_of(self, logainm_ids, category=None):
+        """id_str_key -> names rows of what each of these is directly in"""
+        return self.related_of(self.parents_cache, 'inner_obj_id', 'outer_obj_id', logainm_ids, category)
+
+    def children(self, logainm_id, category=None):
+        return self.children_of([logainm_id], category).get(id_str_key(logainm_id), [])
+
+    def parents(self, logainm_id, category=None):
+        return self.parents_of([logainm_id], category).get(id_str_key(logainm_id), [])
+
+    def names_in_category(self, category):
+        """names rows of everything of this category"""
+        return [dict(zip(NAME_COLUMNS, row)) for row in self.conn.execute("select {} from names where logainm_category_code = ?".format(", ".join(NAME_COLUMNS)), [category])]
+
+    def category_name(self, category):
+        """English name of this category code"""
+        if self.category_names is None:
+            self.category_names = dict(self.conn.execute("select logainm_category_code, name_en from categories"))
+        return self.category_names.get(category)
+
+    def all_names(self):
+        """names rows of everything, not cached"""
+        for row in self.conn.execute("select {} from names".format(", ".join(NAME_COLUMNS))):
+            yield dict(zip(NAME_COLUMNS, row))
+
+    def all_contains(self):
+        """(outer id, inner id) of all of geometric_contains"""
+        return self.conn.execute("select outer_obj_id, inner_obj_id from geometric_contains")
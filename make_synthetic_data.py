@@ -0,0 +1,325 @@
+# -*- coding: utf-8 -*-
+"""
+Make a synthetic, but consistent, set of input files for match.py: a
+logainm.sqlite (names, geometric_contains, logainm_closure & categories, as
+build_logainm_db.py makes it), the townlands.ie *-no-geom.csv files, and a
+boundaries.osm.xml. This doesn't need any
+downloads, and is the same every time, so it can be used to see if a change
+makes things faster or slower.
+
+At --scale 1 there are about as many objects as in Ireland (~60k
+townlands). Counties are always the 32 real ones.
+
+    python make_synthetic_data.py --scale 5 --output-dir benchmark-data/scale-5
+
+Some of the OSM objects are made harder to match, the same way real data is:
+some already have a logainm:ref, some have the Upper/Lower/St. in a different
+place, some are misspelt, some have duplicate names in logainm, some aren't
+in logainm, and some aren't in any civil parish. Some counties have a name:ga
+without the fadas, which logainm_lint.py --logainm-names reports.
+"""
+import sys
+import os
+import csv
+import random
+import unicodedata
+import sqlite3
+import logging
+import argparse
+from xml.sax.saxutils import quoteattr
+
+import instrumentation
+import build_logainm_db
+
+logger = logging.getLogger(__name__)
+
+printer = instrumentation.make_printer(logger)
+
+COUNTIES = [
+    (u"Antrim", u"Aontroim", True), (u"Armagh", u"Ard Mhacha", True), (u"Carlow", u"Ceatharlach", False),
+    (u"Cavan", u"An Cabhán", False), (u"Clare", u"An Clár", False), (u"Cork", u"Corcaigh", False),
+    (u"Derry", u"Doire", True), (u"Donegal", u"Dún na nGall", False), (u"Down", u"An Dún", True),
+    (u"Dublin", u"Baile Átha Cliath", False), (u"Fermanagh", u"Fear Manach", True), (u"Galway", u"Gaillimh", False),
+    (u"Kerry", u"Ciarraí", False), (u"Kildare", u"Cill Dara", False), (u"Kilkenny", u"Cill Chainnigh", False),
+    (u"Laois", u"Laois", False), (u"Leitrim", u"Liatroim", False), (u"Limerick", u"Luimneach", False),
+    (u"Longford", u"An Longfort", False), (u"Louth", u"Lú", False), (u"Mayo", u"Maigh Eo", False),
+    (u"Meath", u"An Mhí", False), (u"Monaghan", u"Muineachán", False), (u"Offaly", u"Uíbh Fhailí", False),
+    (u"Roscommon", u"Ros Comáin", False), (u"Sligo", u"Sligeach", False), (u"Tipperary", u"Tiobraid Árann", False),
+    (u"Tyrone", u"Tir Eoghain", True), (u"Waterford", u"Port Láirge", False), (u"Westmeath", u"An Iarmhí", False),
+    (u"Wexford", u"Loch Garman", False), (u"Wicklow", u"Cill Mhantáin", False),
+]
+
+# (English, Irish) parts that names are made from
+PREFIXES = [
+    (u"Bally", u"Baile "), (u"Kil", u"Cill "), (u"Knock", u"Cnoc "), (u"Drum", u"Droim "), (u"Rath", u"Ráth "),
+    (u"Clon", u"Cluain "), (u"Carrick", u"Carraig "), (u"Derry", u"Doire "), (u"Lis", u"Lios "), (u"Ard", u"Ard "),
+    (u"Glen", u"Gleann "), (u"Tully", u"Tulach "), (u"Cappagh", u"Ceapach "), (u"Mullagh", u"Mullach "),
+    (u"Dun", u"Dún "), (u"Inish", u"Inis "), (u"Cloon", u"Cluain "), (u"Kilna", u"Coill na "),
+]
+SUFFIXES = [
+    (u"more", u"Mór"), (u"beg", u"Beag"), (u"keel", u"Caol"), (u"garriff", u"Garbh"), (u"owen", u"Eoghain"),
+    (u"reagh", u"Riabhach"), (u"duff", u"Dubh"), (u"bane", u"Bán"), (u"lough", u"Locha"), (u"anure", u"an Iúir"),
+    (u"nagree", u"na Groighe"), (u"cor", u"Corr"), (u"glass", u"Glas"), (u"ross", u"Ros"), (u"patrick", u"Phádraig"),
+    (u"bride", u"Bhríde"), (u"connell", u"Conaill"), (u"managh", u"Meanach"), (u"fin", u"Fionn"), (u"rush", u"Ros"),
+]
+SUBPARTS = [(u"Upper", u"Uachtarach"), (u"Lower", u"Íochtarach"), (u"North", u"Thuaidh"), (u"South", u"Theas"),
+            (u"East", u"Thoir"), (u"West", u"Thiar")]
+
+# Number of each level, at --scale 1
+BARONIES_PER_COUNTY = 8.5
+PARISHES_PER_BARONY = 9
+TOWNLANDS_PER_PARISH = 24
+
+CATEGORIES = [(u"CON", u"County", u"Contae"), (u"BAR", u"Barony", u"Barúntacht"),
+              (u"PAR", u"Civil Parish", u"Paróiste Sibhialta"), (u"BF", u"Townland", u"Baile Fearainn")]
+
+# The columns of the logainm CSVs
+NAMES_COLUMNS = ["logainm_id", "logainm_category_code", "logainm_permalink", "placenamesni_link", "name_en", "name_ga", "name_ga_genitive"]
+CONTAINS_COLUMNS = ["outer_obj_id", "inner_obj_id"]
+CATEGORIES_COLUMNS = ["logainm_category_code", "name_en", "name_ga"]
+
+CSV_HEADER = ["OSM_ID", "NAME_TAG", "NAME_EN", "LOGAINM_RE", "CO_OSM_ID", "BAR_OSM_ID", "CP_OSM_ID", "AREA_M2"]
+
+# How OSM objects which don't have a logainm:ref differ from logainm, and
+# how often, for (civil parishes, townlands)
+DIFFERENCES = [
+    ('moved_subpart', 0.05), ('misspelt', 0.03), ('duplicate', 0.01),
+    ('not_in_logainm', 0.01), ('no_parent', 0.01),
+]
+
+
+class Generator(object):
+
+    def __init__(self, scale, seed, tagged_fraction):
+        self.random = random.Random(seed)
+        self.scale = scale
+        self.tagged_fraction = tagged_fraction
+        self.next_logainm_id = 1000
+        self.next_osm_id = 100000
+
+        # (logainm_id, category, name_en, name_ga, northern_ireland)
+        self.names = []
+        # (outer logainm_id, inner logainm_id)
+        self.contains = []
+        # level -> list of dicts for the CSV & OSM XML
+        self.osm = {'counties': [], 'baronies': [], 'civil_parishes': [], 'townlands': []}
+
+    def logainm_id(self):
+        self.next_logainm_id += 1
+        return self.next_logainm_id
+
+    def osm_id(self):
+        self.next_osm_id += 1
+        return self.next_osm_id
+
+    def make_name(self, used, subpart_fraction=0.1):
+        """A new (English, Irish) name, which isn't in used"""
+        for tries in range(100):
+            prefix_en, prefix_ga = self.random.choice(PREFIXES)
+            suffix_en, suffix_ga = self.random.choice(SUFFIXES)
+            name_en, name_ga = prefix_en + suffix_en, prefix_ga + suffix_ga
+            if self.random.random() < subpart_fraction:
+                subpart_en, subpart_ga = self.random.choice(SUBPARTS)
+                name_en, name_ga = name_en + u" " + subpart_en, name_ga + u" " + subpart_ga
+            if tries > 50:
+                # Run out of names in this parent
+                name_en, name_ga = name_en + u" " + unicode(tries), name_ga + u" " + unicode(tries)
+            if name_en not in used:
+                used.add(name_en)
+                return name_en, name_ga
+        raise ValueError("Couldn't make a unique name")
+
+    def difference(self):
+        r = self.random.random()
+        for difference, fraction in DIFFERENCES:
+            if r < fraction:
+                return difference
+            r -= fraction
+        return None
+
+    def osm_name(self, name_en, difference):
+        words = name_en.split(u" ")
+        if difference == 'moved_subpart' and len(words) > 1 and words[-1] in [en for en, ga in SUBPARTS]:
+            return u" ".join(words[-1:] + words[:-1])
+        if difference == 'moved_subpart' and words[0] == u"Saint":
+            return u" ".join([u"St."] + words[1:])
+        if difference == 'misspelt':
+            i = self.random.randrange(1, len(name_en))
+            return name_en[:i] + name_en[i+1:]
+        return name_en
+
+    def add_logainm(self, category, name_en, name_ga, parents, northern_ireland):
+        logainm_id = self.logainm_id()
+        self.names.append((logainm_id, category, name_en, name_ga, northern_ireland))
+        # geometric_contains has every containing object, not just the direct parent
+        for parent in parents:
+            self.contains.append((parent, logainm_id))
+        return logainm_id
+
+    def add_osm(self, level, name, logainm_id, tagged, co_osm_id=None, bar_osm_id=None, cp_osm_id=None, name_ga=None):
+        osm_id = self.osm_id()
+        self.osm[level].append({
+            'osm_id': osm_id, 'name': name, 'name_ga': name_ga, 'logainm_ref': logainm_id if tagged else None,
+            'co_osm_id': co_osm_id, 'bar_osm_id': bar_osm_id, 'cp_osm_id': cp_osm_id,
+        })
+        return osm_id
+
+    def generate(self):
+        num_baronies = max(len(COUNTIES), int(round(len(COUNTIES) * BARONIES_PER_COUNTY * self.scale)))
+
+        counties = []
+        for i, (name_en, name_ga, northern_ireland) in enumerate(COUNTIES):
+            logainm_id = self.add_logainm(u"CON", name_en, name_ga, [], northern_ireland)
+            # Not random, so the rest of the data is the same as before
+            osm_name_ga = name_ga if i % 2 == 0 else without_fadas(name_ga)
+            osm_id = self.add_osm('counties', u"County " + name_en, logainm_id, True, name_ga=osm_name_ga)
+            counties.append((logainm_id, osm_id, northern_ireland, set()))
+
+        for i in range(num_baronies):
+            co_logainm_id, co_osm_id, northern_ireland, used = counties[i % len(counties)]
+            name_en, name_ga = self.make_name(used, subpart_fraction=0.05)
+            bar_logainm_id = self.add_logainm(u"BAR", name_en, name_ga, [co_logainm_id], northern_ireland)
+            bar_osm_id = self.add_osm('baronies', name_en, bar_logainm_id, self.random.random() < 0.5, co_osm_id=co_osm_id)
+
+            parish_names = set()
+            for j in range(PARISHES_PER_BARONY):
+                self.add_parish(co_logainm_id, co_osm_id, bar_logainm_id, bar_osm_id, northern_ireland, parish_names)
+
+    def add_parish(self, co_logainm_id, co_osm_id, bar_logainm_id, bar_osm_id, northern_ireland, parish_names):
+        if self.random.random() < 0.05:
+            prefix_en, prefix_ga = self.random.choice(PREFIXES)
+            name_en, name_ga = u"Saint " + prefix_en.title(), u"San " + prefix_ga.strip()
+            if name_en in parish_names:
+                name_en, name_ga = self.make_name(parish_names)
+            parish_names.add(name_en)
+        else:
+            name_en, name_ga = self.make_name(parish_names)
+        cp_logainm_id = self.add_logainm(u"PAR", name_en, name_ga, [bar_logainm_id, co_logainm_id], northern_ireland)
+        tagged = self.random.random() < self.tagged_fraction
+        difference = None if tagged else self.difference()
+        if difference in ('no_parent', 'duplicate', 'not_in_logainm'):
+            difference = None
+        cp_osm_id = self.add_osm('civil_parishes', self.osm_name(name_en, difference), cp_logainm_id, tagged, bar_osm_id=bar_osm_id)
+
+        used = set()
+        num_townlands = self.random.randint(1, 2 * TOWNLANDS_PER_PARISH - 1)
+        for k in range(num_townlands):
+            name_en, name_ga = self.make_name(used)
+            td_logainm_id = self.add_logainm(u"BF", name_en, name_ga, [cp_logainm_id, bar_logainm_id, co_logainm_id], northern_ireland)
+            tagged = self.random.random() < self.tagged_fraction
+            difference = None if tagged else self.difference()
+
+            if difference == 'duplicate':
+                self.add_logainm(u"BF", name_en, name_ga + u" 2", [cp_logainm_id, bar_logainm_id, co_logainm_id], northern_ireland)
+            elif difference == 'not_in_logainm':
+                name_en = self.make_name(used)[0]
+
+            parents = dict(co_osm_id=co_osm_id, bar_osm_id=bar_osm_id, cp_osm_id=cp_osm_id)
+            if difference == 'no_parent':
+                parents = dict(co_osm_id=co_osm_id)
+            self.add_osm('townlands', self.osm_name(name_en, difference), td_logainm_id, tagged, **parents)
+
+
+def without_fadas(name):
+    return u"".join(c for c in unicodedata.normalize('NFKD', name) if not unicodedata.combining(c))
+
+def write_sqlite(generator, filename):
+    if os.path.exists(filename):
+        os.remove(filename)
+    conn = sqlite3.connect(filename)
+    # The same tables, types & indexes as build_logainm_db.py makes from the
+    # logainm CSVs
+    for table, columns in [('names', NAMES_COLUMNS), ('geometric_contains', CONTAINS_COLUMNS), ('categories', CATEGORIES_COLUMNS)]:
+        build_logainm_db.create_table(conn, table, columns)
+
+    build_logainm_db.insert_rows(conn, 'names', NAMES_COLUMNS, (
+        (unicode(logainm_id), category, u"http://www.logainm.ie/en/{}".format(logainm_id),
+         u"http://www.placenamesni.org/resultdetails.php?entry={}".format(logainm_id) if northern_ireland else u"",
+         name_en, name_ga, u"")
+        for logainm_id, category, name_en, name_ga, northern_ireland in generator.names))
+    build_logainm_db.insert_rows(conn, 'geometric_contains', CONTAINS_COLUMNS, ((unicode(o), unicode(i)) for o, i in generator.contains))
+    build_logainm_db.insert_rows(conn, 'categories', CATEGORIES_COLUMNS, CATEGORIES)
+    conn.commit()
+
+    build_logainm_db.finish_db(conn)
+    conn.close()
+
+def write_csvs(generator, output_dir):
+    def osm_id(value):
+        # townlands.ie uses negative ids for relations
+        return "" if value is None else "-{}".format(value)
+
+    for level, objs in generator.osm.items():
+        with open(os.path.join(output_dir, "{}-no-geom.csv".format(level)), 'w') as fp:
+            writer = csv.writer(fp)
+            writer.writerow(CSV_HEADER)
+            for obj in objs:
+                writer.writerow([osm_id(obj['osm_id']), obj['name'].encode("utf-8"), "",
+                                 "" if obj['logainm_ref'] is None else str(obj['logainm_ref']),
+                                 osm_id(obj['co_osm_id']), osm_id(obj['bar_osm_id']), osm_id(obj['cp_osm_id']), "1"])
+
+OSM_LEVEL_TAGS = {
+    'counties': [(u"admin_level", u"6"), (u"boundary", u"administrative")],
+    'baronies': [(u"boundary", u"barony")],
+    'civil_parishes': [(u"boundary", u"civil_parish")],
+    'townlands': [(u"admin_level", u"10"), (u"boundary", u"administrative")],
+}
+
+def write_osm_xml(generator, filename):
+    with open(filename, 'w') as fp:
+        fp.write("<?xml version='1.0' encoding='UTF-8'?>\n<osm version=\"0.6\" generator=\"make_synthetic_data.py\">\n")
+        for level in ['counties', 'baronies', 'civil_parishes', 'townlands']:
+            for obj in generator.osm[level]:
+                tags = OSM_LEVEL_TAGS[level] + [(u"name", obj['name'])]
+                if obj['name_ga'] is not None:
+                    tags.append((u"name:ga", obj['name_ga']))
+                if obj['logainm_ref'] is not None:
+                    tags.append((u"logainm:ref", unicode(obj['logainm_ref'])))
+                lines = [u'  <relation id="{}" version="1" timestamp="2016-01-01T00:00:00Z" uid="1" user="synthetic" changeset="1">'.format(obj['osm_id']),
+                         u'    <member type="way" ref="{}" role="outer"/>'.format(obj['osm_id'])]
+                lines.extend(u'    <tag k={} v={}/>'.format(quoteattr(k), quoteattr(v)) for k, v in tags)
+                lines.append(u'  </relation>\n')
+                fp.write(u"\n".join(lines).encode("utf-8"))
+        fp.write("</osm>\n")
+
+
+def main(args=None):
+    args = args or sys.argv[1:]
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--scale", type=float, default=1.0, help="1 is about the size of Ireland (default: %(default)s)")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--tagged-fraction", type=float, default=0.3, help="Fraction of civil parishes & townlands which already have a logainm:ref (default: %(default)s)")
+    parser.add_argument("-o", "--output-dir", default=".")
+    parser.add_argument("-v", "--verbose", action="store_true")
+
+    args = parser.parse_args(args)
+
+    ch = logging.StreamHandler(sys.stdout)
+    if args.verbose:
+        ch.setLevel(logging.DEBUG)
+    else:
+        ch.setLevel(logging.INFO)
+    formatter = logging.Formatter('%(asctime)s\t%(levelname)s\tL%(lineno)s\t%(message)s')
+    ch.setFormatter(formatter)
+    logger.addHandler(ch)
+    logger.setLevel(logging.DEBUG)
+
+    if not os.path.isdir(args.output_dir):
+        os.makedirs(args.output_dir)
+
+    generator = Generator(args.scale, args.seed, args.tagged_fraction)
+    with printer("generating data at scale {}".format(args.scale)):
+        generator.generate()
+    logger.info("%d logainm objects, %d townlands", len(generator.names), len(generator.osm['townlands']))
+
+    with printer("writing logainm.sqlite"):
+        write_sqlite(generator, os.path.join(args.output_dir, "logainm.sqlite"))
+    with printer("writing CSVs"):
+        write_csvs(generator, args.output_dir)
+    with printer("writing boundaries.osm.xml"):
+        write_osm_xml(generator, os.path.join(args.output_dir, "boundaries.osm.xml"))
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -1,22 +1,26 @@
 import sys
 import logging
-from contextlib import contextmanager
 import csv
-import sqlite3
 import xml.etree.ElementTree as ET
 import argparse
 from collections import defaultdict
 import re
+import multiprocessing
+import unicodedata
+import json
+import os
+import marshal
+import hashlib
+
+import instrumentation
+import osm_output
+import logainm_closure
+import logainm_store
 
 
 logger = logging.getLogger(__name__)
 
-@contextmanager
-def printer(msg):
-    msg = msg.strip()
-    logging.info("Started "+msg)
-    yield
-    logging.info("Finished "+msg)
+printer = instrumentation.make_printer(logger)
 
 def get_existing_osm_tags(xml_el):
     """Given a XML element for an object, return (as dict) the current OSM tags"""
@@ -58,15 +62,254 @@ def logainm_tags(xml_el, logainm_data):
 
     return new_tags
 
+def connect_logainm_db(read_only=False):
+    return logainm_store.connect(read_only=read_only)
+
+LOGAINM_TAGS_SQL = "select logainm_id, name_en, name_ga from names where logainm_id = ?"
+
 def get_logainm_tags(cursor, logainm_id):
-    cursor.execute("select logainm_id, name_en, name_ga from names where logainm_id = ?", [logainm_id])
+    instrumentation.count('sql_queries')
+    cursor.execute(LOGAINM_TAGS_SQL, [logainm_id])
     data = cursor.fetchone()
     return {'logainm_id': data[0], 'name_en': data[1], 'name_ga': data[2]}
 
-def unicodeify_dict(dct):
-    for key, value in dct.items():
-        dct[key] = value.decode("utf-8")
-    return dct
+# Table of name_key(name_en) for each logainm name, made by build_logainm_db.py.
+# The version is in the name, so an old logainm.sqlite isn't used if name_key
+# (or the table) changes.
+NAME_KEYS_TABLE = "name_keys_v2"
+
+# The objects anywhere in a parent with a name_key, and all of them (for the
+# fuzzy matching). build_logainm_db.py shows their query plans.
+FIND_LOGAINM_OBJS_SQL = "select obj.logainm_id, obj.name_en from logainm_closure as con join names as obj on (obj.logainm_id = con.descendant_id) join {} as k on (k.logainm_id = obj.logainm_id) where con.ancestor_id = :parent_logainm_id and con.ancestor_category_code = :parent_logainm_code and con.descendant_category_code = :obj_logainm_code and k.name_key = :name_key;".format(NAME_KEYS_TABLE)
+FUZZY_CANDIDATES_SQL = "select obj.logainm_id, obj.name_en, obj.name_ga from logainm_closure as con join names as obj on (obj.logainm_id = con.descendant_id) where con.ancestor_id = :parent_logainm_id and con.ancestor_category_code = :parent_logainm_code and con.descendant_category_code = :obj_logainm_code;"
+
+def build_name_keys(conn):
+    """(Re)create the NAME_KEYS_TABLE in the logainm database"""
+    cursor = conn.cursor()
+    cursor.execute("drop table if exists {}".format(NAME_KEYS_TABLE))
+    cursor.execute("select logainm_id, name_en from names where name_en is not null and name_en != ''")
+    rows = [(logainm_id, name_key(name)) for logainm_id, name in cursor.fetchall()]
+    # The same type as names.logainm_id, so the index can be used when joining
+    cursor.execute("create table {0} (logainm_id {1}, name_key TEXT)".format(NAME_KEYS_TABLE, logainm_closure.id_type(conn, 'names', 'logainm_id')))
+    cursor.executemany("insert into {0} (logainm_id, name_key) values (?, ?)".format(NAME_KEYS_TABLE), rows)
+    cursor.execute("create index {0}__logainm_id_name_key on {0}(logainm_id, name_key)".format(NAME_KEYS_TABLE))
+    conn.commit()
+
+def find_logainm_objs(cursor, parent_logainm_code, obj_logainm_code, parent_logainm_id, key):
+    """Returns (logainm_id, name_en) of all the objects anywhere in this
+    parent whose name has this name_key"""
+    instrumentation.count('sql_queries')
+    cursor.execute(FIND_LOGAINM_OBJS_SQL, {'parent_logainm_code': parent_logainm_code, 'obj_logainm_code': obj_logainm_code, 'parent_logainm_id': parent_logainm_id, 'name_key': key})
+    return cursor.fetchall()
+
+
+class SQLMatcher(object):
+    """Looks up logainm objects with one SQL query per lookup"""
+
+    def __init__(self, cursor):
+        self.cursor = cursor
+        logainm_store.require_table(cursor.connection, NAME_KEYS_TABLE)
+        logainm_closure.require_closure(cursor.connection)
+
+    def reconnect(self, cursor):
+        """Use this cursor from now on (e.g. in a new process)"""
+        self.cursor = cursor
+
+    def prepare(self, parent_logainm_code, obj_logainm_code, lookups, logainm_ids):
+        """Called before each level with all the (parent_logainm_id, name_key)
+        lookups, and logainm ids that might be needed. Nothing to do here."""
+        pass
+
+    def find(self, parent_logainm_code, obj_logainm_code, parent_logainm_id, key):
+        """Returns (logainm_id, name_en) of the objects in this parent whose
+        name has this name_key"""
+        return find_logainm_objs(self.cursor, parent_logainm_code, obj_logainm_code, parent_logainm_id, key)
+
+    def tags(self, logainm_id):
+        return get_logainm_tags(self.cursor, logainm_id)
+
+
+class BatchSQLMatcher(SQLMatcher):
+    """Looks up all the logainm objects for a level at once. The lookups are
+    loaded into a temporary table, and resolved with one join, so the number
+    of queries doesn't depend on the number of objects."""
+
+    def __init__(self, cursor):
+        super(BatchSQLMatcher, self).__init__(cursor)
+        self.create_temp_tables()
+        self.found = {}
+        self.found_tags = {}
+
+    def create_temp_tables(self):
+        # The lookups are written to temp tables, which query_only (a read
+        # only connection on Python 2) would stop too
+        self.cursor.execute("pragma query_only = 0")
+        self.cursor.execute("create temp table if not exists match_lookups (parent_logainm_id, name_key)")
+        self.cursor.execute("create temp table if not exists tag_lookups (logainm_id)")
+
+    def reconnect(self, cursor):
+        super(BatchSQLMatcher, self).reconnect(cursor)
+        self.create_temp_tables()
+
+    def prepare(self, parent_logainm_code, obj_logainm_code, lookups, logainm_ids):
+        self.found = defaultdict(list)
+        self.found_tags = {}
+        instrumentation.count('sql_queries', 2)
+
+        self.cursor.execute("delete from match_lookups")
+        self.cursor.executemany("insert into match_lookups (parent_logainm_id, name_key) values (?, ?)", lookups)
+        self.cursor.execute("select l.parent_logainm_id, l.name_key, obj.logainm_id, obj.name_en, obj.name_ga from match_lookups as l join logainm_closure as con on (con.ancestor_id = l.parent_logainm_id) join names as obj on (obj.logainm_id = con.descendant_id) join {} as k on (k.logainm_id = obj.logainm_id) where con.ancestor_category_code = :parent_logainm_code and con.descendant_category_code = :obj_logainm_code and k.name_key = l.name_key;".format(NAME_KEYS_TABLE), {'parent_logainm_code': parent_logainm_code, 'obj_logainm_code': obj_logainm_code})
+        for parent_logainm_id, key, logainm_id, name_en, name_ga in self.cursor:
+            self.found[(parent_logainm_id, key)].append((logainm_id, name_en))
+            self.found_tags[logainm_id] = {'logainm_id': logainm_id, 'name_en': name_en, 'name_ga': name_ga}
+
+        self.cursor.execute("delete from tag_lookups")
+        self.cursor.executemany("insert into tag_lookups (logainm_id) values (?)", ([x] for x in logainm_ids))
+        self.cursor.execute("select l.logainm_id, names.logainm_id, names.name_en, names.name_ga from tag_lookups as l join names on (names.logainm_id = l.logainm_id);")
+        for requested_id, logainm_id, name_en, name_ga in self.cursor:
+            self.found_tags[requested_id] = {'logainm_id': logainm_id, 'name_en': name_en, 'name_ga': name_ga}
+
+    def find(self, parent_logainm_code, obj_logainm_code, parent_logainm_id, key):
+        instrumentation.count('cache_hits')
+        return self.found.get((parent_logainm_id, key), [])
+
+    def tags(self, logainm_id):
+        instrumentation.count('cache_hits')
+        return self.found_tags[logainm_id]
+
+def logainm_id_key(logainm_id):
+    """Logainm ids are numeric, but can be stored as text, so use ints where
+    possible to keep the in memory index small"""
+    try:
+        return int(logainm_id)
+    except (TypeError, ValueError):
+        return logainm_id
+
+
+class MemoryMatcher(object):
+    """Loads the logainm names and hierarchy into memory once, so each lookup
+    is a dict lookup rather than a SQL query.
+
+    names is logainm_id -> (category_code, name_en, name_ga), and children is
+    (parent logainm_id, child category_code, name_key(child name_en)) -> tuple
+    of the logainm_ids anywhere in that parent. Ids are stored as ints, and repeated strings are
+    only stored once."""
+
+    def __init__(self, cursor):
+        logainm_closure.require_closure(cursor.connection)
+        strings = {}
+        def intern_str(s):
+            return strings.setdefault(s, s)
+
+        self.names = {}
+        instrumentation.count('sql_queries', 2)
+        cursor.execute("select logainm_id, logainm_category_code, name_en, name_ga from names")
+        for logainm_id, category_code, name_en, name_ga in cursor:
+            self.names[logainm_id_key(logainm_id)] = (intern_str(category_code), intern_str(name_en), intern_str(name_ga))
+
+        keys = {}
+        children = defaultdict(tuple)
+        cursor.execute("select ancestor_id, descendant_id from logainm_closure")
+        for outer_obj_id, inner_obj_id in cursor:
+            inner_obj_id = logainm_id_key(inner_obj_id)
+            inner = self.names.get(inner_obj_id)
+            if inner is None or inner[1] in (None, ''):
+                continue
+            if inner_obj_id not in keys:
+                keys[inner_obj_id] = intern_str(name_key(inner[1]))
+            children[(logainm_id_key(outer_obj_id), inner[0], keys[inner_obj_id])] += (inner_obj_id,)
+        self.children = dict(children)
+
+        logger.info("Loaded %d logainm names and %d (parent, category, name) keys into memory", len(self.names), len(self.children))
+
+    def reconnect(self, cursor):
+        # Everything is in memory already
+        pass
+
+    def prepare(self, parent_logainm_code, obj_logainm_code, lookups, logainm_ids):
+        pass
+
+    def find(self, parent_logainm_code, obj_logainm_code, parent_logainm_id, key):
+        instrumentation.count('cache_hits')
+        parent_logainm_id = logainm_id_key(parent_logainm_id)
+        parent = self.names.get(parent_logainm_id)
+        if parent is None or parent[0] != parent_logainm_code:
+            return []
+        return [(logainm_id, self.names[logainm_id][1]) for logainm_id in self.children.get((parent_logainm_id, obj_logainm_code, key), ())]
+
+    def tags(self, logainm_id):
+        instrumentation.count('cache_hits')
+        logainm_id = logainm_id_key(logainm_id)
+        category_code, name_en, name_ga = self.names[logainm_id]
+        return {'logainm_id': logainm_id, 'name_en': name_en, 'name_ga': name_ga}
+
+MATCHERS = {
+    'sql': SQLMatcher,
+    'batch': BatchSQLMatcher,
+    'memory': MemoryMatcher,
+}
+
+class CSVRecord(object):
+    """One row of a townlands.ie CSV file, with only the columns the matcher
+    uses. OSM ids are stored as ints (None for empty), but can be accessed
+    like the csv.DictReader row, e.g. obj['OSM_ID'] returns '-1234'."""
+
+    OSM_ID_COLUMNS = {'OSM_ID': 'osm_id', 'CO_OSM_ID': 'co_osm_id', 'BAR_OSM_ID': 'bar_osm_id', 'CP_OSM_ID': 'cp_osm_id'}
+    TEXT_COLUMNS = {'LOGAINM_RE': 'logainm_ref', 'NAME_EN': 'name_en', 'NAME_TAG': 'name_tag'}
+
+    __slots__ = tuple(sorted(OSM_ID_COLUMNS.values())) + tuple(sorted(TEXT_COLUMNS.values()))
+
+    def __getitem__(self, key):
+        if key in self.OSM_ID_COLUMNS:
+            value = getattr(self, self.OSM_ID_COLUMNS[key])
+            return '' if value is None else str(value)
+        return getattr(self, self.TEXT_COLUMNS[key])
+
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+    def values(self):
+        """The values of this record, as a tuple in __slots__ order"""
+        return tuple(getattr(self, attr) for attr in self.__slots__)
+
+    @classmethod
+    def from_values(cls, values):
+        record = cls()
+        # Unrolled (rather than setattr in a loop), since it's done for every
+        # record when loading a snapshot
+        (record.bar_osm_id, record.co_osm_id, record.cp_osm_id, record.osm_id, record.logainm_ref, record.name_en, record.name_tag) = values
+        return record
+
+def read_csv_records(filename, strings):
+    """Read the columns the matcher needs from this CSV file, as a list of
+    CSVRecords. Text values are decoded, and the same string is only stored
+    once (strings is the dict used for that)."""
+    records = []
+    with open(filename) as fp:
+        reader = csv.reader(fp)
+        header = next(reader)
+        columns = [(CSVRecord.OSM_ID_COLUMNS.get(name) or CSVRecord.TEXT_COLUMNS.get(name), i, name in CSVRecord.OSM_ID_COLUMNS) for i, name in enumerate(header)]
+        columns = [(attr, i, is_osm_id) for attr, i, is_osm_id in columns if attr is not None]
+        missing = set(CSVRecord.__slots__) - set(attr for attr, i, is_osm_id in columns)
+
+        for row in reader:
+            record = CSVRecord()
+            for attr, i, is_osm_id in columns:
+                value = row[i]
+                if is_osm_id:
+                    value = int(value) if value != '' else None
+                else:
+                    value = value.decode("utf-8")
+                    value = strings.setdefault(value, value)
+                setattr(record, attr, value)
+            for attr in missing:
+                setattr(record, attr, None if attr in CSVRecord.OSM_ID_COLUMNS.values() else u'')
+            records.append(record)
+
+    return records
 
 def name_en(obj):
     if obj['NAME_EN'] != '':
@@ -74,26 +317,185 @@ def name_en(obj):
     else:
         return obj['NAME_TAG']
 
-def read_logainm_data():
+def osm_relations(elements):
+    """Yield (osm_id, tags) for every relation in these XML elements (e.g. the
+    <osm> root)"""
+    for el in elements:
+        if el.tag == 'relation':
+            yield el.get("id", None), get_existing_osm_tags(el)
+
+def osm_relations_from_xml(filename):
+    """Yield (osm_id, tags) for every relation in this OSM XML file, reading
+    it incrementally"""
+    return osm_relations(stream_osm_elements(filename))
+
+class ParentIndexes(object):
+    """The parent OSM ids of OSM objects, based on what townlands they
+    contain. get('CP_OSM_ID', 'BAR_OSM_ID') returns a dict of civil parish
+    OSM id -> set of barony OSM ids. Each index is only built (with one pass
+    over the townlands) the first time it's needed."""
+
+    def __init__(self, townlands, indexes=None):
+        self.townlands = townlands
+        self.indexes = indexes or {}
+
+    def get(self, obj_key, parent_key):
+        if (obj_key, parent_key) not in self.indexes:
+            self.indexes[(obj_key, parent_key)] = self.build(obj_key, parent_key)
+        return self.indexes[(obj_key, parent_key)]
+
+    def build(self, obj_key, parent_key):
+        obj_attr = CSVRecord.OSM_ID_COLUMNS[obj_key]
+        parent_attr = CSVRecord.OSM_ID_COLUMNS[parent_key]
+        index = defaultdict(set)
+        with instrumentation.stage("building index of {} for {}".format(parent_key, obj_key)) as stage:
+            for obj_osm_id, parent_osm_id in ((getattr(t, obj_attr), getattr(t, parent_attr)) for t in self.townlands):
+                if parent_osm_id is not None:
+                    index['' if obj_osm_id is None else str(obj_osm_id)].add(str(parent_osm_id))
+            stage.objects = len(index)
+        logger.debug("Built index of %s for %s (%d objects)", parent_key, obj_key, len(index))
+        return index
+
+LOGAINM_DATA_CSVS = [('townlands-no-geom.csv', 'townlands'), ('civil_parishes-no-geom.csv', 'civil_parishes'), ('counties-no-geom.csv', 'counties'), ('baronies-no-geom.csv', 'baronies')]
+
+def file_fingerprint(filename, previous=None):
+    """(size, mtime, sha1) of this file. The file is only hashed again if
+    the size or mtime are different from the previous fingerprint"""
+    stat = os.stat(filename)
+    if previous is not None and tuple(previous[:2]) == (stat.st_size, stat.st_mtime):
+        return tuple(previous)
+    sha1 = hashlib.sha1()
+    with open(filename, 'rb') as fp:
+        for block in iter(lambda: fp.read(1024 * 1024), b''):
+            sha1.update(block)
+    return (stat.st_size, stat.st_mtime, sha1.hexdigest())
+
+def write_marshal(filename, objects):
+    """marshal these objects, one after the other, to this file. It's
+    written to a temporary file, then renamed."""
+    directory = os.path.dirname(filename)
+    if directory and not os.path.isdir(directory):
+        os.makedirs(directory)
+    tmp_filename = "{}.{}.tmp".format(filename, os.getpid())
+    with open(tmp_filename, 'wb') as fp:
+        for obj in objects:
+            marshal.dump(obj, fp)
+    os.rename(tmp_filename, filename)
+
+def fingerprint_files(filenames, cache_dir):
+    """filename -> file_fingerprint of each of these files. The last
+    fingerprints are kept in the cache_dir, so a file is only hashed again if
+    it's changed."""
+    fingerprints_filename = os.path.join(cache_dir, "fingerprints.marshal")
+    try:
+        with open(fingerprints_filename, 'rb') as fp:
+            previous = marshal.load(fp)
+    except (IOError, EOFError, ValueError, TypeError):
+        previous = {}
+    if not isinstance(previous, dict):
+        previous = {}
+    fingerprints = {f: file_fingerprint(f, previous.get(f)) for f in filenames}
+    if any(previous.get(f) != fingerprints[f] for f in filenames):
+        previous.update(fingerprints)
+        write_marshal(fingerprints_filename, [previous])
+    return fingerprints
+
+def source_hash(filenames):
+    """sha1 of these source files (in the same directory as this one), so
+    what one version of the code saved isn't used by another"""
+    sha1 = hashlib.sha1()
+    for filename in filenames:
+        with open(os.path.join(os.path.dirname(os.path.abspath(__file__)), filename), 'rb') as fp:
+            sha1.update(fp.read())
+    return sha1.hexdigest()
+
+def snapshot_filename(cache_dir):
+    return os.path.join(cache_dir, "logainm-data.marshal")
+
+def snapshot_header(fingerprints):
+    # The snapshot is made by the code in match.py, and marshal's format can
+    # change between Python versions
+    return (source_hash(["match.py"]), tuple(sys.version_info[:2]), fingerprints)
+
+def same_files(fingerprints, other_fingerprints):
+    """Whether these have the same size & hash for the same files, the mtime
+    doesn't matter"""
+    return {f: (fp[0], fp[2]) for f, fp in fingerprints.items()} == {f: (fp[0], fp[2]) for f, fp in other_fingerprints.items()}
+
+def load_logainm_data_snapshot(filename, fingerprints):
+    """The logainm_data in the snapshot, or None if there isn't one, or any
+    of the input files (with these fingerprints) changed since it was
+    saved."""
+    try:
+        with open(filename, 'rb') as fp:
+            header = marshal.load(fp)
+            if not (isinstance(header, tuple) and len(header) == 3 and isinstance(header[2], dict)):
+                raise ValueError("bad header")
+            if header[:2] != snapshot_header(fingerprints)[:2]:
+                logger.info("match.py changed since the snapshot %s was saved", filename)
+                return None
+            if not same_files(header[2], fingerprints):
+                logger.info("Input files changed since the snapshot %s was saved", filename)
+                return None
+            data = marshal.load(fp)
+    except IOError:
+        return None
+    except (EOFError, ValueError, TypeError):
+        logger.warning("Ignoring invalid snapshot %s", filename)
+        return None
+
     results = {}
-    data_to_load = [('townlands-no-geom.csv', 'townlands'), ('civil_parishes-no-geom.csv', 'civil_parishes'), ('counties-no-geom.csv', 'counties'), ('baronies-no-geom.csv', 'baronies')]
+    for keyname, records in data['records'].items():
+        results[keyname] = [CSVRecord.from_values(values) for values in records]
+    results['index'] = {
+        'parents': ParentIndexes(results['townlands'], data['parents']),
+        'osmid_to_logainm_ref': data['osmid_to_logainm_ref'],
+    }
+    results['liveosmdata'] = data['liveosmdata']
+    return results
+
+def save_logainm_data_snapshot(filename, fingerprints, logainm_data):
+    """Save this logainm_data, with the parent indexes for all the LEVELS,
+    as only builtin types, with marshal, which is much quicker to load than
+    pickle. It's written to a temporary file, then renamed."""
+    parents = logainm_data['index']['parents']
+    for level in LEVELS.values():
+        parents.get(level['obj_key'], level['parent_key'])
+    data = {
+        'records': {keyname: [record.values() for record in logainm_data[keyname]] for filename, keyname in LOGAINM_DATA_CSVS},
+        'parents': {key: dict(index) for key, index in parents.indexes.items()},
+        'osmid_to_logainm_ref': logainm_data['index']['osmid_to_logainm_ref'],
+        'liveosmdata': logainm_data['liveosmdata'],
+    }
+    write_marshal(filename, [snapshot_header(fingerprints), data])
+
+def read_logainm_data(osm_relations=None, osm_filename="boundaries.osm.xml", cache_dir=None):
+    """Load the townlands.ie CSVs, and the current OSM data. osm_relations is
+    an iterable of (osm_id, tags) for the relations currently in OSM,
+    defaulting to those in osm_filename.
+
+    With a cache_dir, it's all saved to a snapshot there, which is loaded
+    instead next time, if the CSVs & osm_filename haven't changed. So
+    osm_relations must be from osm_filename."""
+    snapshot = None
+    if cache_dir is not None:
+        snapshot = snapshot_filename(cache_dir)
+        with instrumentation.stage("loading logainm data snapshot"):
+            fingerprints = fingerprint_files([filename for filename, keyname in LOGAINM_DATA_CSVS] + [osm_filename], cache_dir)
+            results = load_logainm_data_snapshot(snapshot, fingerprints)
+        if results is not None:
+            logger.info("Loaded logainm data from snapshot %s", snapshot)
+            return results
+
+    results = {}
+    data_to_load = LOGAINM_DATA_CSVS
+    strings = {}
     for filename, keyname in data_to_load:
-        with open(filename) as fp:
-            reader = csv.DictReader(fp)
-            results[keyname] = list(unicodeify_dict(x) for x in reader)
+        results[keyname] = read_csv_records(filename, strings)
 
     # create a dict
     results['index'] = {}
-    for obj_key in  ['OSM_ID', 'BAR_OSM_ID', 'CP_OSM_ID']:
-        results['index'][obj_key] = {}
-        for parent_key in  ['BAR_OSM_ID', 'CP_OSM_ID', 'CO_OSM_ID']:
-            results['index'][obj_key][parent_key] = defaultdict(set)
-
-    for t in results['townlands']:
-        for obj_key in  ['OSM_ID', 'BAR_OSM_ID', 'CP_OSM_ID']:
-            for parent_key in  ['BAR_OSM_ID', 'CP_OSM_ID', 'CO_OSM_ID']:
-                if t[parent_key] != '':
-                    results['index'][obj_key][parent_key][t[obj_key]].add(t[parent_key])
+    results['index']['parents'] = ParentIndexes(results['townlands'])
 
     results['index']['osmid_to_logainm_ref'] = {}
     for filename, keyname in data_to_load:
@@ -102,18 +504,20 @@ def read_logainm_data():
                 results['index']['osmid_to_logainm_ref'][x['OSM_ID']] = x['LOGAINM_RE']
 
     # load existing osm data
-    tree = ET.parse("boundaries.osm.xml")
-    root = tree.getroot()
+    if osm_relations is None:
+        osm_relations = osm_relations_from_xml(osm_filename)
 
-    # add new tags to OSM XML
     results['liveosmdata'] = {}
-    for rel in root.findall("relation"):
-        osm_id = "-"+rel.get("id", None)
-        tags = get_existing_osm_tags(rel)
+    for osm_id, tags in osm_relations:
+        osm_id = "-"+osm_id
         if 'logainm:ref' in tags:
             results['index']['osmid_to_logainm_ref'][osm_id] = tags['logainm:ref']
             results['liveosmdata'][osm_id] = True
 
+    if snapshot is not None:
+        with instrumentation.stage("saving logainm data snapshot"):
+            save_logainm_data_snapshot(snapshot, fingerprints, results)
+        logger.info("Saved logainm data to snapshot %s", snapshot)
 
     return results
 
@@ -128,126 +532,615 @@ def osmid_to_logainm_ref(logainm_data, osm_id, existing_match_ups):
     return result
 
 def barony_osmid_for_civil_parish_osmid(logainm_data, civil_parish_id):
-    return set(t['BAR_OSM_ID'] for t in logainm_data['townlands'] if t['CP_OSM_ID'] == civil_parish_id and t['BAR_OSM_ID'] != '' )
+    return parent_osmid_for_obj_osmid(logainm_data, civil_parish_id, 'CP_OSM_ID', 'BAR_OSM_ID')
 
 def parent_osmid_for_obj_osmid(logainm_data, obj_osmid, obj_key, parent_key):
-    result = logainm_data['index'][obj_key][parent_key][obj_osmid]
+    # copy, so the caller can change it
+    result = set(logainm_data['index']['parents'].get(obj_key, parent_key).get(obj_osmid, ()))
     return result
 
-def baronies_matchup(logainm_data, cursor, existing_match_ups):
-    return hierachial_matchup(logainm_data, cursor,
-                key='baronies', obj_logainm_code="BAR", parent_logainm_code='CON',
-                obj_key="BAR_OSM_ID", parent_key="CO_OSM_ID", parent_name="county",
-                existing_match_ups=existing_match_ups,
-         )
-
-def civil_parish_matchup(logainm_data, cursor, existing_match_ups):
-    return hierachial_matchup(logainm_data, cursor,
-                key='civil_parishes', obj_logainm_code="PAR", parent_logainm_code='BAR',
-                obj_key="CP_OSM_ID", parent_key="BAR_OSM_ID", parent_name="barony",
-                existing_match_ups=existing_match_ups,
-         )
-
-def townlands_matchup(logainm_data, cursor, existing_match_ups):
-    return hierachial_matchup(logainm_data, cursor,
-                key='townlands', obj_logainm_code="BF", parent_logainm_code='PAR',
-                obj_key="OSM_ID", parent_key="CP_OSM_ID", parent_name="civil parish",
-                existing_match_ups=existing_match_ups,
-         )
-
-def generate_name_options(name):
-    options = {name}
-    for subpart in ["Upper", "Lower", "East", "West", "North", "South"]:
-        options.add(re.sub("^(.*) "+subpart+r"$", subpart+r" \1", name))
-        options.add(re.sub("^"+subpart+" (.*)$", r"\1 "+subpart, name))
+BARONIES = dict(key='baronies', obj_logainm_code="BAR", parent_logainm_code='CON',
+                obj_key="BAR_OSM_ID", parent_key="CO_OSM_ID", parent_name="county")
 
-    options.add(re.sub("^St. (.*)$", r"Saint \1", name))
-    options.add(re.sub("^Saint (.*)$", r"St \1", name))
-    options.add(re.sub("^Saint (.*)$", r"St. \1", name))
+def baronies_matchup(logainm_data, matcher, existing_match_ups, jobs=1, journal=None):
+    return hierachial_matchup(logainm_data, matcher, existing_match_ups=existing_match_ups, jobs=jobs, journal=journal, **BARONIES)
 
-    options = list(options)
+CIVIL_PARISHES = dict(key='civil_parishes', obj_logainm_code="PAR", parent_logainm_code='BAR',
+                obj_key="CP_OSM_ID", parent_key="BAR_OSM_ID", parent_name="barony")
 
-    if len(options) > 1:
-        logger.info("Got name options %(name)s: %(options)r", {'name':name, 'options':options})
-    return options
+def civil_parish_matchup(logainm_data, matcher, existing_match_ups, jobs=1, journal=None):
+    return hierachial_matchup(logainm_data, matcher, existing_match_ups=existing_match_ups, jobs=jobs, journal=journal, **CIVIL_PARISHES)
+
+TOWNLANDS = dict(key='townlands', obj_logainm_code="BF", parent_logainm_code='PAR',
+                obj_key="OSM_ID", parent_key="CP_OSM_ID", parent_name="civil parish")
+
+def townlands_matchup(logainm_data, matcher, existing_match_ups, jobs=1, journal=None):
+    return hierachial_matchup(logainm_data, matcher, existing_match_ups=existing_match_ups, jobs=jobs, journal=journal, **TOWNLANDS)
+
+LEVELS = {level['key']: level for level in [BARONIES, CIVIL_PARISHES, TOWNLANDS]}
 
-def find_osm_obj_based_on_logainm(cursor, parent_logainm_code, obj_logainm_code, parent_logainm_id, obj, key, parent_name, parent_osm_id):
+NAME_SUBPARTS = ["Upper", "Lower", "East", "West", "North", "South"]
+
+NAME_OPTION_REGEXES = []
+for subpart in NAME_SUBPARTS:
+    NAME_OPTION_REGEXES.append((re.compile("^(.*) "+subpart+r"$"), subpart+r" \1"))
+    NAME_OPTION_REGEXES.append((re.compile("^"+subpart+" (.*)$"), r"\1 "+subpart))
+NAME_OPTION_REGEXES.append((re.compile("^St. (.*)$"), r"Saint \1"))
+NAME_OPTION_REGEXES.append((re.compile("^Saint (.*)$"), r"St \1"))
+NAME_OPTION_REGEXES.append((re.compile("^Saint (.*)$"), r"St. \1"))
+
+def name_options(name):
+    options = {name}
+    for regex, replacement in NAME_OPTION_REGEXES:
+        options.add(regex.sub(replacement, name))
+
+    return list(options)
+
+_lower_subparts = set(subpart.lower() for subpart in NAME_SUBPARTS)
+
+def name_key(name):
+    """Normalised version of this name, which is the same for all the
+    name_options of a name. It's lower case, with whitespace collapsed,
+    leading Upper/Lower/compass words moved to the end, and St/St./Saint at
+    the start all as 'st'. Different names can have the same key, so it's
+    only for finding candidates."""
+    words = name.lower().split()
+    if all(word in _lower_subparts for word in words):
+        # e.g. "North East", any order will do
+        return " ".join(sorted(words))
+
+    while words[0] in _lower_subparts:
+        words = words[1:] + words[:1]
+    # name_options treats any 3 letter word starting with "St" as "St."
+    if words[0] == 'saint' or (len(words[0]) == 3 and words[0].startswith('st')):
+        words[0] = 'st'
+    return " ".join(words)
+
+def find_osm_obj_based_on_logainm(matcher, parent_logainm_code, obj_logainm_code, parent_logainm_id, obj):
+    """Returns (logainm id or None, [logainm ids of names with >1 object])"""
     # Now we have the logainm ref of the parent that this obj is in.
-    # Look at the logainm data for the objs in that obj
-    for name in generate_name_options(name_en(obj)):
-        cursor.execute("select obj.logainm_id from names as parent join geometric_contains as con on (parent.logainm_id = con.outer_obj_id) join names as obj on (obj.logainm_id = con.inner_obj_id) where parent.logainm_category_code = :parent_logainm_code and obj.logainm_category_code = :obj_logainm_code and parent.logainm_id = :parent_logainm_id and obj.name_en = :name;", {'parent_logainm_code': parent_logainm_code, 'obj_logainm_code': obj_logainm_code, 'parent_logainm_id': parent_logainm_id, 'name': name})
-        data = cursor.fetchall()
-        data_str = ", ".join(str(x[0]) for x in data)
+    # Look at the logainm data for the objs in that obj. All the name options
+    # have the same name_key, so one lookup gets the candidates for all of them
+    candidates = matcher.find(parent_logainm_code, obj_logainm_code, parent_logainm_id, name_key(name_en(obj)))
+    ambiguous = []
+    for name in name_options(name_en(obj)):
+        data = [logainm_id for logainm_id, candidate_name in candidates if candidate_name == name]
         if len(data) == 0:
             # No match, try other option
             continue
         elif len(data) > 1:
-            logger.error("ERROR %s %s (%s) is in %s OSM:%s (logainm:%s) has >1 %s in logainm for this name: %s", key, name_en(obj), obj['OSM_ID'], parent_name, parent_osm_id, parent_logainm_id, key, data_str)
+            ambiguous.extend(data)
             continue
         elif len(data) == 1:
-            logger.info("OK %(key)s %(name)s (%(osmid)s) is in %(parent_name)s OSM:%(parent_osmid)s (logainm:%(parent_osmid)s) has 1 %(key)s in logainm for this name: %(parent_logainm)s", dict(key=key, name=name_en(obj), osmid=obj['OSM_ID'], parent_name=parent_name, parent_osmid=parent_osm_id, parent_logainm=parent_logainm_id))
-            # remove leading '-' character
-            return data[0][0]
+            return data[0], ambiguous
         else:
             assert False
 
-    logger.error("ERROR %s %s (%s) is in %s OSM:%s (logainm:%s) http://www.townlands.ie/by/osm_id/%s/ which has no %s in logainm for this name", key, name_en(obj), obj['OSM_ID'], parent_name, parent_osm_id, parent_logainm_id, obj['OSM_ID'], key)
-    return None
+    return None, ambiguous
+
+
+# What happened each object, in the match journal
+IN_OSM = 'in_osm'
+NO_PARENT = 'no_parent'
+MANY_PARENTS = 'many_parents'
+PARENT_MANY_LOGAINM = 'parent_many_logainm'
+PARENT_NO_LOGAINM = 'parent_no_logainm'
+MATCHED = 'matched'
+NOT_FOUND = 'not_found'
+
+def journal_record(outcome, key, obj, **fields):
+    """Match journal record for this object. Fields which are None are left
+    out to keep it small."""
+    record = {'outcome': outcome, 'level': key, 'osm_id': obj['OSM_ID'], 'name': name_en(obj)}
+    for field, value in fields.items():
+        if value is None:
+            continue
+        # logainm ids are written as text, whether the database has them as
+        # text or numbers
+        if field in ('logainm_id', 'parent_logainm_id'):
+            value = unicode(value)
+        elif field == 'ambiguous':
+            value = [unicode(logainm_id) for logainm_id in value]
+        record[field] = value
+    return record
+
+class JournalWriter(object):
+    """Writes the match journal records to a file, one JSON object per line"""
+
+    def __init__(self, filename, buffer_size=1024*1024):
+        self.fp = open(filename, 'w', buffer_size)
+
+    def add(self, record):
+        self.fp.write(json.dumps(record, separators=(',', ':'), sort_keys=True))
+        self.fp.write("\n")
+
+    def close(self):
+        self.fp.close()
+
+class ListJournal(object):
+    """Keeps the records in a list, so a worker process can send them back"""
+
+    def __init__(self):
+        self.records = []
+
+    def add(self, record):
+        self.records.append(record)
+
+    def close(self):
+        pass
+
+class RecordingJournal(object):
+    """Adds the records to another journal, and keeps them, so they can be
+    saved in a checkpoint"""
+
+    def __init__(self, journal):
+        self.journal = journal
+        self.records = []
+
+    def add(self, record):
+        self.records.append(record)
+        self.journal.add(record)
+
+    def close(self):
+        pass
+
+class LoggingJournal(object):
+    """Logs each record as it's added, rather than saving it"""
+
+    def __init__(self, log):
+        self.log = log
+
+    def add(self, record):
+        render_journal_record(self.log, record)
+
+    def close(self):
+        pass
+
+def read_journal(filename):
+    with open(filename) as fp:
+        for line in fp:
+            yield json.loads(line)
+
+def render_journal_record(log, record):
+    """Log this match journal record, with the same messages match.py logged
+    before there was a journal"""
+    if record.get('stage', 'match') != 'match':
+        # From another pipeline.py stage
+        log.info("%s %s %s", record['stage'], record['outcome'], " ".join("{}={}".format(k, json.dumps(record[k])) for k in sorted(record) if k not in ('stage', 'outcome')))
+        return
+
+    key, name, osmid = record['level'], record['name'], record['osm_id']
+    parent_name = LEVELS[key]['parent_name']
+    outcome = record['outcome']
+
+    if outcome == IN_OSM:
+        log.info("%(key)s %(name)s (OSM:%(osmid)s) has a logainm:ref in OSM (logainm %(logainm_id)s)", {'key': key, 'name': name, 'osmid': osmid, 'logainm_id': record['logainm_id']})
+        return
+
+    log.debug("Starting to look at %s %s (osm:%s)", key, name, osmid)
+    if outcome == NO_PARENT:
+        log.error("ERROR No %s found for %s %s (%s) in OSM: Tie: http://www.townlands.ie/by/osm_id/%s", parent_name, key, name, osmid, osmid)
+        return
+    elif outcome == MANY_PARENTS:
+        log.error("ERROR Found %s (%s) %s for %s %s (osmid=%s) in OSM", len(record['parent_osm_ids']), ",".join(record['parent_osm_ids']), parent_name, key, name, osmid)
+        return
+
+    parent_osm_id = record['parent_osm_ids'][0]
+    parent_logainm_id = record.get('parent_logainm_id')
+    if outcome == PARENT_MANY_LOGAINM:
+        log.error("ERROR %s %s (%s) is in %s %s in OSM which is many logainms: %s Tie: http://www.townlands.ie/by/osm_id/%s", key, name, osmid, parent_name, parent_osm_id, parent_logainm_id, osmid)
+        return
+    elif outcome == PARENT_NO_LOGAINM:
+        log.error("ERROR %s %s (%s) is in %s %s in OSM which has no known logainm", key, name, osmid, parent_name, parent_osm_id)
+        return
+    log.debug("OK %s %s (%s) is in %s %s in OSM which is logainm id %s", key, name, osmid, parent_name, parent_osm_id, parent_logainm_id)
+
+    options = name_options(name)
+    if len(options) > 1:
+        log.info("Got name options %(name)s: %(options)r", {'name': name, 'options': options})
+    if record.get('ambiguous'):
+        log.error("ERROR %s %s (%s) is in %s OSM:%s (logainm:%s) has >1 %s in logainm for this name: %s", key, name, osmid, parent_name, parent_osm_id, parent_logainm_id, key, ", ".join(str(x) for x in record['ambiguous']))
+
+    if outcome == MATCHED:
+        log.info("OK %(key)s %(name)s (%(osmid)s) is in %(parent_name)s OSM:%(parent_osmid)s (logainm:%(parent_osmid)s) has 1 %(key)s in logainm for this name: %(parent_logainm)s", dict(key=key, name=name, osmid=osmid, parent_name=parent_name, parent_osmid=parent_osm_id, parent_logainm=parent_logainm_id))
+    else:
+        log.error("ERROR %s %s (%s) is in %s OSM:%s (logainm:%s) http://www.townlands.ie/by/osm_id/%s/ which has no %s in logainm for this name", key, name, osmid, parent_name, parent_osm_id, parent_logainm_id, osmid, key)
+
+class RecordListHandler(logging.Handler):
+    """Keeps all log records in a list, so a worker process can send them
+    back to be logged by the main process"""
+
+    def __init__(self):
+        logging.Handler.__init__(self)
+        self.records = []
+
+    def emit(self, record):
+        # Format the message now, since the args might not be picklable
+        record.msg = record.getMessage()
+        record.args = None
+        record.exc_info = None
+        self.records.append(record)
+
+# Set just before the worker processes are forked, so they don't need to be
+# pickled
+_worker_state = {}
+
+def init_worker():
+    state = _worker_state
+    # Can't share an SQLite connection with the parent process
+    state['matcher'].reconnect(connect_logainm_db(read_only=True).cursor())
+    state['log_handler'] = RecordListHandler()
+    logger.handlers = [state['log_handler']]
+
+def match_shard(indexes):
+    state = _worker_state
+    state['log_handler'].records = []
+    # Don't send back what was counted before the fork
+    instrumentation.PROFILE.take_counters()
+    journal = ListJournal()
+    possibles = [state['possibles'][i] for i in indexes]
+    results = match_objects(state['logainm_data'], state['matcher'], possibles, state['existing_match_ups'], journal, **state['level'])
+    return results, state['log_handler'].records, journal.records, instrumentation.PROFILE.take_counters()
+
+def parallel_match_objects(logainm_data, matcher, possibles, existing_match_ups, journal, level, jobs):
+    """Same as match_objects, but split up by county, and matched in a pool of
+    jobs processes. The log messages & journal records from each county are
+    kept together."""
+    shards = defaultdict(list)
+    for i, obj in enumerate(possibles):
+        shards[obj.get('CO_OSM_ID', '')].append(i)
+    shards = [shards[co_osm_id] for co_osm_id in sorted(shards)]
+
+    # Build the index now, so each worker doesn't have to
+    logainm_data['index']['parents'].get(level['obj_key'], level['parent_key'])
+
+    _worker_state.update(logainm_data=logainm_data, matcher=matcher, possibles=possibles,
+                         existing_match_ups=existing_match_ups, level=level)
+    pool = multiprocessing.Pool(jobs, initializer=init_worker)
+    try:
+        shard_results = pool.map(match_shard, shards, chunksize=1)
+    finally:
+        pool.close()
+        pool.join()
+        _worker_state.clear()
 
-def hierachial_matchup(logainm_data, cursor, key, obj_logainm_code, parent_logainm_code, obj_key, parent_key, parent_name, existing_match_ups=None):
-    existing_match_ups = existing_match_ups or {}
-    logger.info("Have %d %s in total", len(logainm_data[key]), key)
     results = {}
+    for shard_result, records, journal_records, counters in shard_results:
+        instrumentation.PROFILE.add_counters(counters)
+        for record in records:
+            logger.handle(record)
+        for record in journal_records:
+            journal.add(record)
+        results.update(shard_result)
+    return results
 
-    possibles = [b for b in logainm_data[key] if b['LOGAINM_RE'] == '']
-    logger.info("Found %(len)d (%(percent)f%%) %(type)s without logainm ref", dict(len=len(possibles), type=key, percent=(len(possibles)*100/len(logainm_data[key]))))
+def known_parent(logainm_data, obj, obj_key, parent_key, existing_match_ups):
+    """Returns (parent OSM id, parent logainm id) for this object, or
+    (None, None) if there isn't exactly one parent with one logainm id. Like
+    hierachial_matchup does, but without logging anything."""
+    parent_osm_ids = parent_osmid_for_obj_osmid(logainm_data, obj['OSM_ID'], obj_key, parent_key)
+    if len(parent_osm_ids) != 1:
+        return None, None
+    parent_osm_id = parent_osm_ids.pop()
+    parent_logainm_id = logainm_data['index']['osmid_to_logainm_ref'].get(parent_osm_id)
+    if parent_logainm_id is None:
+        parent_logainm_id = existing_match_ups.get(('relation', parent_osm_id[1:]), {}).get('logainm_id')
+    if parent_logainm_id is None or ";" in str(parent_logainm_id):
+        return None, None
+    return parent_osm_id, parent_logainm_id
+
+def planned_lookups(logainm_data, possibles, obj_key, parent_key, existing_match_ups):
+    """Return the (parent_logainm_id, name_key) lookups and logainm ids which
+    hierachial_matchup might need for these objects, without logging
+    anything. Used to let the matcher fetch everything for a level at once."""
+    lookups = set()
+    logainm_ids = set()
+    for obj in possibles:
+        if logainm_data['liveosmdata'].get(obj['OSM_ID'], False):
+            logainm_ids.add(logainm_data['index']['osmid_to_logainm_ref'][obj['OSM_ID']])
+            continue
+
+        parent_osm_id, parent_logainm_id = known_parent(logainm_data, obj, obj_key, parent_key, existing_match_ups)
+        if parent_logainm_id is None:
+            continue
+
+        lookups.add((parent_logainm_id, name_key(name_en(obj))))
+
+    return lookups, logainm_ids
+
+def match_objects(logainm_data, matcher, possibles, existing_match_ups, journal, key, obj_logainm_code, parent_logainm_code, obj_key, parent_key, parent_name):
+    """Try to find the logainm object for each of these OSM objects (which
+    are all of one level). Adds a record for each one to the journal. Returns
+    a dict of ('relation', osm_id) -> tags"""
+    results = {}
+
+    lookups, logainm_ids = planned_lookups(logainm_data, possibles, obj_key, parent_key, existing_match_ups)
+    matcher.prepare(parent_logainm_code, obj_logainm_code, lookups, logainm_ids)
 
     for obj in possibles:
         # maybe it's in the OSM XML already?
         if logainm_data['liveosmdata'].get(obj['OSM_ID'], False):
             logainm_id = logainm_data['index']['osmid_to_logainm_ref'][obj['OSM_ID']]
-            logger.info("%(key)s %(name)s (OSM:%(osmid)s) has a logainm:ref in OSM (logainm %(logainm_id)s)", {'key': key, 'name': name_en(obj), 'osmid': obj['OSM_ID'], 'logainm_id': logainm_id})
+            journal.add(journal_record(IN_OSM, key, obj, logainm_id=logainm_id))
             try:
-                results[('relation', obj['OSM_ID'][1:])] = get_logainm_tags(cursor, logainm_id)
+                results[('relation', obj['OSM_ID'][1:])] = matcher.tags(logainm_id)
             except:
                 pass
             continue
 
-        logger.debug("Starting to look at %s %s (osm:%s)", key, name_en(obj), obj['OSM_ID'])
-        parent_osm_id = parent_osmid_for_obj_osmid(logainm_data, obj['OSM_ID'], obj_key, parent_key)
-        if len(parent_osm_id) == 0:
-            logger.error("ERROR No %s found for %s %s (%s) in OSM: Tie: http://www.townlands.ie/by/osm_id/%s", parent_name, key, name_en(obj), obj['OSM_ID'], obj['OSM_ID'])
+        parent_osm_ids = sorted(parent_osmid_for_obj_osmid(logainm_data, obj['OSM_ID'], obj_key, parent_key))
+        if len(parent_osm_ids) == 0:
+            journal.add(journal_record(NO_PARENT, key, obj))
             continue
-        elif len(parent_osm_id) > 1:
-            logger.error("ERROR Found %s (%s) %s for %s %s (osmid=%s) in OSM", len(parent_osm_id), ",".join(parent_osm_id), parent_name, key, name_en(obj), obj['OSM_ID'])
+        elif len(parent_osm_ids) > 1:
+            journal.add(journal_record(MANY_PARENTS, key, obj, parent_osm_ids=parent_osm_ids))
+            continue
+        parent_osm_id = parent_osm_ids[0]
+        try:
+            parent_logainm_id = osmid_to_logainm_ref(logainm_data, parent_osm_id, existing_match_ups)
+        except (IndexError, KeyError):
+            journal.add(journal_record(PARENT_NO_LOGAINM, key, obj, parent_osm_ids=parent_osm_ids))
+            continue
+        if ";" in str(parent_logainm_id):
+            journal.add(journal_record(PARENT_MANY_LOGAINM, key, obj, parent_osm_ids=parent_osm_ids, parent_logainm_id=parent_logainm_id))
             continue
-        elif len(parent_osm_id) == 1:
-            parent_osm_id = parent_osm_id.pop()
-            try:
-                parent_logainm_id = osmid_to_logainm_ref(logainm_data, parent_osm_id, existing_match_ups)
-                if ";" in str(parent_logainm_id):
-                    logger.error("ERROR %s %s (%s) is in %s %s in OSM which is many logainms: %s Tie: http://www.townlands.ie/by/osm_id/%s", key, name_en(obj), obj['OSM_ID'], parent_name, parent_osm_id, parent_logainm_id, obj['OSM_ID'])
-                    continue
-                else:
-                    logger.debug("OK %s %s (%s) is in %s %s in OSM which is logainm id %s", key, name_en(obj), obj['OSM_ID'], parent_name, parent_osm_id, parent_logainm_id)
-            except (IndexError, KeyError):
-                logger.error("ERROR %s %s (%s) is in %s %s in OSM which has no known logainm", key, name_en(obj), obj['OSM_ID'], parent_name, parent_osm_id)
-                continue
-        else:
-            assert False
 
         # Now we have the logainm ref of the parent that this obj is in.
         # Look at the logainm data for the objs in that obj
-        logainm_id = find_osm_obj_based_on_logainm(cursor, parent_logainm_code, obj_logainm_code, parent_logainm_id, obj, key, parent_name, parent_osm_id)
-        if logainm_id is None:
-            continue
-        else:
-            results[('relation', obj['OSM_ID'][1:])] = get_logainm_tags(cursor, logainm_id)
+        logainm_id, ambiguous = find_osm_obj_based_on_logainm(matcher, parent_logainm_code, obj_logainm_code, parent_logainm_id, obj)
+        journal.add(journal_record(NOT_FOUND if logainm_id is None else MATCHED, key, obj, parent_osm_ids=parent_osm_ids,
+                                   parent_logainm_id=parent_logainm_id, logainm_id=logainm_id, ambiguous=ambiguous or None))
+        if logainm_id is not None:
+            results[('relation', obj['OSM_ID'][1:])] = matcher.tags(logainm_id)
+
+    return results
+
+def hierachial_matchup(logainm_data, matcher, key, obj_logainm_code, parent_logainm_code, obj_key, parent_key, parent_name, existing_match_ups=None, jobs=1, journal=None):
+    """Match up the objects of this level. What happened to each object goes
+    to the journal, by default they're logged."""
+    existing_match_ups = existing_match_ups or {}
+    journal = journal or LoggingJournal(logger)
+    logger.info("Have %d %s in total", len(logainm_data[key]), key)
+
+    possibles = [b for b in logainm_data[key] if b['LOGAINM_RE'] == '']
+    if len(possibles) == 0:
+        logger.info("Found no %s without logainm ref", key)
+        return {}
+    logger.info("Found %(len)d (%(percent)f%%) %(type)s without logainm ref", dict(len=len(possibles), type=key, percent=(len(possibles)*100/len(logainm_data[key]))))
 
+    level = dict(key=key, obj_logainm_code=obj_logainm_code, parent_logainm_code=parent_logainm_code,
+                 obj_key=obj_key, parent_key=parent_key, parent_name=parent_name)
+    with instrumentation.stage("matching " + key) as stage:
+        stage.objects = len(possibles)
+        if jobs > 1:
+            results = parallel_match_objects(logainm_data, matcher, possibles, existing_match_ups, journal, level, jobs)
+        else:
+            results = match_objects(logainm_data, matcher, possibles, existing_match_ups, journal, **level)
 
     logger.info("Matched up %d %s of %d without a logainm id (%s%%)", len(results), key, len(possibles), (len(results)*100)/len(possibles))
     return results
 
+def levenshtein(a, b, max_distance=None):
+    """Edit distance between a and b. With max_distance, stops early and
+    returns max_distance+1 if it's more than that"""
+    if max_distance is None:
+        max_distance = max(len(a), len(b))
+    if abs(len(a) - len(b)) > max_distance:
+        return max_distance + 1
+    previous = range(len(b) + 1)
+    for i, ca in enumerate(a, 1):
+        current = [i]
+        for j, cb in enumerate(b, 1):
+            current.append(min(previous[j] + 1, current[j-1] + 1, previous[j-1] + (ca != cb)))
+        if min(current) > max_distance:
+            return max_distance + 1
+        previous = current
+    return previous[-1]
+
+def fuzzy_name(name):
+    """name_key of this name, without fadas & apostrophes"""
+    name = u"".join(c for c in unicodedata.normalize('NFKD', name) if not unicodedata.combining(c))
+    name = name.replace(u"'", u"").replace(u"\u2019", u"")
+    return name_key(name)
+
+class BKTree(object):
+    """BK-tree of strings, to find all the strings within an edit distance of
+    a string without comparing against every one. Each node is
+    [string, list of values, {distance: child node}]"""
+
+    def __init__(self):
+        self.root = None
+
+    def add(self, string, value):
+        if self.root is None:
+            self.root = [string, [value], {}]
+            return
+        node = self.root
+        while True:
+            distance = levenshtein(string, node[0])
+            if distance == 0:
+                node[1].append(value)
+                return
+            if distance not in node[2]:
+                node[2][distance] = [string, [value], {}]
+                return
+            node = node[2][distance]
+
+    def search(self, string, max_distance):
+        """Yield (distance, value) for everything within max_distance"""
+        if self.root is None:
+            return
+        to_check = [self.root]
+        while to_check:
+            node = to_check.pop()
+            # The exact distance is needed to know which children to check
+            distance = levenshtein(string, node[0])
+            if distance <= max_distance:
+                for value in node[1]:
+                    yield distance, value
+            for child_distance, child in node[2].items():
+                if distance - max_distance <= child_distance <= distance + max_distance:
+                    to_check.append(child)
+
+class FuzzyIndex(object):
+    """BK-trees of the English & Irish names of the children of logainm
+    objects. The tree for a (parent, category) is built the first time it's
+    searched."""
+
+    def __init__(self, cursor, max_distance):
+        logainm_closure.require_closure(cursor.connection)
+        self.cursor = cursor
+        self.max_distance = max_distance
+        self.trees = {}
+
+    def tree(self, parent_logainm_code, obj_logainm_code, parent_logainm_id):
+        if (parent_logainm_id, obj_logainm_code) in self.trees:
+            instrumentation.count('cache_hits')
+        else:
+            tree = BKTree()
+            instrumentation.count('sql_queries')
+            self.cursor.execute(FUZZY_CANDIDATES_SQL, {'parent_logainm_code': parent_logainm_code, 'obj_logainm_code': obj_logainm_code, 'parent_logainm_id': parent_logainm_id})
+            for logainm_id, obj_name_en, obj_name_ga in self.cursor.fetchall():
+                for name in (obj_name_en, obj_name_ga):
+                    if name not in (None, ''):
+                        tree.add(fuzzy_name(name), (logainm_id, name))
+            self.trees[(parent_logainm_id, obj_logainm_code)] = tree
+        return self.trees[(parent_logainm_id, obj_logainm_code)]
+
+    def best(self, parent_logainm_code, obj_logainm_code, parent_logainm_id, name):
+        """Returns (distance, [(logainm_id, name), ...]) of the closest
+        children to this name, or (None, []) if there's none close enough"""
+        found = defaultdict(set)
+        for distance, value in self.tree(parent_logainm_code, obj_logainm_code, parent_logainm_id).search(fuzzy_name(name), self.max_distance):
+            found[distance].add(value)
+        if len(found) == 0:
+            return None, []
+        distance = min(found)
+        return distance, sorted(found[distance])
+
+def fuzzy_matchup(logainm_data, fuzzy_index, existing_match_ups, results, key, obj_logainm_code, parent_logainm_code, obj_key, parent_key, parent_name):
+    """For the objects of this level which weren't matched, and are in a
+    parent with a known logainm id, yield a dict of the closest logainm
+    object. These are only for someone to review, they're not used."""
+    possibles = [b for b in logainm_data[key] if b['LOGAINM_RE'] == '' and ('relation', b['OSM_ID'][1:]) not in results]
+    num_found = 0
+    for obj in possibles:
+        if logainm_data['liveosmdata'].get(obj['OSM_ID'], False):
+            continue
+        parent_osm_id, parent_logainm_id = known_parent(logainm_data, obj, obj_key, parent_key, existing_match_ups)
+        if parent_logainm_id is None:
+            continue
+
+        distance, candidates = fuzzy_index.best(parent_logainm_code, obj_logainm_code, parent_logainm_id, name_en(obj))
+        if distance is None:
+            continue
+        num_found += 1
+        yield {
+            'type': key, 'osm_id': obj['OSM_ID'], 'name': name_en(obj),
+            'parent_osm_id': parent_osm_id, 'parent_logainm_id': parent_logainm_id,
+            'distance': distance, 'logainm_id': candidates[0][0], 'logainm_name': candidates[0][1],
+            'num_candidates': len(set(logainm_id for logainm_id, name in candidates)),
+        }
+
+    logger.info("Found fuzzy candidates for %d of %d unmatched %s", num_found, len(possibles), key)
+
+FUZZY_COLUMNS = ['type', 'osm_id', 'name', 'parent_osm_id', 'parent_logainm_id', 'distance', 'logainm_id', 'logainm_name', 'num_candidates']
+
+def write_fuzzy_matches(writer, fuzzy_matches):
+    for row in fuzzy_matches:
+        writer.writerow([unicode(row[col]).encode("utf-8") for col in FUZZY_COLUMNS])
+
+# The matching is done by the code in these, so checkpoints made with other
+# versions of them aren't used
+MATCHING_SOURCES = ["match.py", "logainm_store.py", "logainm_closure.py", "logainm_closure.sql"]
+
+class LevelCheckpoints(object):
+    """Saves the results (& journal records) of each level in the cache dir,
+    and loads them again if the input files, engine, number of jobs, the
+    matching code, and the levels before it are all the same.
+
+    With rematch, that level and the levels after it are always matched
+    again, and the checkpoints of the levels before it are used even if the
+    matching code has changed, e.g. while trying out a change to how the
+    townlands are matched."""
+
+    def __init__(self, cache_dir, fingerprints, engine, jobs, rematch=None):
+        self.cache_dir = cache_dir
+        # marshal's format can change between Python versions
+        self.key = self.hash(tuple(sys.version_info[:2]), engine, jobs, sorted((f, fp[0], fp[2]) for f, fp in fingerprints.items()))
+        self.code = source_hash(MATCHING_SOURCES)
+        self.rematch = rematch
+        self.rematching = False
+
+    @staticmethod
+    def hash(*values):
+        return hashlib.sha1(repr(values)).hexdigest()
+
+    def filename(self, level):
+        return os.path.join(self.cache_dir, "checkpoint-{}.marshal".format(level['key']))
+
+    def load(self, level):
+        """Move on to this level, and return its saved (results, journal
+        records), or None if it has to be matched (and then save()d)"""
+        self.key = self.hash(self.key, level['key'])
+        self.rematching = self.rematching or level['key'] == self.rematch
+        if self.rematching:
+            return None
+        filename = self.filename(level)
+        try:
+            with open(filename, 'rb') as fp:
+                key, code = marshal.load(fp)
+                if key != self.key:
+                    logger.info("Checkpoint %s is out of date", filename)
+                    return None
+                if code != self.code:
+                    if self.rematch is None:
+                        logger.info("The matching code has changed since checkpoint %s was saved", filename)
+                        return None
+                    logger.warning("Using checkpoint %s, which was made by different matching code, since only %s on are rematched", filename, self.rematch)
+                results = marshal.load(fp)
+        except IOError:
+            return None
+        except (EOFError, ValueError, TypeError):
+            logger.warning("Ignoring invalid checkpoint %s", filename)
+            return None
+        # The levels after this depend on which code matched it
+        self.key = self.hash(self.key, code)
+        return results
+
+    def save(self, level, results, journal_records):
+        write_marshal(self.filename(level), [(self.key, self.code), (results, journal_records)])
+        self.key = self.hash(self.key, self.code)
+
+def match_levels(logainm_data, matcher, levels, jobs=1, journal=None, fuzzy_index=None, fuzzy_writer=None, checkpoints=None):
+    """Match up the objects at each of these levels (in order, since each
+    level needs the matches of the level above), and return all the logainm
+    candidates, dupes and all. With checkpoints (LevelCheckpoints), levels
+    which were matched before with the same inputs are loaded instead, and
+    their journal records added again."""
+    journal = journal or LoggingJournal(logger)
+    logainm_candidates = {}
+    for level in levels:
+        checkpoint = None
+        if checkpoints is not None:
+            with instrumentation.stage("loading checkpoint of " + level['key']):
+                checkpoint = checkpoints.load(level)
+        if checkpoint is not None:
+            results, journal_records = checkpoint
+            for record in journal_records:
+                journal.add(record)
+            logger.info("Loaded %d matched %s from checkpoint %s", len(results), level['key'], checkpoints.filename(level))
+        else:
+            level_journal = RecordingJournal(journal)
+            results = hierachial_matchup(logainm_data, matcher, existing_match_ups=logainm_candidates, jobs=jobs, journal=level_journal, **level)
+            if checkpoints is not None:
+                checkpoints.save(level, results, level_journal.records)
+        if fuzzy_writer is not None:
+            with instrumentation.stage("fuzzy matching " + level['key']):
+                write_fuzzy_matches(fuzzy_writer, fuzzy_matchup(logainm_data, fuzzy_index, logainm_candidates, results, **level))
+        logainm_candidates.update(results)
+    return logainm_candidates
+
 def remove_and_warn_dupes(logainm_candidates):
     logainm_ref_to_osm = defaultdict(set)
     for key, tags in logainm_candidates.items():
@@ -272,16 +1165,76 @@ def limit(logainm_candidates, limit):
 
     return logainm_candidates
 
+def add_logainm_tags_to_relation(rel, logainm_data):
+    """Add the logainm tags for logainm_data to this relation XML element"""
+    # This tag is needed so JOSM knows to upload it
+    rel.set("action", "modify")
+
+    logger.debug("Adding tags to OSM_ID %s", rel.get("id"))
+    for k, v in logainm_tags(rel, logainm_data).items():
+        ET.SubElement(rel, 'tag', {'k': k, 'v': unicode(v)})
+
+def stream_osm_elements(input_filename, output=None):
+    """Incrementally read the OSM XML in input_filename, and yield each
+    direct child of <osm> (e.g. <relation>, <bounds>) once it's fully read
+    in. Each element is freed afterwards, so memory usage doesn't grow with
+    the size of the input. The <osm> attributes are copied to output, if
+    given."""
+    root = None
+    depth = 0
+    for event, el in ET.iterparse(input_filename, events=("start", "end")):
+        if event == 'start':
+            if root is None:
+                root = el
+                if output is not None:
+                    output.root_attrib = dict(root.attrib)
+            depth += 1
+            continue
+
+        depth -= 1
+        if depth != 1:
+            # Only look at the direct children of <osm>, and wait until
+            # they are fully read in
+            continue
+
+        yield el
+        root.clear()
+
+def write_matched_relations(elements, output, logainm_candidates):
+    """Write the relations which are in logainm_candidates (with the new
+    tags) to output. Unmatched relations are dropped, other elements (e.g.
+    <bounds>) are copied as is."""
+    for el in elements:
+        if el.tag == 'relation':
+            osm_id = el.get("id", None)
+            if ('relation', osm_id) not in logainm_candidates:
+                continue
+            add_logainm_tags_to_relation(el, logainm_candidates[('relation', osm_id)])
+            output.add(el, group=output.county_of(el))
+        else:
+            output.add(el)
+
 def main():
 
     parser = argparse.ArgumentParser()
-    parser.add_argument("-i", "--input")
+    parser.add_argument("-i", "--input", default="boundaries.osm.xml")
     parser.add_argument("-o", "--output")
     parser.add_argument("--baronies", action="store_true")
     parser.add_argument("--civil-parishes", action="store_true")
     parser.add_argument("--townlands", action="store_true")
     parser.add_argument("-v", "--verbose", action="store_true")
     parser.add_argument("-n", "--dry-run", action="store_true")
+    parser.add_argument("--engine", choices=sorted(MATCHERS.keys()), default="batch", help="How to look up logainm data. 'sql' does one query per lookup, 'batch' does one query per level, 'memory' loads it all into memory at the start")
+    parser.add_argument("-j", "--jobs", type=int, default=1, help="Match objects in this many processes, split up by county")
+    parser.add_argument("--fuzzy-output", help="Write the closest logainm object for unmatched objects to this TSV file, for review")
+    parser.add_argument("--fuzzy-max-distance", type=int, default=2, help="Largest edit distance for --fuzzy-output (default: %(default)s)")
+    parser.add_argument("--journal", help="Write what happened to each object to this JSON lines file, rather than logging it. Use render_journal.py to read it")
+    parser.add_argument("--stream", action="store_true", help="Read & write the OSM XML incrementally, rather than loading it all into memory")
+    parser.add_argument("--cache-dir", default=".match-cache", help="Keep a snapshot of the logainm data (from the CSVs & input) here, which is reused while they don't change (default: %(default)s)")
+    parser.add_argument("--no-cache", action="store_true", help="Always read the logainm data from the CSVs & input, and match every level")
+    parser.add_argument("--rematch", choices=sorted(LEVELS.keys()), help="Match this level, and the levels after it, again, and use the checkpoints of the levels before it, even if match.py has changed")
+    osm_output.add_output_arguments(parser)
+    parser.add_argument("--profile", metavar="FILE", help="Write the time, CPU, memory & counters of each stage to this JSON file")
 
     parser.add_argument("-l", "--limit")
 
@@ -294,56 +1247,82 @@ def main():
         ch.setLevel(logging.INFO)
     formatter = logging.Formatter('%(asctime)s\t%(levelname)s\tL%(lineno)s\t%(message)s')
     ch.setFormatter(formatter)
-    logger.addHandler(ch)
-
-    conn = sqlite3.connect("logainm.sqlite")
-    cursor = conn.cursor()
-
-    logger.setLevel(logging.DEBUG)
-
-    logainm_data = read_logainm_data()
-
-    logainm_candidates = {}
+    for log in [logger, osm_output.logger, logainm_closure.logger]:
+        log.addHandler(ch)
+        log.setLevel(logging.DEBUG)
 
-    if args.baronies:
-        logainm_candidates.update(baronies_matchup(logainm_data, cursor, logainm_candidates))
+    try:
+        run(args)
+    finally:
+        if args.profile:
+            instrumentation.PROFILE.dump(args.profile)
 
-    if args.civil_parishes:
-        logainm_candidates.update(civil_parish_matchup(logainm_data, cursor, logainm_candidates))
+def run(args):
+    conn = connect_logainm_db(read_only=True)
+    cursor = conn.cursor()
 
-    if args.townlands:
-        logainm_candidates.update(townlands_matchup(logainm_data, cursor, logainm_candidates))
+    with instrumentation.stage("setting up {} matcher".format(args.engine)):
+        matcher = MATCHERS[args.engine](cursor)
 
-    logainm_candidates = remove_and_warn_dupes(logainm_candidates)
-    logainm_candidates = limit(logainm_candidates, args.limit)
+    if args.stream or args.dry_run:
+        # relations are only read (from args.input) if the snapshot can't be used
+        root = None
+        relations = None
+    else:
+        # read in OSM XML, once, for the existing tags & the output
+        with printer("reading in OSM XML") as stage:
+            root = ET.parse(args.input).getroot()
+            stage.objects = len(root)
+        relations = osm_relations(root)
+
+    with printer("reading logainm data") as stage:
+        logainm_data = read_logainm_data(relations, osm_filename=args.input, cache_dir=None if args.no_cache else args.cache_dir)
+        stage.objects = sum(len(logainm_data[key]) for key in LEVELS)
+
+    journal = JournalWriter(args.journal) if args.journal else LoggingJournal(logger)
+
+    fuzzy_index = fuzzy_writer = None
+    if args.fuzzy_output:
+        fuzzy_index = FuzzyIndex(cursor, args.fuzzy_max_distance)
+        fuzzy_output = open(args.fuzzy_output, 'w')
+        fuzzy_writer = csv.writer(fuzzy_output, delimiter='\t')
+        fuzzy_writer.writerow(FUZZY_COLUMNS)
+
+    levels = [level for wanted, level in [(args.baronies, BARONIES), (args.civil_parishes, CIVIL_PARISHES), (args.townlands, TOWNLANDS)] if wanted]
+    checkpoints = None
+    if not args.no_cache:
+        fingerprints = fingerprint_files([filename for filename, keyname in LOGAINM_DATA_CSVS] + [args.input, logainm_store.DEFAULT_FILENAME], args.cache_dir)
+        checkpoints = LevelCheckpoints(args.cache_dir, fingerprints, args.engine, args.jobs, rematch=args.rematch)
+
+    logainm_candidates = match_levels(logainm_data, matcher, levels, jobs=args.jobs, journal=journal, fuzzy_index=fuzzy_index, fuzzy_writer=fuzzy_writer, checkpoints=checkpoints)
+
+    journal.close()
+    if fuzzy_writer is not None:
+        fuzzy_output.close()
+
+    with instrumentation.stage("removing duplicates") as stage:
+        logainm_candidates = remove_and_warn_dupes(logainm_candidates)
+        logainm_candidates = limit(logainm_candidates, args.limit)
+        stage.objects = len(logainm_candidates)
 
     if args.dry_run:
         return
 
-    # read in OSM XML
-    with printer("reading in OSM XML"):
-        tree = ET.parse(args.input)
-        root = tree.getroot()
-
-    # add new tags to OSM XML
-    with printer("adding XML tags"):
-        for rel in root.findall("relation"):
-            osm_id = rel.get("id", None)
-            if ('relation', osm_id) in logainm_candidates:
-
-                # This tag is needed so JOSM knows to upload it
-                rel.set("action", "modify")
-
-                logging.debug("Adding tags to OSM_ID %d", osm_id)
-                logaimn_data = logainm_candidates[('relation', osm_id)]
-                for k, v in logainm_tags(rel, logaimn_data).items():
-                    ET.SubElement(rel, 'tag', {'k': k, 'v': unicode(v)})
-            else:
-                root.remove(rel)
+    output = osm_output.output_from_args(args, cursor)
 
+    if args.stream:
+        with printer("streaming OSM XML") as stage:
+            write_matched_relations(stream_osm_elements(args.input, output), output, logainm_candidates)
+            output.close()
+            stage.objects = output.num_objects
+        return
 
-    # write out OSM XML
-    tree.write(args.output, encoding='utf-8', xml_declaration=True) 
+    # add new tags, and write out OSM XML
+    with printer("writing out OSM XML") as stage:
+        output.root_attrib = dict(root.attrib)
+        write_matched_relations(root, output, logainm_candidates)
+        output.close()
+        stage.objects = output.num_objects
 
 if __name__ == '__main__':
     main()
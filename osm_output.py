@@ -0,0 +1,186 @@
+"""
+Write the changed OSM objects, as a JOSM OSM XML file (with action="modify"),
+or as osmChange (.osc), which can be uploaded directly.
+
+The output can be split into shards of at most --max-objects objects each
+(e.g. 10000, the most the OSM API allows in one changeset), and grouped by
+the county the objects are in (based on their logainm:ref), so each file can
+be uploaded, and retried, on its own.
+
+    output = osm_output.output_from_args(args, cursor)
+    for rel in relations:
+        output.add(rel, group=output.county_of(rel))
+    filenames = output.close()
+
+Objects are written as they're added, so the whole output is never in
+memory.
+"""
+import os
+import re
+import logging
+import xml.etree.ElementTree as ET
+from xml.sax.saxutils import quoteattr
+
+import logainm_closure
+
+logger = logging.getLogger(__name__)
+
+OSM_OBJECT_TAGS = {'node', 'way', 'relation'}
+
+
+def write_element(fp, el, skip_attribs=()):
+    """Write this element, on a line of its own. The element isn't changed
+    (it might still belong to an iterparse)."""
+    tail = el.tail
+    skipped = [(k, el.attrib.pop(k)) for k in skip_attribs if k in el.attrib]
+    el.tail = None
+    ET.ElementTree(el).write(fp, encoding='utf-8', xml_declaration=False)
+    el.tail = tail
+    el.attrib.update(skipped)
+    fp.write("\n")
+
+def format_attrib(attrib):
+    return "".join(u" {}={}".format(k, quoteattr(v)) for k, v in sorted(attrib.items())).encode("utf-8")
+
+
+class JOSMFile(object):
+    """OSM XML file, for opening in JOSM. Everything added is written, the
+    modified objects have action="modify" already."""
+
+    def __init__(self, filename, root_attrib):
+        self.fp = open(filename, 'w')
+        self.fp.write("<?xml version='1.0' encoding='utf-8'?>\n")
+        self.fp.write("<osm{}>\n".format(format_attrib(root_attrib)))
+
+    def write(self, el):
+        write_element(self.fp, el)
+
+    def close(self):
+        self.fp.write("</osm>\n")
+        self.fp.close()
+
+class OsmChangeFile(object):
+    """osmChange file. Only the objects with action="modify" are written,
+    everything else is unchanged."""
+
+    def __init__(self, filename, root_attrib):
+        self.fp = open(filename, 'w')
+        self.fp.write("<?xml version='1.0' encoding='utf-8'?>\n")
+        self.fp.write('<osmChange version="0.6" generator="logainm-osm-import">\n<modify>\n')
+
+    def write(self, el):
+        if el.tag in OSM_OBJECT_TAGS and el.get("action") == "modify":
+            write_element(self.fp, el, skip_attribs=("action", ))
+
+    def close(self):
+        self.fp.write("</modify>\n</osmChange>\n")
+        self.fp.close()
+
+FORMATS = {
+    'josm': JOSMFile,
+    'osc': OsmChangeFile,
+}
+
+def slug(group):
+    return re.sub("[^a-z0-9]+", "-", group.lower()).strip("-") or "unknown"
+
+
+class ShardedOutput(object):
+    """Writes the objects to one file, or to shards of max_objects objects
+    each, optionally grouped. With filename new-boundaries.osc, the shards
+    are new-boundaries-dublin-001.osc, new-boundaries-dublin-002.osc, etc."""
+
+    def __init__(self, filename, format=None, max_objects=None, grouped=False, counties=None):
+        self.filename = filename
+        self.format = format or ('osc' if filename.endswith(".osc") else 'josm')
+        self.max_objects = max_objects
+        self.grouped = grouped
+        self.counties = counties
+        self.root_attrib = {'version': '0.6', 'generator': 'logainm-osm-import'}
+        # group -> [open file, number of objects in it, number of shards]
+        self.shards = {}
+        self.filenames = []
+        self.num_objects = 0
+
+    def shard_filename(self, group, number):
+        if not self.grouped and self.max_objects is None:
+            return self.filename
+        base, ext = os.path.splitext(self.filename)
+        if self.grouped:
+            base += "-" + slug(group)
+        if self.max_objects is not None:
+            base += "-{:03d}".format(number)
+        return base + ext
+
+    def open_shard(self, group, number):
+        filename = self.shard_filename(group, number)
+        self.filenames.append(filename)
+        return FORMATS[self.format](filename, self.root_attrib)
+
+    def county_of(self, el, logainm_ref=None):
+        """Name of the county this object is in, according to logainm (by
+        its logainm:ref, or this one), for grouping"""
+        if self.counties is None:
+            return None
+        if logainm_ref is None:
+            logainm_ref = {tag.get('k'): tag.get('v') for tag in el.findall("tag")}.get('logainm:ref')
+        return self.counties.get(logainm_ref)
+
+    def add(self, el, group=None):
+        """Write this element. Objects count towards the shard size. Other
+        elements (e.g. <bounds>) are only written when there's one file."""
+        if el.tag not in OSM_OBJECT_TAGS and (self.grouped or self.max_objects is not None):
+            return
+        group = (group or "unknown") if self.grouped else None
+        if group not in self.shards:
+            self.shards[group] = [self.open_shard(group, 1), 0, 1]
+        shard = self.shards[group]
+
+        if el.tag in OSM_OBJECT_TAGS and el.get("action") == "modify":
+            if self.max_objects is not None and shard[1] >= self.max_objects:
+                shard[0].close()
+                shard[2] += 1
+                shard[0], shard[1] = self.open_shard(group, shard[2]), 0
+            shard[1] += 1
+            self.num_objects += 1
+
+        shard[0].write(el)
+
+    def close(self):
+        """Finish all the files, and return their names"""
+        if len(self.shards) == 0:
+            # Nothing changed, but there should still be an (empty) file
+            self.shards[None] = [self.open_shard("none", 1), 0, 1]
+        for shard in self.shards.values():
+            shard[0].close()
+        logger.info("Wrote %d changed objects to %d %s file(s): %s", self.num_objects, len(self.filenames), self.format, ", ".join(self.filenames))
+        return self.filenames
+
+
+class LogainmCounties(object):
+    """logainm id -> English name of the county it's in, loaded from the
+    logainm database the first time it's needed"""
+
+    def __init__(self, cursor):
+        self.cursor = cursor
+        self.counties = None
+
+    def get(self, logainm_id, default=None):
+        if self.counties is None:
+            logainm_closure.require_closure(self.cursor.connection)
+            self.cursor.execute("select con.descendant_id, county.name_en from logainm_closure as con join names as county on (county.logainm_id = con.ancestor_id) where con.ancestor_category_code = 'CON';")
+            self.counties = {str(logainm_id): name_en for logainm_id, name_en in self.cursor}
+            # and the counties themselves
+            self.cursor.execute("select logainm_id, name_en from names where logainm_category_code = 'CON';")
+            self.counties.update((str(logainm_id), name_en) for logainm_id, name_en in self.cursor)
+        return self.counties.get(str(logainm_id), default)
+
+
+def add_output_arguments(parser):
+    parser.add_argument("--format", choices=sorted(FORMATS.keys()), help="Output format, 'josm' (OSM XML with action=modify) or 'osc' (osmChange). Default: osc if the output ends in .osc, otherwise josm")
+    parser.add_argument("--max-objects", type=int, help="Split the output into files of at most this many changed objects (e.g. 10000 for one changeset each)")
+    parser.add_argument("--group-by-county", action="store_true", help="Write a separate file (or files) for each county")
+
+def output_from_args(args, cursor):
+    counties = LogainmCounties(cursor) if args.group_by_county else None
+    return ShardedOutput(args.output, format=args.format, max_objects=args.max_objects, grouped=args.group_by_county, counties=counties)
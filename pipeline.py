@@ -0,0 +1,267 @@
+"""
+Run the matching, tag completion, encoding fix & lints on the OSM data in one
+go. The input is read once, and each relation goes through each stage in
+turn, so later stages see the changes of earlier ones (e.g. the lints see the
+logainm:refs which were just added). Everything changed is written to one
+output, and what each stage did to one report.
+
+    python pipeline.py -i boundaries.osm.xml -o nightly.osc --report nightly-report.jsonl
+
+The report is a JSON lines file like the match journal, and can be read with
+render_journal.py.
+"""
+import sys
+import logging
+import argparse
+import xml.etree.ElementTree as ET
+
+import instrumentation
+import osm_output
+import match
+import add_all_logainm_tags
+import fix_names_encoding
+import logainm_lint
+import logainm_closure
+import logainm_store
+
+logger = logging.getLogger(__name__)
+
+printer = instrumentation.make_printer(logger)
+
+
+class Pipeline(object):
+    """Runs the OSM relations through these stages. Each stage has:
+
+        prepare(relations): look at all the relations (XML elements) before
+            any are changed, e.g. to look things up in bulk
+        process(rel, tags): look at, and maybe change, one relation (tags is
+            an add_all_logainm_tags.Tags). Returns True iff it was changed
+        finish(): called after all the relations are processed
+
+    Stages can add to self.new_logainm_refs (OSM id -> logainm id) in
+    prepare, so later stages know about the logainm:refs they will add."""
+
+    def __init__(self, stages, journal):
+        self.stages = stages
+        self.journal = journal
+        self.new_logainm_refs = {}
+        for stage in stages:
+            stage.pipeline = self
+
+    def logainm_refs(self, relations):
+        """All the logainm:refs of these relations, once the earlier stages
+        have run"""
+        for rel in relations:
+            if rel.get("id") in self.new_logainm_refs:
+                yield self.new_logainm_refs[rel.get("id")]
+            else:
+                for tag in rel.findall("tag"):
+                    if tag.get('k') == 'logainm:ref':
+                        yield tag.get('v')
+
+    def run(self, root, output):
+        relations = root.findall("relation")
+        for stage in self.stages:
+            with instrumentation.stage("preparing " + stage.name) as prof:
+                stage.prepare(relations)
+                prof.objects = len(relations)
+
+        with printer("running stages and writing out OSM XML") as prof:
+            prof.objects = len(relations)
+            output.root_attrib = dict(root.attrib)
+            for el in root:
+                if el.tag != 'relation':
+                    output.add(el)
+                    continue
+
+                tags = add_all_logainm_tags.Tags(el)
+                changed = False
+                for stage in self.stages:
+                    if stage.process(el, tags):
+                        changed = True
+                        # Stages might have changed the tags behind our back
+                        tags = add_all_logainm_tags.Tags(el)
+
+                if changed:
+                    el.set("action", "modify")
+                    output.add(el, group=output.county_of(el, tags.get('logainm:ref')))
+
+        for stage in self.stages:
+            with instrumentation.stage("finishing " + stage.name):
+                stage.finish()
+
+
+class MatchStage(object):
+    """Adds logainm:ref etc. to the relations which match.py matches up"""
+    name = 'match'
+
+    def __init__(self, cursor, levels, engine='batch', jobs=1):
+        self.cursor = cursor
+        self.levels = levels
+        self.engine = engine
+        self.jobs = jobs
+
+    def prepare(self, relations):
+        with instrumentation.stage("setting up {} matcher".format(self.engine)):
+            matcher = match.MATCHERS[self.engine](self.cursor)
+
+        with printer("reading logainm data") as stage:
+            logainm_data = match.read_logainm_data(match.osm_relations(relations))
+            stage.objects = sum(len(logainm_data[key]) for key in match.LEVELS)
+
+        logainm_candidates = match.match_levels(logainm_data, matcher, self.levels, jobs=self.jobs, journal=self.pipeline.journal)
+        with instrumentation.stage("removing duplicates") as stage:
+            self.logainm_candidates = match.remove_and_warn_dupes(logainm_candidates)
+            stage.objects = len(self.logainm_candidates)
+
+        for (osm_type, osm_id), logainm_data in self.logainm_candidates.items():
+            self.pipeline.new_logainm_refs[osm_id] = str(logainm_data['logainm_id'])
+
+    def process(self, rel, tags):
+        logainm_data = self.logainm_candidates.get(('relation', rel.get("id")))
+        if logainm_data is None:
+            return False
+        match.add_logainm_tags_to_relation(rel, logainm_data)
+        return True
+
+    def finish(self):
+        pass
+
+
+class AddAllTagsStage(object):
+    """Adds the logainm:url, names, etc. from logainm (add_all_logainm_tags.py)"""
+    name = 'add-all-tags'
+
+    def __init__(self, store):
+        self.store = store
+
+    def prepare(self, relations):
+        self.logainm_names = self.store.get_names(self.pipeline.logainm_refs(relations))
+
+    def process(self, rel, tags):
+        logainmref = add_all_logainm_tags.logainm_ref_key(tags.get('logainm:ref'))
+        if logainmref not in self.logainm_names:
+            return False
+        changed = add_all_logainm_tags.add_logainm_tags(tags, self.logainm_names[logainmref])
+        if changed:
+            self.pipeline.journal.add({'stage': self.name, 'outcome': 'added_tags', 'osm_id': rel.get("id"), 'keys': changed})
+        return len(changed) > 0
+
+    def finish(self):
+        pass
+
+
+class FixNamesEncodingStage(object):
+    """Fixes Irish names with "??" for letters (fix_names_encoding.py)"""
+    name = 'fix-names-encoding'
+
+    def __init__(self, store):
+        self.store = store
+
+    def prepare(self, relations):
+        # Only the few objects which have a broken name need to be looked up.
+        # They might only get a logainm:ref from an earlier stage.
+        bad = [rel for rel in relations if any('??' in add_all_logainm_tags.Tags(rel).get(k, "") for k in fix_names_encoding.NAME_GA_KEYS)]
+        self.logainm_names = self.store.get_names(self.pipeline.logainm_refs(bad))
+
+    def process(self, rel, tags):
+        if not fix_names_encoding.has_bad_name(tags):
+            return False
+        fixes = fix_names_encoding.fix_bad_names(rel.get("id"), tags, self.logainm_names)
+        for k, bad_name, correct_name in fixes:
+            self.pipeline.journal.add({'stage': self.name, 'outcome': 'fixed_name', 'osm_id': rel.get("id"), 'key': k, 'old': bad_name, 'new': correct_name})
+        return len(fixes) > 0
+
+    def finish(self):
+        pass
+
+
+class LintStage(object):
+    """Runs all the logainm_lint.py checks, after the other stages have run"""
+    name = 'lint'
+
+    def __init__(self, store):
+        self.linter = logainm_lint.Linter([check() for check in logainm_lint.CHECKS], store)
+
+    def prepare(self, relations):
+        pass
+
+    def process(self, rel, tags):
+        self.linter.visit(rel.get("id"), tags)
+        return False
+
+    def finish(self):
+        for check, problems in self.linter.finish():
+            for problem in problems:
+                self.pipeline.journal.add(dict(problem, stage=self.name, outcome=check.name))
+
+
+STAGES = ['match', 'add-all-tags', 'fix-names-encoding', 'lint']
+
+def make_stages(args, store):
+    """The stages to run, in order"""
+    wanted = args.stage or STAGES
+    levels = [level for flag, level in [(args.baronies, match.BARONIES), (args.civil_parishes, match.CIVIL_PARISHES), (args.townlands, match.TOWNLANDS)] if flag]
+    stages = {
+        'match': lambda: MatchStage(store.cursor(), levels or [match.BARONIES, match.CIVIL_PARISHES, match.TOWNLANDS], engine=args.engine, jobs=args.jobs),
+        'add-all-tags': lambda: AddAllTagsStage(store),
+        'fix-names-encoding': lambda: FixNamesEncodingStage(store),
+        'lint': lambda: LintStage(store),
+    }
+    return [stages[name]() for name in STAGES if name in wanted]
+
+
+def main(args=None):
+    args = args or sys.argv[1:]
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-i", "--input", default="boundaries.osm.xml")
+    parser.add_argument("-o", "--output", required=True)
+    parser.add_argument("--report", help="Write what each stage did to this JSON lines file, rather than logging it. Use render_journal.py to read it")
+    parser.add_argument("--stage", action="append", choices=STAGES, help="Only run this stage (can be given more than once). They're always run in the order: " + ", ".join(STAGES))
+    parser.add_argument("--baronies", action="store_true", help="Match baronies (if none of --baronies, --civil-parishes & --townlands are given, all are matched)")
+    parser.add_argument("--civil-parishes", action="store_true")
+    parser.add_argument("--townlands", action="store_true")
+    parser.add_argument("--engine", choices=sorted(match.MATCHERS.keys()), default="batch", help="How to look up logainm data when matching, see match.py")
+    parser.add_argument("-j", "--jobs", type=int, default=1, help="Match objects in this many processes, split up by county")
+    parser.add_argument("-v", "--verbose", action="store_true")
+    osm_output.add_output_arguments(parser)
+    parser.add_argument("--profile", metavar="FILE", help="Write the time, CPU, memory & counters of each stage to this JSON file")
+
+    args = parser.parse_args(args)
+
+    ch = logging.StreamHandler(sys.stdout)
+    if args.verbose:
+        ch.setLevel(logging.DEBUG)
+    else:
+        ch.setLevel(logging.INFO)
+    formatter = logging.Formatter('%(asctime)s\t%(levelname)s\tL%(lineno)s\t%(message)s')
+    ch.setFormatter(formatter)
+    for log in [logger, match.logger, add_all_logainm_tags.logger, fix_names_encoding.logger, logainm_lint.logger, osm_output.logger, logainm_closure.logger]:
+        log.addHandler(ch)
+        log.setLevel(logging.DEBUG)
+
+    try:
+        run(args)
+    finally:
+        if args.profile:
+            instrumentation.PROFILE.dump(args.profile)
+
+def run(args):
+    store = logainm_store.LogainmStore.open()
+
+    with printer("reading in OSM XML") as stage:
+        root = ET.parse(args.input).getroot()
+        stage.objects = len(root)
+
+    journal = match.JournalWriter(args.report) if args.report else match.LoggingJournal(logger)
+    output = osm_output.output_from_args(args, store.cursor())
+    try:
+        Pipeline(make_stages(args, store), journal).run(root, output)
+    finally:
+        journal.close()
+    output.close()
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
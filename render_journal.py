@@ -0,0 +1,44 @@
+"""
+Show a match journal (as written by match.py --journal, or pipeline.py
+--report) as the log messages match.py would have printed.
+
+    python render_journal.py match-journal.jsonl
+    python render_journal.py --outcome not_found --level townlands match-journal.jsonl
+"""
+import sys
+import logging
+import argparse
+
+import match
+
+
+def main(args=None):
+    args = args or sys.argv[1:]
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("journal", help="JSON lines file from match.py --journal")
+    parser.add_argument("--outcome", action="append", help="Only show records with this outcome (can be given more than once)")
+    parser.add_argument("--level", action="append", choices=sorted(match.LEVELS.keys()), help="Only show records for this level (can be given more than once)")
+    parser.add_argument("-v", "--verbose", action="store_true")
+
+    args = parser.parse_args(args)
+
+    ch = logging.StreamHandler(sys.stdout)
+    if args.verbose:
+        ch.setLevel(logging.DEBUG)
+    else:
+        ch.setLevel(logging.INFO)
+    ch.setFormatter(logging.Formatter('%(levelname)s\t%(message)s'))
+    match.logger.addHandler(ch)
+    match.logger.setLevel(logging.DEBUG)
+
+    for record in match.read_journal(args.journal):
+        if args.outcome and record['outcome'] not in args.outcome:
+            continue
+        if args.level and record.get('level') not in args.level:
+            continue
+        match.render_journal_record(match.logger, record)
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -1,62 +1,71 @@
 #! /usr/bin/python
 # encoding: utf-8
-import sqlite3
+"""
+Make the logainm pages (index.html, and counties/<name>.html for each
+county) from ../logainm.sqlite.
+
+A hash of each page's data & template is kept in manifest.json, and only the
+pages where that has changed (or which are missing) are made again, in
+parallel.
+
+    python make.py [-j 4] [--force]
+"""
+import os
+import sys
+import json
+import hashlib
+import argparse
+import multiprocessing
 import pprint
 from jinja2 import Template
 
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+import logainm_store
+
 def logainm_id_to_path(lid):
     s = "{:06d}".format(int(lid))
     return "{}/{}/{}.png".format(s[0:2], s[2:4], s[4:6])
 
-logainm = {}
-
-conn = sqlite3.connect("../logainm.sqlite")
-cursor = conn.cursor()
-
-cursor.execute("select logainm_id, name_en, name_ga from names where logainm_category_code = 'CON'")
-logainm['counties'] = []
-for c in list(cursor.fetchall()):
-    baronies = []
-    logainm['counties'].append({
-        'id': c[0],
-        'name_en': c[1],
-        'name_ga': c[2],
-        'baronies': baronies,
-        'icon': logainm_id_to_path(c[0]),
-    })
-
-    cursor.execute("select logainm_id, name_en, name_ga from names join geometric_contains where names.logainm_category_code = 'BAR' and geometric_contains.inner_obj_id = names.logainm_id and geometric_contains.outer_obj_id = ?", [c[0]])
-    for barony in list(cursor.fetchall()):
-        cps = []
-        baronies.append({
-            'id': barony[0],
-            'name_en': barony[1],
-            'name_ga': barony[2],
-            'civil_parishes': cps,
-            'icon': logainm_id_to_path(barony[0]),
-        })
-
-        cursor.execute("select logainm_id, name_en, name_ga from names join geometric_contains where names.logainm_category_code = 'PAR' and geometric_contains.inner_obj_id = names.logainm_id and geometric_contains.outer_obj_id = ?", [barony[0]])
-        for cp in list(cursor.fetchall()):
-            townlands = []
-            cps.append({
-                'id': cp[0],
-                'name_en': cp[1],
-                'name_ga': cp[2],
-                'townlands': townlands,
-                'icon': logainm_id_to_path(cp[0]),
-            })
-
-            cursor.execute("select logainm_id, name_en, name_ga from names join geometric_contains where names.logainm_category_code = 'BF' and geometric_contains.inner_obj_id = names.logainm_id and geometric_contains.outer_obj_id = ?", [cp[0]])
-            for t in list(cursor.fetchall()):
-                townlands.append({
-                    'id': t[0],
-                    'name_en': t[1],
-                    'name_ga': t[2],
-                    'icon': logainm_id_to_path(t[0]),
-                })
+# The child category for each category, and what the children are called
+CHILDREN = {'CON': ('BAR', 'baronies'), 'BAR': ('PAR', 'civil_parishes'), 'PAR': ('BF', 'townlands')}
+
+def load_counties(store):
+    """Load the whole county -> barony -> civil parish -> townland tree from
+    the LogainmStore, with one bulk lookup for each level. Something in more
+    than one parent (e.g. a civil parish in 2 baronies) is in each of them."""
+    objs = {}
+    def obj(row):
+        logainm_id = row['logainm_id']
+        if logainm_id not in objs:
+            objs[logainm_id] = {'id': logainm_id, 'name_en': row['name_en'], 'name_ga': row['name_ga'], 'icon': logainm_id_to_path(logainm_id)}
+            if row['logainm_category_code'] in CHILDREN:
+                objs[logainm_id][CHILDREN[row['logainm_category_code']][1]] = []
+        return objs[logainm_id]
+
+    counties = [obj(row) for row in store.names_in_category('CON')]
 
+    parents = counties
+    for category in ['CON', 'BAR', 'PAR']:
+        child_category, children_name = CHILDREN[category]
+        children = store.children_of([parent['id'] for parent in parents], child_category)
+        next_parents = {}
+        for parent in parents:
+            for row in children[logainm_store.id_str_key(parent['id'])]:
+                child = obj(row)
+                parent[children_name].append(child)
+                next_parents[child['id']] = child
+        parents = list(next_parents.values())
 
+    return counties
+
+def write_template(template, filename, **context):
+    """Render the template to this file a bit at a time (template.generate,
+    joined up into bigger pieces), rather than making the whole page in
+    memory first"""
+    stream = template.stream(**context)
+    stream.enable_buffering(1000)
+    with open(filename, 'w') as fp:
+        stream.dump(fp, encoding="utf-8")
 
 all_template_src = u"""<!DOCTYPE html><html>
 <head>
@@ -131,9 +140,6 @@ all_template_src = u"""<!DOCTYPE html><html>
 </html>
 """
 
-all_template = Template(all_template_src)
-with open("index.html" ,'w') as fp:
-    fp.write(all_template.render(counties=logainm['counties']).encode("utf-8"))
 
 
 per_county_template_src = u"""<!DOCTYPE html><html>
@@ -170,7 +176,91 @@ per_county_template_src = u"""<!DOCTYPE html><html>
 </html>
 """
 
-per_county_template = Template(per_county_template_src)
-for county in logainm['counties']:
-    with open("counties/"+county['name_en']+".html", "w") as fp:
-        fp.write(per_county_template.render(county=county).encode("utf-8"))
+TEMPLATES = {
+    'all': Template(all_template_src),
+    'per_county': Template(per_county_template_src),
+}
+TEMPLATE_SOURCES = {'all': all_template_src, 'per_county': per_county_template_src}
+
+MANIFEST = "manifest.json"
+
+def data_hash(obj):
+    """Hash of this data. It's only compared to the hash from the last run,
+    so the (dict) order only has to be the same each time, not sorted, which
+    would be a lot slower."""
+    return hashlib.sha1(json.dumps(obj, separators=(',', ':'))).hexdigest()
+
+def pages(counties):
+    """(filename, template name, context, hash of the data) of every page.
+    index.html depends on all the counties, so its hash is made from theirs,
+    rather than going through them all again."""
+    county_hashes = [data_hash(county) for county in counties]
+    yield "index.html", 'all', {'counties': counties}, data_hash(sorted(county_hashes))
+    for county, county_hash in zip(counties, county_hashes):
+        yield "counties/"+county['name_en']+".html", 'per_county', {'county': county}, county_hash
+
+def page_hash(template_name, data_hash):
+    """Hash of everything that goes into a page"""
+    return hashlib.sha1(TEMPLATE_SOURCES[template_name].encode("utf-8") + data_hash).hexdigest()
+
+def read_manifest():
+    if not os.path.exists(MANIFEST):
+        return {}
+    with open(MANIFEST) as fp:
+        return json.load(fp)
+
+def write_manifest(manifest):
+    with open(MANIFEST + ".tmp", 'w') as fp:
+        json.dump(manifest, fp, sort_keys=True, indent=0)
+    os.rename(MANIFEST + ".tmp", MANIFEST)
+
+def make_page(page):
+    filename, template_name, context = page
+    write_template(TEMPLATES[template_name], filename, **context)
+    return filename
+
+
+def main(args=None):
+    args = args or sys.argv[1:]
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-j", "--jobs", type=int, default=multiprocessing.cpu_count(), help="Make this many pages at once (default: number of CPUs)")
+    parser.add_argument("--force", action="store_true", help="Make all the pages, even if they haven't changed")
+    args = parser.parse_args(args)
+
+    store = logainm_store.LogainmStore.open("../logainm.sqlite")
+
+    logainm = {}
+    logainm['counties'] = load_counties(store)
+
+    manifest = {} if args.force else read_manifest()
+    new_manifest = {}
+    to_make = []
+    for filename, template_name, context, context_hash in pages(logainm['counties']):
+        new_manifest[filename] = page_hash(template_name, context_hash)
+        if manifest.get(filename) != new_manifest[filename] or not os.path.exists(filename):
+            to_make.append((filename, template_name, context))
+
+    print "{} of {} pages have changed".format(len(to_make), len(new_manifest))
+    if len(to_make) > 0:
+        if not os.path.isdir("counties"):
+            os.makedirs("counties")
+        if args.jobs > 1 and len(to_make) > 1:
+            pool = multiprocessing.Pool(min(args.jobs, len(to_make)))
+            try:
+                # index.html, the biggest page, is first, so it's not left
+                # until the end
+                for filename in pool.imap_unordered(make_page, to_make):
+                    pass
+            finally:
+                pool.close()
+                pool.join()
+        else:
+            for page in to_make:
+                make_page(page)
+
+    write_manifest(new_manifest)
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])